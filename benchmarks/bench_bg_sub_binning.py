@@ -0,0 +1,87 @@
+"""
+Accuracy vs speed of the background estimation on binned images.
+
+For each binning factor, the background level is estimated on every image and compared to the full resolution
+estimate. The error is reported in intensity units and relative to the background noise (the standard deviation
+of the background pixels), which is what matters for the segmentation.
+
+Without image paths, synthetic images are used: a noisy background with bright blobs and a few saturated pixels.
+
+Usage:
+    python benchmarks/bench_bg_sub_binning.py /data/A1_well/*_refseg_1.tif --factors 1 2 4 8
+    python benchmarks/bench_bg_sub_binning.py --size 4096 --images 3
+"""
+import argparse
+import time
+
+import numpy as np
+from tifffile import imread
+
+from cp_server.tasks_server.tasks.bg_sub.bg_sub import estimate_background, get_smo
+
+
+def synthetic_image(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    A noisy background with about one bright blob per 100x100 pixels, and a few saturated pixels.
+    """
+    img = rng.normal(1000, 50, (size, size))
+    n_blobs = size * size // 10_000
+    rows, cols = rng.integers(0, size, (2, n_blobs))
+    yy, xx = np.ogrid[-10:11, -10:11]
+    blob = 4000 * np.exp(-(yy**2 + xx**2) / 50)
+    for r, c in zip(rows, cols):
+        r0, c0 = max(r - 10, 0), max(c - 10, 0)
+        patch = img[r0:r + 11, c0:c + 11]
+        patch += blob[r0 - r + 10:r0 - r + 10 + patch.shape[0], c0 - c + 10:c0 - c + 10 + patch.shape[1]]
+    img[rng.integers(0, size, 20), rng.integers(0, size, 20)] = 65535
+    return img.clip(0, 65535).astype(np.uint16)
+
+def time_background(img: np.ndarray, sigma: float, size: int, factor: int) -> tuple[float, float]:
+    """
+    Background level and estimation time, once the SMO of the binned shape is cached (as on a running worker).
+    """
+    estimate_background(img, sigma, size, factor)
+    start = time.perf_counter()
+    background = estimate_background(img, sigma, size, factor)
+    return background, time.perf_counter() - start
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="TIFF images to benchmark, synthetic images if none")
+    parser.add_argument("--size", type=int, default=4096, help="Width and height of the synthetic images")
+    parser.add_argument("--images", type=int, default=3, help="Number of synthetic images")
+    parser.add_argument("--factors", type=int, nargs="+", default=[1, 2, 4, 8], help="Binning factors")
+    parser.add_argument("--sigma", type=float, default=0.0)
+    parser.add_argument("--smo-size", type=int, default=7, help="Averaging window size of the SMO")
+    args = parser.parse_args()
+
+    if args.paths:
+        imgs = [imread(path) for path in args.paths]
+    else:
+        rng = np.random.default_rng(0)
+        imgs = [synthetic_image(args.size, rng) for _ in range(args.images)]
+
+    results: dict[int, list[tuple[float, float]]] = {factor: [] for factor in args.factors}
+    noise = []
+    for img in imgs:
+        for factor in args.factors:
+            results[factor].append(time_background(img, args.sigma, args.smo_size, factor))
+        full_smo = get_smo(tuple(img.shape), float(args.sigma), int(args.smo_size))
+        noise.append(float(full_smo.bg_mask(img).compressed().std()))
+
+    reference = [background for background, _ in results[1]] if 1 in results else None
+    print(f"{'factor':>6} {'ms/image':>9} {'speed-up':>9} {'max |err|':>10} {'err/noise':>10}")
+    base_time = np.mean([elapsed for _, elapsed in results[args.factors[0]]])
+    for factor, values in results.items():
+        elapsed = np.mean([t for _, t in values])
+        if reference is None:
+            error, relative = float("nan"), float("nan")
+        else:
+            errors = [abs(background - ref) for (background, _), ref in zip(values, reference)]
+            error = max(errors)
+            relative = max(err / n for err, n in zip(errors, noise))
+        print(f"{factor:>6} {elapsed * 1000:>9.1f} {base_time / elapsed:>9.1f} {error:>10.2f} {relative:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
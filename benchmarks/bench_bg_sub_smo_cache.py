@@ -0,0 +1,59 @@
+"""
+Benchmark of the background subtraction with and without the cache of SMO instances.
+
+Each image of a plate has the same shape and parameters, so only the first image should pay for building the SMO
+(estimating its null distribution from a random image). The uncached timing builds a new SMO for every image, as
+`apply_bg_sub` used to do.
+
+Usage:
+    python benchmarks/bench_bg_sub_smo_cache.py --size 2048 --images 20
+"""
+import argparse
+import time
+
+import numpy as np
+from smo import SMO
+
+from cp_server.tasks_server.tasks.bg_sub.bg_sub import apply_bg_sub, get_smo
+
+
+def uncached_bg_sub(img: np.ndarray, sigma: float, size: int) -> np.ndarray:
+    """
+    The background subtraction without the cache: a new SMO per image.
+    """
+    bg_img = SMO(shape=img.shape, sigma=sigma, size=size).bg_corrected(img)
+    bg_img[bg_img<0] = 0
+    return bg_img.astype(img.dtype)
+
+def time_per_image(func, imgs: list[np.ndarray], sigma: float, size: int) -> float:
+    """
+    Mean time per image of the background subtraction over all the images.
+    """
+    start = time.perf_counter()
+    for img in imgs:
+        func(img, sigma, size)
+    return (time.perf_counter() - start) / len(imgs)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="Width and height of the synthetic images")
+    parser.add_argument("--images", type=int, default=20, help="Number of images of the same shape")
+    parser.add_argument("--sigma", type=float, default=0.0)
+    parser.add_argument("--smo-size", type=int, default=7, help="Averaging window size of the SMO")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 65536, (args.size, args.size), dtype=np.uint16) for _ in range(args.images)]
+
+    uncached = time_per_image(uncached_bg_sub, imgs, args.sigma, args.smo_size)
+    get_smo.cache_clear()
+    cached = time_per_image(apply_bg_sub, imgs, args.sigma, args.smo_size)
+
+    print(f"{'':>9} {'ms/image':>9}")
+    print(f"{'uncached':>9} {uncached * 1000:>9.1f}")
+    print(f"{'cached':>9} {cached * 1000:>9.1f}")
+    print(f"saving: {(uncached - cached) * 1000:.1f} ms/image ({(1 - cached / uncached) * 100:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Write time, read time and file size of the TIFF compression codecs, on masks and images.
+
+Files are written with `save_mask` (masks) or `save_img` (images), as the workers do, so the numbers include the
+dtype conversion and, for images, the atomic rename. Codecs needing the imagecodecs package are skipped when it is
+not installed.
+
+Without paths, synthetic data is used: Voronoi masks of touching cells and noisy images with bright blobs.
+
+Usage:
+    python benchmarks/bench_compression.py --masks /data/A1_well/A1_masks/*_mask_1.tif --images /data/A1_well/*_refseg_1.tif
+    python benchmarks/bench_compression.py --size 2048 --codecs none zlib:1 zlib:6 zstd:1 zstd:3 lzw packbits
+"""
+import argparse
+import importlib.util
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from tifffile import imread
+
+from cp_server.tasks_server.tasks.saving.save_arrays import IMAGECODECS_CODECS, save_img, save_mask
+
+
+def synthetic_mask(size: int, n_cells: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Touching cells (Voronoi tessellation of random seeds), with the background between cells kept at 0.
+    """
+    markers = np.zeros((size, size), dtype=np.uint16)
+    seeds = rng.integers(0, size, (n_cells, 2))
+    markers[seeds[:, 0], seeds[:, 1]] = np.arange(1, n_cells + 1)
+    distances, (rows, cols) = distance_transform_edt(markers == 0, return_indices=True)
+    mask = markers[rows, cols]
+    mask[distances > size / np.sqrt(n_cells) / 2] = 0
+    return mask
+
+def synthetic_image(size: int, mask: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """
+    A background-subtracted like image: low noise around 0, brighter cells.
+    """
+    img = rng.normal(20, 10, (size, size)) + 2000 * (mask > 0)
+    return img.clip(0, 65535).astype(np.uint16)
+
+def bench_codec(arrays: list[np.ndarray], save, codec: str, tmp_dir: Path, repeats: int) -> tuple[float, float, int]:
+    """
+    Best mean write and read time per file over the repeats, and the total size of the files.
+    """
+    paths = [str(tmp_dir / f"bench_{i}.tif") for i in range(len(arrays))]
+    write, read = float("inf"), float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for array, path in zip(arrays, paths):
+            save(array, path, compression=codec)
+        write = min(write, (time.perf_counter() - start) / len(arrays))
+        start = time.perf_counter()
+        for path in paths:
+            imread(path)
+        read = min(read, (time.perf_counter() - start) / len(arrays))
+    size = sum(os.path.getsize(path) for path in paths)
+    return write, read, size
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--masks", nargs="*", default=[], help="Mask TIFFs to benchmark")
+    parser.add_argument("--images", nargs="*", default=[], help="Image TIFFs to benchmark")
+    parser.add_argument("--size", type=int, default=2048, help="Width and height of the synthetic data")
+    parser.add_argument("--cells", type=int, default=2000, help="Number of cells of the synthetic masks")
+    parser.add_argument("--files", type=int, default=4, help="Number of synthetic files of each kind")
+    parser.add_argument("--codecs", nargs="+", default=["none", "zlib:1", "zlib", "zstd:1", "zstd:3", "lzw", "packbits"])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.masks or args.images:
+        masks = [imread(path) for path in args.masks]
+        imgs = [imread(path) for path in args.images]
+    else:
+        rng = np.random.default_rng(0)
+        masks = [synthetic_mask(args.size, args.cells, rng) for _ in range(args.files)]
+        imgs = [synthetic_image(args.size, mask, rng) for mask in masks]
+
+    has_imagecodecs = importlib.util.find_spec("imagecodecs") is not None
+    print(f"{'data':>6} {'codec':>9} {'write ms':>9} {'read ms':>8} {'MB':>8} {'ratio':>6}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for kind, arrays, save in (("masks", masks, save_mask), ("images", imgs, save_img)):
+            if not arrays:
+                continue
+            raw_size = sum(array.nbytes for array in arrays)
+            for codec in args.codecs:
+                if codec.partition(":")[0] in IMAGECODECS_CODECS and not has_imagecodecs:
+                    print(f"{kind:>6} {codec:>9} {'skipped, needs imagecodecs':>34}")
+                    continue
+                write, read, size = bench_codec(arrays, save, codec, Path(tmp_dir), args.repeats)
+                print(f"{kind:>6} {codec:>9} {write * 1000:>9.1f} {read * 1000:>8.1f} {size / 1e6:>8.2f} {raw_size / size:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
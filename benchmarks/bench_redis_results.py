@@ -0,0 +1,94 @@
+"""
+Redis memory and operations spent on the task results of a plate-sized run, with every result stored (as before) and
+with the results stored only by the tasks declaring ignore_result=False (the current configuration), which no task of
+a plate run does.
+
+The tasks of the run are not executed: for every task a plate run goes through, the result is stored through the
+Celery result backend as the worker does after the task (SETEX and PUBLISH), and the producer subscribes to the
+result of every task it sends, unless sent with ignore_result=True. The used memory and the number of commands
+processed by Redis are read from INFO. The database given is flushed before each mode, so use a spare one.
+
+Usage:
+    python benchmarks/bench_redis_results.py redis://localhost:6379/15 --wells 384 --fovs 9 --chunk-size 4
+"""
+import argparse
+import math
+import uuid
+
+import redis
+
+from cp_server.tasks_server.celery_app import RESULT_EXPIRES, create_celery_app
+
+PREFIX = "cp_server.tasks_server.tasks."
+# Tasks of a plate run, with a result of the usual size
+TASKS_PER_WELL_ROUND = [(PREFIX + "celery_main_task.process_images", "Batch of 9 images sent to be segmented in 3 chains")]
+TASKS_PER_CHUNK = [
+    (PREFIX + "bg_sub.remove_bg", ["/data/A1_well/A1P1_refseg_1.tif"] * 4),
+    (PREFIX + "segementation.seg_task.segment", ["masks:run-A1:A1P1"] * 4),
+    (PREFIX + "counter.counter_task_manager.check_and_track", None),
+    (PREFIX + "counter.counter_task_manager.mark_chunk_done", None),
+]
+TASKS_PER_FOV = [
+    (PREFIX + "track.track_cells", None),
+    (PREFIX + "counter.counter_task_manager.mark_one_done", None),
+]
+TASKS_PER_WELL = [(PREFIX + "counter.counter_task_manager.all_tracks_finished", "Run A1 completed successfully. All tracks finished.")]
+
+
+def plate_tasks(wells: int, fovs: int, chunk_size: int) -> list[tuple[str, object]]:
+    """
+    Every task of a two-round run of the plate.
+    """
+    chunks = math.ceil(fovs / chunk_size)
+    per_well = 2 * (TASKS_PER_WELL_ROUND + chunks * TASKS_PER_CHUNK) + fovs * TASKS_PER_FOV + TASKS_PER_WELL
+    return wells * per_well
+
+def redis_usage(client: redis.Redis) -> tuple[int, int]:
+    """
+    Used memory in bytes and total number of commands processed by Redis.
+    """
+    return int(client.info("memory")["used_memory"]), int(client.info("stats")["total_commands_processed"])
+
+def run(url: str, tasks: list[tuple[str, object]], store_all: bool) -> tuple[int, int, int]:
+    """
+    Store the results of the tasks as the workers do, and return the number of stored results, and the memory and
+    commands used. None of the tasks of a plate run opts in, so with `store_all` False nothing is stored.
+    """
+    app = create_celery_app()
+    app.conf.update(result_backend=url, result_expires=24 * 3600)
+    client = redis.Redis.from_url(url)
+    client.flushdb()
+    memory, commands = redis_usage(client)
+
+    stored = 0
+    if store_all:
+        with app.producer_or_acquire() as producer:
+            for _, result in tasks:
+                task_id = str(uuid.uuid4())
+                # Sending a task whose result isn't ignored subscribes the producer to the result
+                app.backend.on_task_call(producer, task_id)
+                app.backend.store_result(task_id, result, "SUCCESS")
+                stored += 1
+        app.backend.result_consumer.stop()
+
+    new_memory, new_commands = redis_usage(client)
+    return stored, new_memory - memory, new_commands - commands - 2  # The INFO calls themselves
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", help="Redis database to use, flushed by the benchmark")
+    parser.add_argument("--wells", type=int, default=384)
+    parser.add_argument("--fovs", type=int, default=9, help="Number of FOVs per well")
+    parser.add_argument("--chunk-size", type=int, default=4, help="Number of images per chain")
+    args = parser.parse_args()
+
+    tasks = plate_tasks(args.wells, args.fovs, args.chunk_size)
+    print(f"{len(tasks)} tasks for {args.wells} wells of {args.fovs} FOVs, 2 rounds")
+    print(f"{'results':>12} {'stored':>8} {'memory MB':>10} {'commands':>9} {'kept for':>9}")
+    for label, store_all, expires in (("all stored", True, 24 * 3600), ("opt-in", False, RESULT_EXPIRES)):
+        stored, memory, commands = run(args.url, tasks, store_all)
+        print(f"{label:>12} {stored:>8} {memory / 1e6:>10.2f} {commands:>9} {expires / 3600:>8.1f}h")
+
+
+if __name__ == "__main__":
+    main()
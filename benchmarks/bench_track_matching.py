@@ -0,0 +1,64 @@
+"""
+Benchmark of the tracking matching engines ("greedy" vs "assignment") on crowded synthetic fields of view.
+
+The masks are Voronoi tessellations of random seeds, so every cell touches its neighbours, and the second frame
+moves each seed by a few pixels. Only the matching step is timed (the overlap tables are computed once), since it
+is the only part that differs between the two engines.
+
+Usage:
+    python benchmarks/bench_track_matching.py --size 2048 --cells 500 2000 8000
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from cp_server.tasks_server.tasks.track.track import frame_overlaps, track_luts
+
+
+def voronoi_masks(size: int, n_cells: int, jitter: float, seed: int=0) -> np.ndarray:
+    """
+    Two frames of touching cells, the seeds of the second frame being moved by a random jitter.
+    """
+    rng = np.random.default_rng(seed)
+    seeds = rng.uniform(0, size, (n_cells, 2))
+    frames = []
+    for frame_seeds in (seeds, seeds + rng.normal(0, jitter, seeds.shape)):
+        markers = np.zeros((size, size), dtype=np.uint16)
+        coords = np.clip(frame_seeds.astype(int), 0, size - 1)
+        markers[coords[:, 0], coords[:, 1]] = np.arange(1, n_cells + 1)
+        _, (rows, cols) = distance_transform_edt(markers == 0, return_indices=True)
+        frames.append(markers[rows, cols])
+    return np.stack(frames)
+
+def time_matching(overlaps: list[np.ndarray], threshold: float, matching: str, repeats: int) -> tuple[float, int]:
+    """
+    Best time over the repeats of the matching step, and the number of complete tracks found.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        luts = track_luts(overlaps, threshold, matching)
+        best = min(best, time.perf_counter() - start)
+    return best, int(luts[0].max())
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="Width and height of the synthetic images")
+    parser.add_argument("--cells", type=int, nargs="+", default=[500, 2000, 8000], help="Number of cells per image")
+    parser.add_argument("--jitter", type=float, default=4.0, help="Standard deviation of the seed displacement (pixels)")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Stitch threshold on IOU")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'cells':>7} {'engine':>11} {'time (ms)':>10} {'tracks':>7}")
+    for n_cells in args.cells:
+        overlaps = frame_overlaps(voronoi_masks(args.size, n_cells, args.jitter))
+        for matching in ("greedy", "assignment"):
+            elapsed, tracks = time_matching(overlaps, args.threshold, matching, args.repeats)
+            print(f"{n_cells:>7} {matching:>11} {elapsed * 1000:>10.1f} {tracks:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import math
+import os
+
+from fastapi import HTTPException
+from redis import RedisError
+
+from cp_server.fastapi_app import get_logger
+from cp_server.fastapi_app.endpoints import redis_client
+from cp_server.tasks_server.utils.throughput import queue_throughput
+
+
+# Maximum number of waiting tasks per queue before new work is refused, as "queue=limit,...", 0 for no limit
+ADMISSION_QUEUE_LIMITS = os.getenv("ADMISSION_QUEUE_LIMITS", "celery=5000,gpu_tasks=1000")
+# Fraction of the Redis maxmemory above which new work is refused (ignored if Redis has no maxmemory)
+ADMISSION_MAX_MEMORY = float(os.getenv("ADMISSION_MAX_MEMORY", 0.8))
+# Retry-After when it can't be estimated from the throughput, and upper bound of the estimate, in seconds
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 30))
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", 600))
+
+logger = get_logger(__name__)
+
+
+def parse_queue_limits(limits: str) -> dict[str, int]:
+    """
+    Parse the queue limits setting, "queue=limit" pairs separated by commas.
+    """
+    parsed = {}
+    for item in filter(None, (item.strip() for item in limits.split(","))):
+        queue, sep, limit = item.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid queue limit {item!r}, expected 'queue=limit'")
+        parsed[queue.strip()] = int(limit)
+    return parsed
+
+QUEUE_LIMITS = parse_queue_limits(ADMISSION_QUEUE_LIMITS)
+
+def _retry_after(excess: int, throughput: float) -> int:
+    """
+    Seconds until the queue is expected to be back under its limit at the observed throughput.
+    """
+    if throughput <= 0:
+        return ADMISSION_RETRY_AFTER
+    return max(1, min(ADMISSION_MAX_RETRY_AFTER, math.ceil(excess / throughput)))
+
+def check_admission() -> None:
+    """
+    Refuse new work while the system is saturated: a queue holds more waiting tasks than its limit (QUEUE_LIMITS), or
+    Redis uses more than ADMISSION_MAX_MEMORY of its maxmemory. Raises a 429 error with a Retry-After header, estimated
+    from the throughput of the saturated queue. If Redis can't be queried, the work is admitted.
+    """
+    queues = [queue for queue, limit in QUEUE_LIMITS.items() if limit > 0]
+    try:
+        pipe = redis_client.pipeline()
+        for queue in queues:
+            pipe.llen(queue)
+        pipe.info("memory")
+        *depths, memory = pipe.execute()
+
+        for queue, depth in zip(queues, depths):
+            excess = depth - QUEUE_LIMITS[queue]
+            if excess >= 0:
+                retry_after = _retry_after(excess + 1, queue_throughput(redis_client, queue))
+                logger.warning(f"Refusing work: {depth} tasks waiting in {queue}, retry in {retry_after}s")
+                raise HTTPException(status_code=429,
+                                    detail=f"Queue {queue} is full ({depth} tasks waiting), retry later",
+                                    headers={"Retry-After": str(retry_after)})
+
+        used, maxmemory = int(memory["used_memory"]), int(memory.get("maxmemory", 0))
+        if maxmemory and used > ADMISSION_MAX_MEMORY * maxmemory:
+            logger.warning(f"Refusing work: Redis uses {used / maxmemory:.0%} of its memory")
+            raise HTTPException(status_code=429,
+                                detail=f"Redis memory is almost full ({used / maxmemory:.0%}), retry later",
+                                headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not check the queues, admitting the work: {e}")
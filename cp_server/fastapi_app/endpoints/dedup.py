@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+from redis import RedisError
+
+from cp_server.fastapi_app import get_logger
+from cp_server.fastapi_app.endpoints import redis_client
+from cp_server.tasks_server.utils.claims import INFLIGHT_IMAGES_KEY
+
+
+# How long a submitted image is remembered, so that resubmissions of it attach to the first submission, in seconds
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", 1800))
+
+logger = get_logger(__name__)
+
+
+def settings_hash(params: dict[str, Any]) -> str:
+    """
+    Hash of the processing parameters of a submission, its images excluded.
+    """
+    settings = {key: value for key, value in params.items() if key != "img_path"}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def dedup_key(img_path: str, settings: str) -> str:
+    """
+    Key of an image submitted with the given settings. The modification time of the image is part of it, so a new
+    acquisition written to the same path is processed again.
+    """
+    path = Path(img_path).resolve()
+    identity = f"{path}:{path.stat().st_mtime_ns}:{settings}"
+    return f"inflight:{hashlib.sha1(identity.encode()).hexdigest()}"
+
+def claim_images(img_paths: list[str], params: dict[str, Any], task_id: str) -> dict[str, str]:
+    """
+    Claim the images for the task about to be sent, unless the same images (same path and modification time) were
+    already submitted with the same parameters in the last DEDUP_TTL seconds. An image listed twice is claimed once,
+    and is not a duplicate of itself. The claims are indexed
+    in the INFLIGHT_IMAGES_KEY hash, from which the workers release them when the images are done or failed for good
+    (see `release_claims`).
+    Returns the images already claimed by another task, with its ID. If Redis can't be queried, all the images are
+    claimed.
+    """
+    settings = settings_hash(params)
+    try:
+        keys = {img_path: dedup_key(img_path, settings) for img_path in img_paths}
+        pipe = redis_client.pipeline()
+        for key in keys.values():
+            pipe.set(key, task_id, nx=True, ex=DEDUP_TTL)
+        claimed = pipe.execute()
+
+        new_claims = {img_path: key for (img_path, key), is_new in zip(keys.items(), claimed) if is_new}
+        if new_claims:
+            pipe = redis_client.pipeline()
+            pipe.hset(INFLIGHT_IMAGES_KEY, mapping=new_claims)
+            pipe.expire(INFLIGHT_IMAGES_KEY, DEDUP_TTL)
+            pipe.execute()
+        duplicates = [(img_path, key) for img_path, key in keys.items() if img_path not in new_claims]
+        if not duplicates:
+            return {}
+        owners = redis_client.mget([key for _, key in duplicates])
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not check for duplicate submissions, processing all the images: {e}")
+        return {}
+    owners = [owner.decode() if isinstance(owner, bytes) else owner for owner in owners]
+    # An image whose claim was released (or expired) in between is no longer processed, so it is not a duplicate
+    return {img_path: owner for (img_path, _), owner in zip(duplicates, owners) if owner is not None}
@@ -2,6 +2,7 @@ from collections import defaultdict
 from typing import Any, cast
 from pathlib import Path
 import json
+import uuid
 
 from fastapi import APIRouter, Request, HTTPException
 from celery import Celery
@@ -9,7 +10,14 @@ from celery import Celery
 from cp_server.fastapi_app.endpoints.request_models import NDArrayPayload, NDArrayResult, ProcessRequest, BackgroundRequest, RegisterMaskRequest
 from cp_server.fastapi_app import get_logger
 from cp_server.fastapi_app.endpoints import redis_client
+from cp_server.fastapi_app.endpoints.admission import check_admission
+from cp_server.fastapi_app.endpoints.dedup import claim_images
+from cp_server.tasks_server.celery_app import EXECUTOR
 from cp_server.tasks_server.utils.serialization_utils import custom_decoder, custom_encoder
+from cp_server.tasks_server.utils.claims import INFLIGHT_IMAGES_KEY, release_claims
+from cp_server.tasks_server.utils.failures import FAILED_IMAGES_KEY
+from cp_server.tasks_server.utils.progress import (STAGES, TRACKED, missing_stages, run_batches, run_progress,
+                                                   untracked_fovs)
 
 
 # Setup logging
@@ -18,6 +26,10 @@ logger = get_logger(__name__)
 # Create a router for the segment task
 router = APIRouter()
 
+# Options of the blocking waits on task results. The embedded worker (EXECUTOR="local") runs in this process, which
+# Celery would otherwise take for a task waiting on a subtask, and its in-memory result backend is cheap to poll often
+RESULT_GET_OPTIONS: dict[str, Any] = dict(interval=0.05, disable_sync_subtasks=False) if EXECUTOR == "local" else {}
+
 
 @router.post("/process")
 def process_images_endpoint(request: Request, payload: ProcessRequest) -> dict[str, Any]:
@@ -27,14 +39,25 @@ def process_images_endpoint(request: Request, payload: ProcessRequest) -> dict[s
     - `img_path`: A string path or a list of string paths to image files.
     - `sigma`: Sigma value for background subtraction (default is 0.0).
     - `size`: Size parameter for background subtraction (default is 7).
+    - `bin_factor`: Binning factor of the image on which the background is estimated, faster on large images (default is 1, no binning).
     - `cellpose_settings`: Model and segmentation settings for Cellpose.
     - `dst_folder`: Destination folder where processed images will be saved.
     - `well_id`: Unique identifier for the processing well.
     - `total_fovs`: Total number of fields of view, used to set the number of pending tracks in Redis. Not included in the model dump.
     - `track_stitch_threshold`: Threshold for stitching masks during tracking. Optional, default is 0.75.
+    - `track_overlap_mode`: How the overlaps between masks are computed during tracking, "dense" or "bbox". Optional, default is "dense".
+    - `track_matching`: How masks are matched between frames during tracking, "greedy" or "assignment". Optional, default is "greedy".
+    - `fuse_bg_sub`: Remove the background on the GPU worker and segment the corrected images from memory. Optional, default is False.
+    - `save_bg_img`: With `fuse_bg_sub`, still write the background-subtracted images to disk, asynchronously. Optional, default is True.
+    - `chunk_size`: Number of images processed by each chain of a batch, the chains running concurrently. Optional, default is chosen by the workers from the image size and the recent segmentation latency.
+    - `deduplicate`: Skip the images already submitted with the same parameters and not modified since. Optional, default is True. Not included in the model dump.
     - `round`: The round number for processing, build from the image path if not provided. Defaults to None. Not included in the model dump.
     This endpoint will send tasks to a Celery worker to process the images (single or batch).
-    It returns a dictionary with the task ID and the count of images sent.
+    While the queues or Redis are saturated, the request is refused with a 429 error and a Retry-After header.
+    It returns a dictionary with the task ID and the count of images sent. For a batch, the task ID is also the batch ID
+    of `/process/batch/{batch_id}/status`. Images submitted again (e.g. a retried request) attach to the task already
+    processing them: they are listed under `duplicates` with the ID of that task, and not sent again. Once processed
+    (or failed for good), images are no longer duplicates.
 
     :param request: The FastAPI request object.
     :param payload: The payload containing the image processing parameters.
@@ -42,23 +65,49 @@ def process_images_endpoint(request: Request, payload: ProcessRequest) -> dict[s
     :return: A dictionary with task ID and count of images sent.
     """
     celery_app: Celery = request.app.state.celery_app
+    check_admission()
 
     # Initialize the counter for pending tracks
     if payload.round == 2:
         redis_client.setnx(f"pending_tracks:{payload.well_id}", payload.total_fovs)
         redis_client.expire(f"pending_tracks:{payload.well_id}", 24 * 3600)
 
-    img_count = len(payload.img_path) if isinstance(payload.img_path, list) else 1
-    logger.info(f"Sending {img_count} image(s) for processing with well_id {payload.well_id}")
-
     # Process the paths
     params = payload.model_dump()
-    task = celery_app.send_task(
-        "cp_server.tasks_server.tasks.celery_main_task.process_images",
-        kwargs=params)
+    task_id = str(uuid.uuid4())
+    img_paths = payload.img_path if isinstance(payload.img_path, list) else [payload.img_path]
+    duplicates = {}
+    if payload.deduplicate:
+        # An image listed twice is processed once
+        img_paths = list(dict.fromkeys(img_paths))
+        duplicates = claim_images(img_paths, params, task_id)
+        if duplicates:
+            logger.info(f"Skipping {len(duplicates)} image(s) already submitted for well_id {payload.well_id}")
+            img_paths = [p for p in img_paths if p not in duplicates]
+            if not img_paths:
+                # Everything is already being processed, attach to the task processing the (first) image
+                return {"well_id": payload.well_id, "task_id": next(iter(duplicates.values())), "images_sent": 0,
+                        "duplicates": duplicates}
+        if isinstance(payload.img_path, list):
+            params["img_path"] = img_paths
+
+    img_count = len(img_paths)
+    logger.info(f"Sending {img_count} image(s) for processing with well_id {payload.well_id}")
+    try:
+        task = celery_app.send_task(
+            "cp_server.tasks_server.tasks.celery_main_task.process_images",
+            kwargs=params,
+            task_id=task_id,
+            ignore_result=True)
+    except Exception as e:
+        logger.error(f"Failed to send the images of well_id {payload.well_id}: {e}")
+        # Nothing processes the images claimed by this request, so a retried request must not skip them
+        if payload.deduplicate:
+            release_claims(img_paths)
+        raise HTTPException(status_code=500, detail=f"Failed to send the images: {e}")
 
     # Determine number of images sent
-    return {"well_id": payload.well_id, "task_id": task.id, "images_sent": img_count}
+    return {"well_id": payload.well_id, "task_id": task.id, "images_sent": img_count, "duplicates": duplicates}
 
 @router.post("/process_bg_sub")
 def process_bg_sub_endpoint(request: Request, payload: BackgroundRequest) -> dict[str, Any]:
@@ -68,6 +117,7 @@ def process_bg_sub_endpoint(request: Request, payload: BackgroundRequest) -> dic
     - `img_path`: A string path or a list of string paths to image files.
     - `sigma`: Sigma value for background subtraction (default is 0.0).
     - `size`: Size parameter for background subtraction (default is 7).
+    - `bin_factor`: Binning factor of the image on which the background is estimated, faster on large images (default is 1, no binning).
 
     This endpoint will send tasks to a Celery worker to process the images (single or batch).
     It returns a dictionary with the task ID and the count of images sent.
@@ -86,7 +136,8 @@ def process_bg_sub_endpoint(request: Request, payload: BackgroundRequest) -> dic
     params = payload.model_dump()
     task = celery_app.send_task(
         "cp_server.tasks_server.tasks.bg_sub.remove_bg",
-        kwargs=params)
+        kwargs=params,
+        ignore_result=True)
 
     return {"task_id": task.id, "images_sent": img_count}
 
@@ -119,17 +170,136 @@ async def get_process_status(well_id: str) -> dict[str, Any]:
     raise HTTPException(status_code=404,
                         detail=f"well_id '{well_id}' not found")
 
+@router.get("/process/batch/{batch_id}/status")
+async def get_batch_status(batch_id: str) -> dict[str, Any]:
+    """
+    Check the remaining chains of a batch sent to `/process`, its batch ID being the returned task ID, and how many
+    of its chains failed (their images are not all processed, see `/process/failed_images`).
+    Returns 404 if the batch is not found in Redis (not split yet, or expired).
+    """
+    done, rem_val, failed_val = redis_client.mget(
+        [f"batch_done:{batch_id}", f"pending_chunks:{batch_id}", f"failed_chunks:{batch_id}"])
+    failed = int(cast(bytes, failed_val)) if failed_val is not None else 0
+    if done is not None:
+        return {"batch_id": batch_id, "status": "finished", "remaining": 0, "failed": failed}
+
+    if rem_val is not None:
+        rem_val = cast(bytes | str, rem_val)
+        decoded_val = rem_val.decode('utf-8') if isinstance(rem_val, bytes) else rem_val
+        return {"batch_id": batch_id, "status": "processing", "remaining": int(decoded_val), "failed": failed}
+
+    raise HTTPException(status_code=404,
+                        detail=f"batch_id '{batch_id}' not found")
+
+@router.get("/process/{well_id}/progress")
+async def get_run_progress(well_id: str) -> dict[str, Any]:
+    """
+    Report the stage reached by each image of a run sent to `/process` (submitted, bg_subtracted, segmented or
+    tracked), from its progress ledger, with the number of images at each stage.
+    Returns 404 if no progress was recorded for the run (none sent, or expired).
+    """
+    stages, _, _ = run_progress(well_id)
+    if not stages:
+        raise HTTPException(status_code=404,
+                            detail=f"No progress recorded for well_id '{well_id}'")
+    counts = {stage: 0 for stage in STAGES}
+    for stage in stages.values():
+        counts[stage] = counts.get(stage, 0) + 1
+    return {"well_id": well_id, "counts": counts, "images": stages}
+
+@router.post("/process/{well_id}/resume")
+def resume_run_endpoint(request: Request, well_id: str) -> dict[str, Any]:
+    """
+    Resume a run interrupted by a crash, from its progress ledger, with the parameters it was sent with:
+    - the images not segmented yet are sent again to be processed. The background of the images already corrected is
+      not removed again, as they are marked.
+    - the fields of view whose images were all segmented, but not tracked, are registered and tracked again.
+    Images already segmented or tracked are left as they are. The count of pending tracks of the run is set again to
+    the number of its fields of view not tracked yet, so `all_tracks_finished` still fires once they are.
+    While the queues or Redis are saturated, the request is refused with a 429 error and a Retry-After header.
+    Returns 404 if no progress was recorded for the run (none sent, or expired), and 409 while its tasks are still
+    running (chains of its batches counted down, or images not tracked yet still claimed), as resuming it then would
+    process its remaining images twice.
+
+    :return: A dictionary with the task ID of the images sent again (None if none), their count and the number of
+        fields of view sent to be tracked.
+    """
+    celery_app: Celery = request.app.state.celery_app
+    check_admission()
+
+    stages, masks, params = run_progress(well_id)
+    if not stages or params is None:
+        raise HTTPException(status_code=404,
+                            detail=f"No progress recorded for well_id '{well_id}'")
+    if _run_in_flight(well_id, [p for p, stage in stages.items() if stage != TRACKED]):
+        raise HTTPException(status_code=409,
+                            detail=f"The run of well_id '{well_id}' is still being processed")
+    img_paths, fovs = missing_stages(stages, masks)
+    logger.info(f"Resuming {well_id}: {len(img_paths)} image(s) to process, {len(fovs)} FOV(s) to track")
+
+    to_track = untracked_fovs(stages)
+    if to_track:
+        redis_client.set(f"pending_tracks:{well_id}", len(to_track), ex=24 * 3600)
+
+    task_id = None
+    if img_paths:
+        task = celery_app.send_task(
+            "cp_server.tasks_server.tasks.celery_main_task.process_images",
+            kwargs={**params, "img_path": img_paths, "well_id": well_id},
+            ignore_result=True)
+        task_id = task.id
+
+    for fov_id, fov_masks in fovs.items():
+        hkey = f"masks:{well_id}:{fov_id}"
+        redis_client.hset(hkey, mapping=fov_masks)
+        celery_app.send_task(
+            'cp_server.tasks_server.tasks.counter.counter_task_manager.check_and_track',
+            kwargs={
+                'hkey': hkey,
+                'track_stitch_threshold': params["track_stitch_threshold"],
+                'track_overlap_mode': params["track_overlap_mode"],
+                'track_matching': params["track_matching"]
+            },
+            ignore_result=True)
+
+    return {"well_id": well_id, "task_id": task_id, "images_sent": len(img_paths), "fovs_tracked": len(fovs)}
+
+def _run_in_flight(well_id: str, img_paths: list[str]) -> bool:
+    """
+    Whether chains of the batches of the run are still counted down, or the images are still claimed by a task (see
+    `dedup.claim_images`).
+    """
+    pending_keys = [f"pending_chunks:{batch_id}" for batch_id in run_batches(well_id)]
+    if pending_keys and redis_client.exists(*pending_keys):
+        return True
+    if not img_paths:
+        return False
+    claim_keys = [key for key in redis_client.hmget(INFLIGHT_IMAGES_KEY, img_paths) if key is not None]
+    return bool(claim_keys) and bool(redis_client.exists(*claim_keys))
+
+@router.get("/process/failed_images")
+async def get_failed_images() -> dict[str, Any]:
+    """
+    List the images left out of their batch after failing every retry, with the stage and the error, so they can be
+    checked and resubmitted. An image is removed from the list once processed successfully.
+    """
+    raw = cast(dict[bytes, bytes], redis_client.hgetall(FAILED_IMAGES_KEY))
+    failed = {img_path.decode(): json.loads(record) for img_path, record in raw.items()}
+    return {"failed": failed, "count": len(failed)}
+
 @router.post("/register_mask")
 def register_mask_endpoint(request: Request, payload: RegisterMaskRequest) -> list[str]:
     """
     Register multiple masks in batch and trigger tracking for R2 masks.
+    While the queues or Redis are saturated, the request is refused with a 429 error and a Retry-After header.
     
     :param request: The FastAPI request object.
-    :param payload: RegisterMaskRequest containing well_id, mask_paths (list), total_fovs, and track_stitch_threshold
+    :param payload: RegisterMaskRequest containing well_id, mask_paths (list), total_fovs, track_stitch_threshold, track_overlap_mode and track_matching
 
     :return: List of tracking task IDs.
     """
     celery_app: Celery = request.app.state.celery_app
+    check_admission()
     
     tracking_task_ids = []
     
@@ -176,8 +346,11 @@ def register_mask_endpoint(request: Request, payload: RegisterMaskRequest) -> li
                         'cp_server.tasks_server.tasks.counter.counter_task_manager.check_and_track',
                         kwargs={
                             'hkey': hkey,
-                            'track_stitch_threshold': payload.track_stitch_threshold
-                        }
+                            'track_stitch_threshold': payload.track_stitch_threshold,
+                            'track_overlap_mode': payload.track_overlap_mode,
+                            'track_matching': payload.track_matching
+                        },
+                        ignore_result=True
                     )
                     tracking_task_ids.append(task.id)
                     logger.debug(f"Triggered tracking task {task.id} for {fov_id} (well {payload.run_id})")
@@ -222,7 +395,8 @@ def segment_ndarray_endpoint(request: Request, payload: NDArrayPayload) -> NDArr
     - `array`: A serialized NumPy ndarray (base64-encoded string).
     - `cellpose_settings`: Model and segmentation settings for Cellpose.
     
-    This endpoint will send a task to a Celery worker to segment the image.
+    This endpoint will send a task to a Celery worker to segment the image, in the interactive lane of the GPU worker,
+    which is served before the bulk segmentation of `/process`.
     It returns the segmented mask as a serialized NumPy ndarray.
     """
     celery_app: Celery = request.app.state.celery_app
@@ -237,11 +411,12 @@ def segment_ndarray_endpoint(request: Request, payload: NDArrayPayload) -> NDArr
     # Send task to Celery worker and wait for result
     try: 
         result = celery_app.send_task(
-        "cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings",queue="gpu_tasks",
+        "cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings",
         kwargs={
             "img": ndarray,
             "cellpose_settings": payload.cellpose_settings
-        }).get(timeout=180)  # Blocking call to get result with timeout of 3 minutes
+        # Blocking call to get result with timeout of 3 minutes
+        }).get(timeout=180, **RESULT_GET_OPTIONS)
     except Exception as e:
         logger.error(f"Failed to process segmentation task: {e}")
         raise HTTPException(status_code=500, detail=f"Segmentation task failed {e}")
@@ -264,8 +439,8 @@ def cellpose_metadata_endpoint(request: Request) -> dict[str, Any]:
     
     try:
         result = celery_app.send_task(
-            "cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata",queue="gpu_tasks"
-        ).get(timeout=60)  # Blocking call to get result with timeout of 60 seconds
+            "cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata"
+        ).get(timeout=60, **RESULT_GET_OPTIONS)  # Blocking call to get result with timeout of 60 seconds
         return result
     except Exception as e:
         logger.error(f"Failed to retrieve Cellpose metadata: {e}")
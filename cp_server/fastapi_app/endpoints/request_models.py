@@ -1,10 +1,12 @@
 from pathlib import Path
 import os
 import re
-from typing import Any, Union, List
+from typing import Any, Literal, Union, List
 
 from pydantic import BaseModel, model_validator, Field
 
+from cp_server.tasks_server.tasks.saving.mask_store import store_exists
+
 
 # Filename pattern constants
 FILENAME_PATTERN = r'^.+_.+_[12]$'
@@ -38,10 +40,12 @@ class BackgroundRequest(BaseModel):
         img_path (str | list[str]): Path(s) to the image file(s).
         sigma (float): Sigma value for background subtraction.
         size (int): Size parameter for background subtraction.
+        bin_factor (int): Binning factor of the image on which the background is estimated, faster on large images. Defaults to 1 (no binning).
     """
     img_path: Union[str, List[str]]
     sigma: float = 0.0
     size: int = 7
+    bin_factor: int = Field(default=1, ge=1)
 
     @model_validator(mode="before")
     def validate_img_path(cls, values: dict[str, Any]) -> dict[str, Any]:
@@ -92,6 +96,7 @@ class ProcessRequest(BackgroundRequest):
         img_path (str | list[str]): Path(s) to the image file(s).
         sigma (float): Sigma value for background subtraction.
         size (int): Size parameter for background subtraction.
+        bin_factor (int): Binning factor of the image on which the background is estimated.
 
     Attributes:
         cellpose_settings (dict): Model and segmentation settings for Cellpose.
@@ -99,6 +104,12 @@ class ProcessRequest(BackgroundRequest):
         well_id (str): Unique identifier for the processing well.
         total_fovs (int): Total number of fields of view. It will not be included in the model dump.
         track_stitch_threshold (float, optional): Threshold for stitching masks during tracking. Default to 0.75.
+        track_overlap_mode (str, optional): How the overlaps between masks are computed during tracking, "dense" or "bbox" (faster on large, sparse images). Default to "dense".
+        track_matching (str, optional): How masks are matched between frames during tracking, "greedy" or "assignment" (optimal one-to-one matching). Default to "greedy".
+        fuse_bg_sub (bool, optional): If True, the background is removed on the GPU worker and the corrected images are segmented without being read back from disk. Default to False.
+        save_bg_img (bool, optional): With fuse_bg_sub, whether the background-subtracted images are still written back to disk (asynchronously). Default to True.
+        chunk_size (int, optional): Number of images processed by each chain of a batch, the chains running concurrently. Defaults to None, for a size chosen by the workers from the image size and the recent segmentation latency.
+        deduplicate (bool, optional): If True, images already submitted with the same parameters (and not modified since) are not processed again. Default to True. It will not be included in the model dump.
         round (int, optional): The round number for processing, build from the image path if not provided. Defaults to None. It will not be included in the model dump.
     This model uses Pydantic's model validators to ensure that the input files are valid
     and that the necessary parameters are provided.
@@ -108,6 +119,12 @@ class ProcessRequest(BackgroundRequest):
     well_id: str
     total_fovs: int = Field(exclude=True)
     track_stitch_threshold: float = 0.75
+    track_overlap_mode: Literal["dense", "bbox"] = "dense"
+    track_matching: Literal["greedy", "assignment"] = "greedy"
+    fuse_bg_sub: bool = False
+    save_bg_img: bool = True
+    chunk_size: int | None = Field(default=None, ge=1)
+    deduplicate: bool = Field(default=True, exclude=True)
     round: int | None = Field(default=None, exclude=True)
 
     @model_validator(mode="after")
@@ -153,14 +170,18 @@ class RegisterMaskRequest(BaseModel):
     
     Attributes:
         run_id (str): Unique identifier for the processing run.
-        mask_paths (list[str]): List of paths to mask files. File names should end with '_1.tif' or '_2.tif'.
+        mask_paths (list[str]): List of paths to mask files, or to masks in a per-well container ('<dst_folder>.zip/<mask file name>'). File names should end with '_1.tif' or '_2.tif'.
         total_fovs (int): Total number of fields of view. It will not be included in the model dump.
         track_stitch_threshold (float, optional): Threshold for stitching masks during tracking. Default to 0.75.
+        track_overlap_mode (str, optional): How the overlaps between masks are computed during tracking, "dense" or "bbox" (faster on large, sparse images). Default to "dense".
+        track_matching (str, optional): How masks are matched between frames during tracking, "greedy" or "assignment" (optimal one-to-one matching). Default to "greedy".
     """
     run_id: str
     mask_paths: list[str]
     total_fovs: int = Field(exclude=True)
     track_stitch_threshold: float = 0.75
+    track_overlap_mode: Literal["dense", "bbox"] = "dense"
+    track_matching: Literal["greedy", "assignment"] = "greedy"
     
     @model_validator(mode="before")
     def validate_mask_paths(cls, values: dict[str, Any]) -> dict[str, Any]:
@@ -187,7 +208,7 @@ class RegisterMaskRequest(BaseModel):
             # Decode the mask file path to a string if it is bytes or os.PathLike
             fs_path = os.fsdecode(mask_file)
             mask_path_obj = Path(fs_path)
-            if not mask_path_obj.is_file():
+            if not store_exists(mask_path_obj):
                 raise ValueError(f"Provided mask_path is not a valid file path: {fs_path}")
             validated_paths.append(str(mask_path_obj))
 
@@ -23,9 +23,16 @@ app.include_router(process_router)
 logger.info("Creating a minimal Celery app to send tasks to the worker...")
 logger.debug("just to test log levels")
 # Lazy import to trigger the creation of the Celery app after the fastapi app is created
-from cp_server.tasks_server.celery_app import create_celery_app
-min_celery_app = create_celery_app()
-app.state.celery_app = min_celery_app
+from cp_server.tasks_server.celery_app import EXECUTOR, create_celery_app
+if EXECUTOR == "local":
+    # Single node: the tasks run in this process, on the app they are registered to
+    logger.info("Starting the embedded worker, without Redis nor Celery workers...")
+    from cp_server.tasks_server.celery_app import celery_app, start_local_worker
+    app.state.local_worker = start_local_worker(celery_app)
+    app.state.celery_app = celery_app
+else:
+    min_celery_app = create_celery_app()
+    app.state.celery_app = min_celery_app
 
 logger.info("Cellpose server up and running!")
 
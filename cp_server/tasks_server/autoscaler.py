@@ -0,0 +1,130 @@
+import math
+import os
+from time import monotonic
+
+from celery.worker.autoscale import Autoscaler
+from redis import RedisError
+
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.utils.redis_com import redis_client
+from cp_server.tasks_server.utils.throughput import queue_throughput
+
+
+# Waiting time of the queued tasks above which the pool grows, estimated from the queue depth and its throughput, in seconds
+AUTOSCALE_TARGET_WAIT = float(os.getenv("AUTOSCALE_TARGET_WAIT", 30))
+# Load average (1 min) per core above which the pool doesn't grow
+AUTOSCALE_MAX_LOAD = float(os.getenv("AUTOSCALE_MAX_LOAD", 0.9))
+# Fraction of the host memory that must stay available: the pool doesn't grow below it, and shrinks below half of it
+AUTOSCALE_MIN_MEMORY = float(os.getenv("AUTOSCALE_MIN_MEMORY", 0.15))
+# Minimum delay between two measurements of the queues and the host, in seconds
+AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL", 5))
+
+logger = get_logger('autoscaler')
+
+
+def host_load() -> float:
+    """
+    Load average of the host over the last minute, per core.
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+def available_memory() -> float:
+    """
+    Fraction of the host memory available to new processes (MemAvailable), 1.0 if it can't be read.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = {line.split(":")[0]: int(line.split()[1]) for line in f}
+        return meminfo["MemAvailable"] / meminfo["MemTotal"]
+    except (OSError, KeyError, ValueError, IndexError):
+        return 1.0
+
+def target_concurrency(procs: int, busy: int, wait: float, load: float, memory: float,
+                       min_concurrency: int, max_concurrency: int) -> int:
+    """
+    Pool size for the current load, within `min_concurrency` and `max_concurrency`.
+    Args:
+        procs (int): Current pool size.
+        busy (int): Number of tasks reserved by the worker (running or prefetched).
+        wait (float): Estimated waiting time of the tasks still in the queues, in seconds (inf if unknown).
+        load (float): Load average per core of the host.
+        memory (float): Fraction of the host memory available.
+    Returns:
+        int: The pool grows in proportion to how much the waiting time exceeds AUTOSCALE_TARGET_WAIT, unless the host has
+        no CPU or memory headroom left. Without tasks waiting, it shrinks to the tasks reserved.
+    """
+    if memory < AUTOSCALE_MIN_MEMORY / 2:
+        target = procs - 1
+    elif wait > AUTOSCALE_TARGET_WAIT:
+        target = procs + 1 if math.isinf(wait) else math.ceil(procs * wait / AUTOSCALE_TARGET_WAIT)
+        if load >= AUTOSCALE_MAX_LOAD or memory < AUTOSCALE_MIN_MEMORY:
+            target = procs
+    elif wait > 0:
+        target = procs
+    else:
+        target = busy
+    return max(min_concurrency, min(max_concurrency, target))
+
+class LatencyAutoscaler(Autoscaler):
+    """
+    Autoscaler of the worker pool (`--autoscale=max,min`) driven by the waiting time of the queued tasks and by the
+    CPU and memory headroom of the host, rather than by the number of tasks reserved by the worker.
+    The waiting time of each queue consumed is its depth over its throughput (counted by the `task_postrun` handler).
+    Shrinking is delayed by the keepalive of the autoscaler (AUTOSCALE_KEEPALIVE) after scaling up.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._target: int | None = None
+        self._measured_at = 0.0
+
+    def queues(self) -> list[str]:
+        """
+        Queues consumed by the worker.
+        """
+        if self.worker is None:
+            return ["celery"]
+        return list(self.worker.app.amqp.queues.consume_from or ["celery"])
+
+    def queue_wait(self) -> float:
+        """
+        Estimated waiting time of the tasks in the queues consumed, the longest of them. Infinite if tasks are waiting
+        in a queue whose throughput wasn't measured yet.
+        """
+        queues = self.queues()
+        pipe = redis_client.pipeline()
+        for queue in queues:
+            pipe.llen(queue)
+        wait = 0.0
+        for queue, depth in zip(queues, pipe.execute()):
+            if depth:
+                throughput = queue_throughput(redis_client, queue)
+                wait = max(wait, depth / throughput if throughput > 0 else math.inf)
+        return wait
+
+    def _maybe_scale(self, req=None) -> bool | None:
+        # The queues are measured at most every AUTOSCALE_INTERVAL, while this is called on every task received
+        if self._target is None or monotonic() - self._measured_at >= AUTOSCALE_INTERVAL:
+            self._measured_at = monotonic()
+            try:
+                wait = self.queue_wait()
+            except (OSError, RedisError) as e:
+                logger.warning(f"Could not measure the queues, keeping {self.processes} processes: {e}")
+                self._target = None
+                return None
+            self._target = target_concurrency(self.processes, self.qty, wait, host_load(), available_memory(),
+                                              self.min_concurrency, self.max_concurrency)
+            logger.debug(f"Queue wait {wait:.1f}s, {self.qty} tasks reserved: target of {self._target} processes")
+
+        procs = self.processes
+        if self._target > procs:
+            self.scale_up(self._target - procs)
+            return True
+        if self._target < procs:
+            self.scale_down(procs - self._target)
+            return True
+        return None
+
+    def scale_down(self, n: int) -> None:
+        # Unlike the default autoscaler, a pool that never scaled up may shrink (e.g. started at max concurrency)
+        if self._last_scale_up is None or monotonic() - self._last_scale_up > self.keepalive:
+            self._shrink(n)
@@ -1,8 +1,11 @@
 import os
+import threading
 
 from kombu.serialization import register
 from celery import Celery
-from celery.signals import worker_ready
+from celery.utils.nodenames import gethostname, nodename
+from celery.worker import WorkController
+from celery.signals import task_postrun, worker_init, worker_process_init, worker_ready
 
 from cp_server.tasks_server import get_logger
 from cp_server.tasks_server.utils.serialization_utils import custom_encoder, custom_decoder
@@ -10,6 +13,20 @@ from cp_server.tasks_server.utils.serialization_utils import custom_encoder, cus
 
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_BACKEND_URL = os.getenv("CELERY_BACKEND_URL", "redis://localhost")
+# Queues of the GPU worker: a lane for the requests a user waits on, and one for the bulk (plate) segmentation
+GPU_INTERACTIVE_QUEUE = "gpu_interactive"
+GPU_QUEUE = "gpu_tasks"
+# How a worker consuming several queues picks the next one: "priority" drains the queues in the order given to -Q
+# (the interactive lane first), "round_robin" takes them in turn, "sorted" in alphabetical order
+QUEUE_ORDER_STRATEGY = os.getenv("QUEUE_ORDER_STRATEGY", "priority")
+# Lifetime of the stored task results, in seconds. Only the tasks opting in (ignore_result=False) store them
+RESULT_EXPIRES = int(os.getenv("RESULT_EXPIRES", 600))
+# "celery" (Celery workers coordinated through Redis) or "local" (embedded worker, see start_local_worker)
+EXECUTOR = os.getenv("EXECUTOR", "celery")
+# Number of threads of the embedded worker, running the CPU and the GPU tasks
+LOCAL_WORKER_THREADS = int(os.getenv("LOCAL_WORKER_THREADS", 6))
+# How often the embedded worker checks its in-memory queues when idle, in seconds
+LOCAL_POLLING_INTERVAL = float(os.getenv("LOCAL_POLLING_INTERVAL", 0.005))
 
 
 # Set up logging for the Celery app
@@ -27,6 +44,12 @@ def create_celery_app(include_tasks: bool = False) -> Celery:
     """
     Create and configure a Celery application instance. It is meant to be used as a singleton.
     This function sets up the Celery app with the specified broker and backend URLs, and registers a custom serializer for handling numpy arrays.
+    The GPU tasks are routed to two lanes: the interactive tasks (a user waits on their result) to GPU_INTERACTIVE_QUEUE,
+    the bulk segmentation to GPU_QUEUE. The GPU worker consumes both, in the order set by QUEUE_ORDER_STRATEGY.
+    Task results are not stored, unless the task is declared with ignore_result=False, and expire after RESULT_EXPIRES.
+    Workers started with --autoscale size their pool with `LatencyAutoscaler`.
+    With EXECUTOR="local", the broker and the result backend are in memory, for a worker embedded in the same process
+    (see `start_local_worker`).
     It can also include the tasks module if specified, when running as a worker.
     Args:
         include_tasks (bool): If True, include the tasks module in the Celery app.
@@ -34,11 +57,16 @@ def create_celery_app(include_tasks: bool = False) -> Celery:
         Celery: Configured Celery application instance.
     """
     # Instantiate Celery
+    local = EXECUTOR == "local"
     celery_app = Celery(
         "cp_server-tasks",
         broker=CELERY_BROKER_URL,
-        backend=CELERY_BACKEND_URL,
+        backend="cache+memory://" if local else CELERY_BACKEND_URL,
         broker_connection_retry_on_startup=True)
+    if local:
+        # Celery gives the CELERY_BROKER_URL environment variable precedence over the broker argument, but not over
+        # the read and write URLs
+        celery_app.conf.update(broker_read_url="memory://", broker_write_url="memory://")
     
     # Update Celery configuration
     celery_app.conf.update(
@@ -48,6 +76,20 @@ def create_celery_app(include_tasks: bool = False) -> Celery:
         # Reduce verbosity of task completion logging
         worker_log_format='[%(asctime)s: %(levelname)s/%(processName)s] %(message)s',
         worker_task_log_format='[%(asctime)s: %(levelname)s/%(processName)s][%(task_name)s(%(task_id)s)] %(message)s',
+        broker_transport_options={"queue_order_strategy": QUEUE_ORDER_STRATEGY,
+                                  **({"polling_interval": LOCAL_POLLING_INTERVAL} if local else {})},
+        # Results are only stored for the tasks whose result is read (the interactive ones), and not for long
+        task_ignore_result=True,
+        result_expires=RESULT_EXPIRES,
+        # Pool size of the workers started with --autoscale, from the queue waiting time and the host headroom
+        worker_autoscaler="cp_server.tasks_server.autoscaler:LatencyAutoscaler",
+        # Routes are also needed by the API, which sends the interactive tasks
+        task_routes={
+            "cp_server.tasks_server.tasks.segementation.seg_task.segment": {"queue": GPU_QUEUE},
+            "cp_server.tasks_server.tasks.segementation.seg_task.bg_sub_and_segment": {"queue": GPU_QUEUE},
+            "cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings": {"queue": GPU_INTERACTIVE_QUEUE},
+            "cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata": {"queue": GPU_INTERACTIVE_QUEUE},
+        },
     )
     
     # Only load tasks if we're running as a worker
@@ -60,15 +102,35 @@ def create_celery_app(include_tasks: bool = False) -> Celery:
             "cp_server.tasks_server.tasks.segementation.seg_task",
         ])
         celery_app.conf.task_default_queue = "celery"
-        celery_app.conf.task_routes = {
-            "cp_server.tasks_server.tasks.segementation.seg_task.segment": {"queue": "gpu_tasks"},
-            "cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings": {"queue": "gpu_tasks"},
-            "cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata": {"queue": "gpu_tasks"},
-        }
     return celery_app
 
 celery_app = create_celery_app(include_tasks=True)
 
+def start_local_worker(app: Celery = celery_app) -> WorkController:
+    """
+    Start a worker in a background thread of this process, consuming all the queues (the interactive GPU lane first)
+    with a pool of LOCAL_WORKER_THREADS threads. With EXECUTOR="local", the API sends its tasks to this worker
+    through the in-memory broker, so the server runs standalone, without Redis nor separate Celery workers.
+    The app must be the one the tasks are registered to (`celery_app`), which also holds the in-memory results.
+    Returns:
+        WorkController: The running worker, to be stopped with `stop()`.
+    """
+    if EXECUTOR != "local":
+        raise RuntimeError(f"The embedded worker needs EXECUTOR='local', not {EXECUTOR!r}")
+    # Tasks chained or sent from the worker threads are published through the current app
+    app.set_default()
+    worker = app.WorkController(
+        hostname=nodename("local", gethostname()),
+        pool_cls="threads",
+        concurrency=LOCAL_WORKER_THREADS,
+        queues=[GPU_INTERACTIVE_QUEUE, GPU_QUEUE, "celery"],
+        without_heartbeat=True,
+        without_mingle=True,
+        without_gossip=True)
+    threading.Thread(target=worker.start, name="local_worker", daemon=True).start()
+    logger.info(f"Embedded worker started with {LOCAL_WORKER_THREADS} threads")
+    return worker
+
 @worker_ready.connect
 def preload_models(sender, **kwargs):
     """
@@ -121,6 +183,68 @@ def preload_models(sender, **kwargs):
     except Exception as e:
         logger.warning(f"Cellpose-kit model preloading failed: {e}")
 
+@worker_init.connect
+def warm_tracking_kernels_on_init(sender, **kwargs):
+    """
+    Get the numba tracking kernels ready in the main process of the non-GPU workers, before the pool starts: the
+    prefork children (also those recycled by --max-tasks-per-child) are forked from this process, so they inherit the
+    compiled kernels. A cold compilation takes several seconds, longer than a child is given to start
+    (worker_proc_alive_timeout), so it must not happen in the children.
+    """
+    worker_name = getattr(sender, 'hostname', '')
+    if 'gpu' in worker_name.lower():
+        logger.info("Skipping tracking kernels warm-up on GPU worker")
+        return
+    _warm_tracking_kernels()
+
+@worker_process_init.connect
+def warm_tracking_kernels_on_process_init(**kwargs):
+    """
+    Get the numba tracking kernels ready in each prefork child when it starts, only if they are inherited from the
+    main process or loaded from the on-disk cache. Otherwise they are compiled by the first tracking task.
+    """
+    try:
+        from cp_server.tasks_server.tasks.track.track import kernels_ready
+    except ImportError:
+        return
+    if not kernels_ready():
+        logger.info("Tracking kernels not cached - leaving their compilation to the first tracking task")
+        return
+    _warm_tracking_kernels()
+
+def _warm_tracking_kernels() -> None:
+    """
+    Compile or load the numba tracking kernels and log how long it took, so we can check that the cache is used.
+    """
+    try:
+        from cp_server.tasks_server.tasks.track.track import kernels_cache_hits, warm_up_kernels
+
+        timings = warm_up_kernels()
+        logger.info(f"Tracking kernels ready in {sum(timings.values()):.3f}s "
+                    f"({kernels_cache_hits()} loaded from cache): "
+                    + ", ".join(f"{name}={elapsed:.3f}s" for name, elapsed in timings.items()))
+    except ImportError:
+        logger.info("Numba not available on this worker - skipping tracking kernels warm-up")
+    except Exception as e:
+        logger.warning(f"Tracking kernels warm-up failed: {e}")
+
+@task_postrun.connect
+def record_throughput(task=None, **kwargs):
+    """
+    Count the tasks done per queue, from which the API estimates when a saturated queue will accept work again.
+    """
+    queue = (task.request.delivery_info or {}).get("routing_key") if task is not None else None
+    if not queue:
+        # Eagerly applied, not taken from a queue
+        return
+    try:
+        from cp_server.tasks_server.utils.redis_com import redis_client
+        from cp_server.tasks_server.utils.throughput import record_task_done
+
+        record_task_done(redis_client, queue)
+    except Exception as e:
+        logger.warning(f"Could not record the throughput of {queue}: {e}")
+
 # Configure logging to reduce verbosity of task completion messages
 import logging
 trace_logger = logging.getLogger('celery.app.trace')
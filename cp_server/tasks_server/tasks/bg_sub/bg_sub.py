@@ -1,22 +1,135 @@
-from typing import TypeVar
+import os
+from functools import lru_cache
+from typing import Callable, TypeVar
 
 import numpy as np
 from numpy.typing import NDArray
+from scipy.ndimage import gaussian_filter, uniform_filter
 from smo import SMO
 
 
 T = TypeVar('T', bound=np.generic)
 
+# Probability threshold of the SMO null distribution below which pixels are background (SMO.bg_mask default)
+BG_THRESHOLD = 0.05
 
-def apply_bg_sub(img: NDArray[T], sigma: float=0.0, size: int=7)-> NDArray[T]:
+# Number of SMO instances kept alive, one per (shape, sigma, size)
+SMO_CACHE_SIZE = int(os.getenv("SMO_CACHE_SIZE", 8))
+
+
+@lru_cache(maxsize=SMO_CACHE_SIZE)
+def get_smo(shape: tuple[int, ...], sigma: float, size: int) -> SMO:
+    """
+    Return the SMO instance for the given image shape and parameters, building it on first use.
+    Building an SMO estimates its null distribution from a random image of the same shape, which costs about as much
+    as correcting an image. The instance is only read afterwards, so it is shared between the threads of `remove_bg`.
+    """
+    return SMO(shape=shape, sigma=sigma, size=size)
+
+def bin_image(img: NDArray[T], factor: int, saturation: NDArray | None = None) -> np.ma.MaskedArray:
+    """
+    Downsample the last two axes of the image by averaging blocks of `factor` x `factor` pixels. The rows and columns
+    that don't fill a whole block are dropped. Blocks containing a saturated pixel (the image maximum, unless another
+    `saturation`, broadcastable to the image, is given) are masked, as SMO does with the saturated pixels at full
+    resolution.
+    """
+    height, width = (dim // factor * factor for dim in img.shape[-2:])
+    blocks_shape = (*img.shape[:-2], height // factor, factor, width // factor, factor)
+    blocks = img[..., :height, :width].reshape(blocks_shape)
+    binned = blocks.mean(axis=(-3, -1))
+    if saturation is None:
+        saturation = img.max()
+    else:
+        saturation = saturation.reshape(*saturation.shape[:-2], 1, 1, 1, 1)
+    saturated = (blocks >= saturation).any(axis=(-3, -1))
+    return np.ma.MaskedArray(binned, saturated)
+
+def estimate_background(img: NDArray[T], sigma: float=0.0, size: int=7, bin_factor: int=1) -> float:
+    """
+    Estimate the background intensity of the image, as the median of the pixels that SMO classifies as background.
+    With `bin_factor` > 1, the estimation runs on a copy of the image binned by this factor, which is about
+    `bin_factor`**2 times faster. The background being a single smooth level, binning barely changes it.
+    """
+    if bin_factor > 1:
+        img = bin_image(img, bin_factor)
+    smo = get_smo(tuple(img.shape), float(sigma), int(size))
+    return float(np.median(smo.bg_mask(img).compressed()))
+
+def apply_bg_sub(img: NDArray[T], sigma: float=0.0, size: int=7, bin_factor: int=1)-> NDArray[T]:
     """
-    Apply background subtraction to the image
+    Apply background subtraction to the image.
+    With `bin_factor` > 1, the background level is estimated on a binned copy of the image (see `estimate_background`).
     """
-    
-    smo = SMO(shape=img.shape, sigma=sigma, size=size)
-    
-    bg_img = smo.bg_corrected(img)
+
+    if bin_factor > 1:
+        # Same as SMO.bg_corrected, with the background estimated on the binned image
+        image = np.ma.masked_greater_equal(img, img.max())
+        bg_img = image - estimate_background(img, sigma, size, bin_factor)
+    else:
+        smo = get_smo(tuple(img.shape), float(sigma), int(size))
+        bg_img = smo.bg_corrected(img)
     # Reset neg val to 0
     bg_img[bg_img<0] = 0
-    
-    return bg_img.astype(img.dtype)
\ No newline at end of file
+
+    return bg_img.astype(img.dtype)
+
+def _masked_filter(filter: Callable, data: NDArray, mask: NDArray[np.bool_], **kwargs) -> tuple[NDArray, NDArray[np.bool_]]:
+    """
+    Apply a scipy.ndimage filter respecting the mask, as SMO does, on the data and mask of a masked array.
+    """
+    if not mask.any():
+        return filter(data, **kwargs, mode="mirror"), mask
+    out = filter(np.where(mask, 0, data), **kwargs, mode="mirror")
+    return out, ~filter(~mask, **kwargs, mode="mirror")
+
+def _stack_smo(data: NDArray, mask: NDArray[np.bool_], sigma: float, size: int) -> tuple[NDArray, NDArray[np.bool_]]:
+    """
+    The Silver Mountain Operator of each image of a (n, y, x) stack, in one pass. The filters and the gradient only
+    run along the image axes. The masked arrays of SMO are replaced by (data, mask) pairs, which avoids most of their
+    overhead on large stacks. Away from masked (saturated) pixels, each image gets the same values as with
+    `SMO.smo_image`. Next to them, the masked arrays arithmetic of SMO keeps the unmasked operand of the gradient
+    instead of a difference, so a few pixels can be classified differently.
+    """
+    out, mask = _masked_filter(gaussian_filter, data.astype(float), mask, sigma=(0, sigma, sigma))
+
+    # Normalized gradient
+    grad = np.gradient(out, axis=(1, 2))
+    norm = np.sqrt(grad[0]**2 + grad[1]**2)
+    for x in grad:
+        np.divide(x, norm, where=(norm > 0) & ~mask, out=x)
+
+    smoothed = [_masked_filter(uniform_filter, x, mask, size=(1, size, size)) for x in grad]
+    return np.sqrt(smoothed[0][0]**2 + smoothed[1][0]**2), smoothed[0][1]
+
+def estimate_background_stack(stack: NDArray[T], sigma: float=0.0, size: int=7, bin_factor: int=1) -> NDArray[np.float64]:
+    """
+    Estimate the background intensity of each image of a (n, y, x) stack of same-shaped images, as
+    `estimate_background` does for one image, with a single NumPy pass over the stack.
+    Returns:
+        np.ndarray: The background level of each image, shape (n,).
+    """
+    saturation = stack.max(axis=(1, 2), keepdims=True)
+    if bin_factor > 1:
+        binned = bin_image(stack, bin_factor, saturation)
+        data, mask = binned.data, np.ma.getmaskarray(binned)
+    else:
+        data, mask = stack, stack >= saturation
+    threshold = get_smo(tuple(data.shape[1:]), float(sigma), int(size)).smo_rv.ppf(BG_THRESHOLD)
+    smo_image, smo_mask = _stack_smo(data, mask, sigma, size)
+    background = (smo_image <= threshold) & ~smo_mask
+    return np.array([np.median(img[bg]) for img, bg in zip(data, background)])
+
+def apply_bg_sub_stack(stack: NDArray[T], sigma: float=0.0, size: int=7, bin_factor: int=1) -> NDArray[T]:
+    """
+    Apply background subtraction to each image of a (n, y, x) stack of same-shaped images, as `apply_bg_sub` does on
+    each image, but with the estimation, subtraction and clipping done on the whole stack at once. The result is the
+    same, except for images with saturated pixels, whose background level can differ by a fraction of an intensity
+    unit (see `_stack_smo`).
+    """
+    saturated = stack >= stack.max(axis=(1, 2), keepdims=True)
+    bg_img = stack - estimate_background_stack(stack, sigma, size, bin_factor)[:, None, None]
+    # Reset neg val to 0, saturated pixels are left untouched (as in SMO.bg_corrected)
+    np.maximum(bg_img, 0, out=bg_img)
+    bg_img[saturated] = stack[saturated]
+
+    return bg_img.astype(stack.dtype)
@@ -1,36 +1,279 @@
-from celery import shared_task
-from typing import Union, List
-from tifffile import imread
+import os
+import threading
+import time
+import billiard
+from celery import Task, shared_task
+from celery.exceptions import Ignore
+from celery.signals import worker_process_shutdown
+from typing import Any, Union, List
+import numpy as np
+from numpy.typing import NDArray
+from tifffile import TiffFile, imread
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
+from multiprocessing import shared_memory
 
 from cp_server.tasks_server import get_logger
-from cp_server.tasks_server.tasks.bg_sub.bg_sub import apply_bg_sub
-from cp_server.tasks_server.tasks.saving.save_arrays import save_img
+from cp_server.tasks_server.tasks.bg_sub.bg_sub import apply_bg_sub, apply_bg_sub_stack
+from cp_server.tasks_server.tasks.saving.save_arrays import read_bg_sub_params, save_img
+from cp_server.tasks_server.utils.failures import retry_later
+from cp_server.tasks_server.utils.progress import BG_SUBTRACTED, record_stage
+
+# Executor running the background subtraction of a batch: "thread" or "process" (immune to the GIL held by parts of SMO)
+BG_SUB_EXECUTOR = os.getenv("BG_SUB_EXECUTOR", "thread")
+# CPU cores available to the worker container, shared by its prefork children (--concurrency)
+CPU_BUDGET = int(os.getenv("CPU_BUDGET") or os.cpu_count() or 1)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 6))
+# Number of threads or processes of each child, so that all the children together don't oversubscribe the cores
+BG_SUB_WORKERS = int(os.getenv("BG_SUB_WORKERS", max(1, CPU_BUDGET // WORKER_CONCURRENCY)))
+# Maximum number of pixels of a stack of same-shaped images corrected at once in a batch, 0 to correct them one by one.
+# Opt-in: the stacked path is faster but not bit-identical to SMO next to the masked (saturated) pixels
+BG_SUB_STACK_PIXELS = int(os.getenv("BG_SUB_STACK_PIXELS", 0))
+# How often the processes of the background subtraction pool check that their worker child is still alive, in seconds
+BG_SUB_PARENT_CHECK = float(os.getenv("BG_SUB_PARENT_CHECK", 1.0))
+# Number of threads persisting the background-subtracted images in the background (fused bg-sub + segment stage)
+BG_WRITER_THREADS = int(os.getenv("BG_WRITER_THREADS", 2))
 
 logger = get_logger(__name__)
 
-def _process_single_bg(img_path: str, sigma: float, size: int) -> str:
-    logger.debug(f"Removing background from {img_path}")
+_bg_writer = ThreadPoolExecutor(max_workers=BG_WRITER_THREADS, thread_name_prefix="bg_writer")
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = threading.Lock()
+
+def bg_sub_params(sigma: float, size: int, bin_factor: int = 1) -> dict[str, Any]:
+    """
+    Parameters of a background subtraction, as recorded in the marker of the corrected images.
+    """
+    return {"sigma": sigma, "size": size, "bin_factor": bin_factor}
+
+def is_bg_subtracted(img_path: str, params: dict[str, Any]) -> bool:
+    """
+    Check the marker of the image, so that a retried or resubmitted task never removes the background twice.
+    Only the TIFF header is read.
+    """
+    done_params = read_bg_sub_params(img_path)
+    if done_params is None:
+        return False
+    if done_params != params:
+        logger.warning(f"{img_path} was already background-subtracted with {done_params}, not subtracting again with {params}")
+    return True
+
+def load_bg_sub(img_path: str, sigma: float, size: int, bin_factor: int = 1) -> tuple[NDArray, bool]:
+    """
+    Read an image and return it background-subtracted, without writing it back, and whether the background was
+    removed now. Images already marked as background-subtracted are returned as they are.
+    """
+    img = imread(img_path)
+    if is_bg_subtracted(img_path, bg_sub_params(sigma, size, bin_factor)):
+        logger.info(f"Background already removed from {img_path}, skipping")
+        return img, False
+    logger.debug(f"Removing background from {img_path}, {img.shape=} and {img.dtype=}")
+    return apply_bg_sub(img, sigma, size, bin_factor), True
+
+def save_bg_img_async(bg_img: NDArray, img_path: str, params: dict[str, Any]) -> Future:
+    """
+    Overwrite the image with its background-subtracted version from the writer threads, so the caller doesn't wait
+    for the compression and the disk. Failures are logged, the returned future can be waited on.
+    """
+    def _log_failure(future: Future) -> None:
+        if future.exception() is not None:
+            logger.error(f"Failed to save the background-subtracted image at {img_path}: {future.exception()}")
+
+    future = _bg_writer.submit(save_img, bg_img, img_path, params)
+    future.add_done_callback(_log_failure)
+    return future
+
+def _exit_with_parent(parent_pid: int) -> None:
+    """
+    Initializer of the processes of the pool: exit as soon as the worker child that started them is gone (e.g.
+    terminated by the Celery parent), instead of being left behind as orphans.
+    """
+    def _watch() -> None:
+        while os.getppid() == parent_pid:
+            time.sleep(BG_SUB_PARENT_CHECK)
+        os._exit(0)
+
+    threading.Thread(target=_watch, name="parent_watch", daemon=True).start()
+
+def _get_process_pool() -> ProcessPoolExecutor | None:
+    """
+    Return the process pool of this worker child, created on first use and kept alive between tasks (so the SMO
+    instances cached in its processes are reused). Returns None when BG_SUB_EXECUTOR is "thread".
+    The processes are started through billiard, which, unlike multiprocessing, lets the daemonic prefork children
+    of the worker start processes of their own. They exit with the child (see `_exit_with_parent`), and the pool is
+    shut down when the child stops (see `shutdown_process_pool`).
+    """
+    global _process_pool
+    if BG_SUB_EXECUTOR not in ("thread", "process"):
+        raise ValueError(f"Unknown BG_SUB_EXECUTOR {BG_SUB_EXECUTOR!r}, expected 'thread' or 'process'")
+    if BG_SUB_EXECUTOR == "thread":
+        return None
+    with _process_pool_lock:
+        if _process_pool is None:
+            logger.info(f"Starting a pool of {BG_SUB_WORKERS} processes for background subtraction")
+            _process_pool = ProcessPoolExecutor(max_workers=BG_SUB_WORKERS, mp_context=billiard.get_context("fork"),
+                                                initializer=_exit_with_parent, initargs=(os.getpid(),))
+        return _process_pool
+
+@worker_process_shutdown.connect
+def shutdown_process_pool(**kwargs) -> None:
+    """
+    Stop the process pool of a worker child when the child stops (e.g. recycled by --max-tasks-per-child).
+    """
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def _reset_process_pool(pool: ProcessPoolExecutor) -> None:
+    """
+    Drop a broken process pool (e.g. a process was killed), so the next task starts a new one.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is pool:
+            _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _bg_sub_shared(shm_name: str, shape: tuple[int, ...], dtype: str, sigma: float, size: int, bin_factor: int) -> None:
+    """
+    Remove the background of the image held in a shared memory block, in place. Runs in the process pool.
+    """
+    # The forked processes share the resource tracker of the parent, which owns and unlinks the block
+    shm = shared_memory.SharedMemory(name=shm_name)
+    img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        img[...] = apply_bg_sub(img, sigma, size, bin_factor)
+    finally:
+        # The view must be released before closing the block
+        del img
+        shm.close()
+
+def _bg_sub_in_process(img_path: str, sigma: float, size: int, bin_factor: int, pool: ProcessPoolExecutor) -> NDArray:
+    """
+    Read an image and remove its background in the process pool. The pixels are exchanged through a shared memory
+    block instead of being pickled to the process and back.
+    """
     img = imread(img_path)
-    logger.debug(f"{img.shape=} and {img.dtype=}")
-    bg_img = apply_bg_sub(img, sigma, size)
-    save_img(bg_img, img_path)
+    logger.debug(f"Removing background from {img_path} in a process, {img.shape=} and {img.dtype=}")
+    shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+    shared_img = np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)
+    try:
+        shared_img[...] = img
+        pool.submit(_bg_sub_shared, shm.name, img.shape, img.dtype.str, sigma, size, bin_factor).result()
+        bg_img = shared_img.copy()
+    except BrokenProcessPool:
+        _reset_process_pool(pool)
+        raise
+    finally:
+        del shared_img
+        shm.close()
+        shm.unlink()
+    return bg_img
+
+def _process_single_bg(img_path: str, sigma: float, size: int, bin_factor: int = 1,
+                       pool: ProcessPoolExecutor | None = None) -> str:
+    params = bg_sub_params(sigma, size, bin_factor)
+    if is_bg_subtracted(img_path, params):
+        logger.info(f"Background already removed from {img_path}, skipping")
+        return str(img_path)
+    if pool is None:
+        logger.debug(f"Removing background from {img_path}")
+        bg_img = apply_bg_sub(imread(img_path), sigma, size, bin_factor)
+    else:
+        bg_img = _bg_sub_in_process(img_path, sigma, size, bin_factor, pool)
+    save_img(bg_img, img_path, params)
     logger.info(f"Background-subtracted image overwritten at {img_path}")
     return str(img_path)
 
-@shared_task(name="cp_server.tasks_server.tasks.bg_sub.remove_bg")
-def remove_bg(img_path: Union[str, List[str]], sigma: float, size: int) -> Union[str, List[str]]:
+def _stack_batches(img_paths: list[str], params: dict[str, Any], errors: dict[str, Exception]) -> list[list[str]]:
     """
-    Apply background subtraction to one or more images, save the result(s), and return the file path(s).
+    Group the images still to be corrected into stacks of same-shaped 2D images of at most BG_SUB_STACK_PIXELS
+    pixels. Other images get a stack of their own. Only the TIFF headers are read, the images that can't be read are
+    added to `errors`.
+    """
+    groups: dict[tuple, list[str]] = {}
+    for img_path in img_paths:
+        try:
+            if is_bg_subtracted(img_path, params):
+                logger.info(f"Background already removed from {img_path}, skipping")
+                continue
+            with TiffFile(img_path) as tif:
+                series = tif.series[0]
+                groups.setdefault((series.shape, series.dtype.str), []).append(img_path)
+        except Exception as e:
+            logger.error(f"Failed to read image from {img_path}: {e}")
+            errors[img_path] = e
+
+    batches = []
+    for (shape, _), paths in groups.items():
+        stack_size = max(1, BG_SUB_STACK_PIXELS // int(np.prod(shape))) if len(shape) == 2 else 1
+        batches.extend(paths[i:i + stack_size] for i in range(0, len(paths), stack_size))
+    return batches
+
+def _process_stacked_bg(img_paths: list[str], sigma: float, size: int, bin_factor: int) -> None:
+    """
+    Read a stack of same-shaped images, correct them in one pass and overwrite them.
     """
-    if isinstance(img_path, list):
-        logger.info(f"Processing {len(img_path)} images in parallel for background subtraction.")
-        with ThreadPoolExecutor() as executor:
-            func = partial(_process_single_bg, sigma=sigma, size=size)
-            results = list(executor.map(func, img_path))
-        return results
+    imgs = [imread(img_path) for img_path in img_paths]
+    if imgs[0].ndim == 2:
+        logger.debug(f"Removing background from a stack of {len(imgs)} images of shape {imgs[0].shape}")
+        bg_imgs = apply_bg_sub_stack(np.stack(imgs), sigma, size, bin_factor)
     else:
-        return _process_single_bg(img_path, sigma, size)
+        bg_imgs = [apply_bg_sub(img, sigma, size, bin_factor) for img in imgs]
+    for bg_img, img_path in zip(bg_imgs, img_paths):
+        save_img(bg_img, img_path, bg_sub_params(sigma, size, bin_factor))
+        logger.info(f"Background-subtracted image overwritten at {img_path}")
+
+@shared_task(bind=True, name="cp_server.tasks_server.tasks.bg_sub.remove_bg")
+def remove_bg(self: Task, img_path: Union[str, List[str]], sigma: float, size: int, bin_factor: int = 1,
+              well_id: str | None = None, attempt: int = 0) -> Union[str, List[str]]:
+    """
+    Apply background subtraction to one or more images, save the result(s), and return the file path(s).
+    The saved images are marked with the parameters used, and marked images are skipped, so reruns are safe and cheap.
+    A batch is spread over BG_SUB_WORKERS threads. With BG_SUB_EXECUTOR="process", the threads only read and write
+    the images, while the background subtraction itself runs in a pool of as many processes.
+    With `bin_factor` > 1, the background level is estimated on images binned by this factor (see `apply_bg_sub`).
+    With BG_SUB_STACK_PIXELS > 0, in threads, same-shaped images are grouped in stacks of up to as many pixels, each
+    corrected in a single NumPy pass (see `apply_bg_sub_stack`, which can differ slightly from `apply_bg_sub`).
+    In a batch, the images that fail are left out of the returned paths, so the rest of the batch goes on to the
+    segmentation, and retried alone by a later run of the task, `attempt` counting the retries (see `retry_later`).
+    The task fails only if every image failed for good.
+    With a `well_id`, the images done are recorded in the progress ledger of the run.
+    """
+    pool = _get_process_pool()
+    if not isinstance(img_path, list):
+        done = _process_single_bg(img_path, sigma, size, bin_factor, pool)
+        if well_id is not None:
+            record_stage(well_id, [done], BG_SUBTRACTED)
+        return done
+
+    errors: dict[str, Exception] = {}
+    with ThreadPoolExecutor(max_workers=BG_SUB_WORKERS) as executor:
+        if pool is None and BG_SUB_STACK_PIXELS > 0 and attempt == 0:
+            batches = _stack_batches(img_path, bg_sub_params(sigma, size, bin_factor), errors)
+            logger.info(f"Processing {len(img_path)} images in {len(batches)} stacks for background subtraction.")
+            func = partial(_process_stacked_bg, sigma=sigma, size=size, bin_factor=bin_factor)
+            futures = {executor.submit(func, batch): batch for batch in batches}
+        else:
+            logger.info(f"Processing {len(img_path)} images in parallel for background subtraction.")
+            func = partial(_process_single_bg, sigma=sigma, size=size, bin_factor=bin_factor, pool=pool)
+            futures = {executor.submit(func, p): [p] for p in img_path}
+    for future, batch in futures.items():
+        if future.exception() is not None:
+            logger.error(f"Background subtraction failed for {batch}: {future.exception()}")
+            errors.update({p: future.exception() for p in batch})  # type: ignore[misc]
 
+    # Images of a stack saved before the failure are marked, and so skipped by the retry
+    retried = bool(errors) and retry_later(self, errors, attempt, "bg_sub")
+    done = [str(p) for p in img_path if p not in errors]
+    if not done and errors:
+        if retried:
+            raise Ignore()
+        raise next(iter(errors.values()))
+    if well_id is not None:
+        record_stage(well_id, done, BG_SUBTRACTED)
+    return done
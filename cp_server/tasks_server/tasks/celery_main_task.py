@@ -1,67 +1,192 @@
+import math
+import os
+import uuid
 from typing import Any
 
-from celery import chain, shared_task
+from celery import Task, chain, shared_task
+from tifffile import TiffFile
 
 from cp_server.tasks_server import get_logger
 from cp_server.tasks_server.celery_app import celery_app
+from cp_server.tasks_server.tasks.segementation.seg_latency import seg_latency
+from cp_server.tasks_server.utils.progress import SUBMITTED, record_batch, record_params, record_stage
+from cp_server.tasks_server.utils.redis_com import redis_client
+
+# Number of images of each chain a batch is split into, when the request doesn't set it and no latency was recorded yet
+PROCESS_CHUNK_SIZE = int(os.getenv("PROCESS_CHUNK_SIZE", 4))
+# Targeted duration of the segmentation of a chunk, from the recent latency of the segmentation, in seconds
+CHUNK_TARGET_SECONDS = float(os.getenv("CHUNK_TARGET_SECONDS", 60))
+# Maximum number of pixels of a chunk, which the GPU worker holds in memory with their masks
+CHUNK_MAX_PIXELS = int(os.getenv("CHUNK_MAX_PIXELS", 64 * 1024 * 1024))
+# Minimum number of chains of a batch, so that a batch keeps every GPU worker slot busy
+CHUNK_MIN_CHAINS = int(os.getenv("CHUNK_MIN_CHAINS", 3))
+# Lifetime of the counters of pending chains and of the done flags of the batches, in seconds
+BATCH_TTL = int(os.getenv("BATCH_TTL", 24 * 3600))
 
 # Setup logging
 logger = get_logger('tasks')
 
 
-@shared_task(name="cp_server.tasks_server.tasks.celery_main_task.process_images")
-def process_images(img_path: str | list[str],
+def chunk_paths(img_paths: list[str], chunk_size: int) -> list[list[str]]:
+    """
+    Split the images of a batch into as few chunks of at most `chunk_size` images as possible, in order. The images
+    are spread evenly over the chunks, so the chains take about the same time.
+    """
+    n_chunks = math.ceil(len(img_paths) / chunk_size)
+    bounds = [round(i * len(img_paths) / n_chunks) for i in range(n_chunks + 1)]
+    return [img_paths[start:stop] for start, stop in zip(bounds, bounds[1:])]
+
+def adaptive_chunk_size(img_paths: list[str]) -> int:
+    """
+    Number of images per chunk of a batch, from the size of its images (the TIFF header of the first one) and the
+    recent latency of the segmentation: as many images as are segmented in about CHUNK_TARGET_SECONDS, within
+    CHUNK_MAX_PIXELS, and few enough to split the batch into at least CHUNK_MIN_CHAINS chains.
+    Without any recorded latency, chunks are of PROCESS_CHUNK_SIZE images (still within the pixel budget).
+    """
+    chunk_size = PROCESS_CHUNK_SIZE
+    try:
+        with TiffFile(img_paths[0]) as tif:
+            pixels = math.prod(tif.series[0].shape)
+    except Exception as e:
+        logger.warning(f"Could not read the image size of {img_paths[0]}, chunking by {chunk_size} images: {e}")
+    else:
+        latency = seg_latency()
+        if latency:
+            chunk_size = int(CHUNK_TARGET_SECONDS / (latency * pixels / 1e6))
+        chunk_size = min(chunk_size, CHUNK_MAX_PIXELS // pixels)
+        logger.debug(f"Chunks of {chunk_size} images of {pixels} pixels, segmentation latency {latency} s/megapixel")
+    chunk_size = min(chunk_size, math.ceil(len(img_paths) / CHUNK_MIN_CHAINS))
+    return max(1, chunk_size)
+
+@shared_task(bind=True, name="cp_server.tasks_server.tasks.celery_main_task.process_images")
+def process_images(self: Task,
+                   img_path: str | list[str],
                    cellpose_settings: dict[str, Any],
                    dst_folder: str, 
                    well_id: str,
                    track_stitch_threshold: float=0.75, 
+                   track_overlap_mode: str="dense",
+                   track_matching: str="greedy",
                    sigma: float=0.0, 
                    size: int=7,
+                   bin_factor: int=1,
+                   fuse_bg_sub: bool=False,
+                   save_bg_img: bool=True,
+                   chunk_size: int | None=None,
                    ) -> str:
     """
     Process one or more images by removing the background, segmenting, and tracking using Cellpose and IoU tracking.
     Accepts a single image path or a list of image paths. Handles batch operation for all downstream tasks.
+    With `fuse_bg_sub`, the background is removed on the GPU worker right before segmenting, and the corrected images
+    are passed in memory. They are then only written back to disk if `save_bg_img`, without delaying the segmentation.
+    A batch is split into chunks of `chunk_size` images (sized by `adaptive_chunk_size` by default), each processed
+    by its own chain, so the background of a chunk is removed while the previous one is segmented, and the chunks of a large
+    batch are spread over the GPU workers. The number of chains still running is counted down in Redis under
+    'pending_chunks:<batch_id>', and 'batch_done:<batch_id>' is set once they all finished. The batch ID is the ID of
+    this task. A chain failing is also counted down, by its error callback, and counted in 'failed_chunks:<batch_id>'.
+    Either way, the claims of the images of the chain are released (see `fastapi_app.endpoints.dedup`).
+    The stage reached by each image is recorded in the progress ledger of the run (see `utils.progress`), with the
+    parameters, so a run interrupted by a crash can be resumed from where each image stopped.
     """
     # Starting point of the log
     logger.info(f"Received image file(s): {img_path}")
+    record_params(well_id, dict(
+        cellpose_settings=cellpose_settings,
+        dst_folder=dst_folder,
+        track_stitch_threshold=track_stitch_threshold,
+        track_overlap_mode=track_overlap_mode,
+        track_matching=track_matching,
+        sigma=sigma,
+        size=size,
+        bin_factor=bin_factor,
+        fuse_bg_sub=fuse_bg_sub,
+        save_bg_img=save_bg_img))
+    record_stage(well_id, img_path if isinstance(img_path, list) else [img_path], SUBMITTED)
 
     # Helper to create the workflow chain for a single or batch
-    def create_chain(img_path_batch):
+    def create_chain(img_path_batch, *callbacks):
+        if fuse_bg_sub:
+            segment_tasks = [
+                celery_app.signature(
+                    'cp_server.tasks_server.tasks.segementation.seg_task.bg_sub_and_segment',
+                    kwargs=dict(
+                        img_path=img_path_batch,
+                        cellpose_settings=cellpose_settings,
+                        dst_folder=dst_folder,
+                        well_id=well_id,
+                        sigma=sigma,
+                        size=size,
+                        bin_factor=bin_factor,
+                        save_bg_img=save_bg_img
+                    )
+                ),
+            ]
+        else:
+            segment_tasks = [
+                celery_app.signature(
+                    'cp_server.tasks_server.tasks.bg_sub.remove_bg',
+                    kwargs=dict(
+                        img_path=img_path_batch, 
+                        sigma=sigma, 
+                        size=size,
+                        bin_factor=bin_factor,
+                        well_id=well_id
+                    )
+                ),
+                celery_app.signature(
+                    'cp_server.tasks_server.tasks.segementation.seg_task.segment',
+                    kwargs=dict(
+                        cellpose_settings=cellpose_settings, 
+                        dst_folder=dst_folder, 
+                        well_id=well_id
+                    )
+                ),
+            ]
         return chain(
-            celery_app.signature(
-                'cp_server.tasks_server.tasks.bg_sub.remove_bg',
-                kwargs=dict(
-                    img_path=img_path_batch, 
-                    sigma=sigma, 
-                    size=size
-                )
-            ),
-            celery_app.signature(
-                'cp_server.tasks_server.tasks.segementation.seg_task.segment',
-                kwargs=dict(
-                    cellpose_settings=cellpose_settings, 
-                    dst_folder=dst_folder, 
-                    well_id=well_id
-                )
-            ),
+            *segment_tasks,
             celery_app.signature(
                 'cp_server.tasks_server.tasks.counter.counter_task_manager.check_and_track',
                 kwargs=dict(
-                    track_stitch_threshold=track_stitch_threshold
+                    track_stitch_threshold=track_stitch_threshold,
+                    track_overlap_mode=track_overlap_mode,
+                    track_matching=track_matching
                 )
             ),
+            *callbacks,
         )
 
+    def end_callbacks(batch_id):
+        # End the chain, successful or not: release its images and count it down if it is a chunk of a batch
+        mark_done = celery_app.signature(
+            'cp_server.tasks_server.tasks.counter.counter_task_manager.mark_chunk_done',
+            args=[batch_id],
+            kwargs=dict(batch_ttl=BATCH_TTL))
+        mark_failed = celery_app.signature(
+            'cp_server.tasks_server.tasks.counter.counter_task_manager.mark_chunk_failed',
+            args=[batch_id],
+            kwargs=dict(batch_ttl=BATCH_TTL))
+        return mark_done, mark_failed
+
     # Accept both str and list[str]
     if isinstance(img_path, list):
-        logger.info(f"Batch workflow: {len(img_path)} images.")
-        # For batch, pass the list through the chain (all downstream tasks support batch)
-        create_chain(img_path).apply_async()
+        batch_id = self.request.id or uuid.uuid4().hex
+        chunks = chunk_paths(img_path, chunk_size or adaptive_chunk_size(img_path))
+        logger.info(f"Batch workflow {batch_id}: {len(img_path)} images in {len(chunks)} chains.")
+        # Set the counter before any chain can finish and count down
+        redis_client.set(f"pending_chunks:{batch_id}", len(chunks), ex=BATCH_TTL)
+        record_batch(well_id, batch_id)
+        mark_done, mark_failed = end_callbacks(batch_id)
+        # For each chunk, pass the list through the chain (all downstream tasks support batch)
+        for chunk in chunks:
+            create_chain(chunk, mark_done.clone(kwargs=dict(img_paths=chunk))).on_error(
+                mark_failed.clone(kwargs=dict(img_paths=chunk))).apply_async()
         logger.info(f"Batch workflow created for {len(img_path)} images.")
-        return f"Batch of {len(img_path)} images sent to be segmented"
+        return f"Batch of {len(img_path)} images sent to be segmented in {len(chunks)} chains"
     else:
         # Single image
-        create_chain(img_path).apply_async()
+        mark_done, mark_failed = end_callbacks(None)
+        create_chain(img_path, mark_done.clone(kwargs=dict(img_paths=[img_path]))).on_error(
+            mark_failed.clone(kwargs=dict(img_paths=[img_path]))).apply_async()
         logger.info(f"Workflow created for {img_path}")
         return f"Image {img_path} was sent to be segmented"
 
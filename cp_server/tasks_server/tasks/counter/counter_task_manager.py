@@ -3,6 +3,8 @@ from typing import Optional, List, Union
 from celery import shared_task
 
 from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.utils.claims import release_claims
+from cp_server.tasks_server.utils.progress import record_tracked
 from cp_server.tasks_server.utils.redis_com import redis_client
 from cp_server.tasks_server.celery_app import celery_app
 from redis import RedisError
@@ -14,19 +16,64 @@ logger = get_logger('counter_tasks')
 def mark_one_done(track_result, well_id: str) -> Optional[str]:
     """
     Celery callback: decrement the pending counter; if zero, fire final task.
-    The track_result parameter receives the return value from the track_cells task.
+    The track_result parameter receives the return value from the track_cells task, the tracked masks, whose images
+    are recorded as tracked in the progress ledger of the run.
     """
     # Log the track result (optional, can be removed if not needed)
     logger.debug(f"Track task completed with result: {track_result}")
+    if isinstance(track_result, list):
+        record_tracked(well_id, track_result)
     
     remaining = redis_client.decr(f"pending_tracks:{well_id}")
     logger.info(f"Tracks remaining: {remaining}")
     if remaining == 0:
         celery_app.send_task(
             'cp_server.tasks_server.tasks.counter.counter_task_manager.all_tracks_finished',
-            args=[well_id]
+            args=[well_id],
+            ignore_result=True
         )
 
+@shared_task(name="cp_server.tasks_server.tasks.counter.counter_task_manager.mark_chunk_done")
+def mark_chunk_done(chain_result, batch_id: Optional[str], batch_ttl: int = 24 * 3600,
+                    img_paths: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Celery callback ending the chain of each chunk of a batch, or of a single image (no batch_id): release the claims
+    of its images (see `release_claims`), then decrement the pending chains of the batch; if zero, flag the batch as
+    done. The chain_result parameter receives the return value from the check_and_track task.
+    """
+    release_claims(img_paths or [])
+    if batch_id is not None and _count_chunk_down(batch_id, batch_ttl):
+        return f"Batch {batch_id} completed successfully. All chains finished."
+    return None
+
+@shared_task(name="cp_server.tasks_server.tasks.counter.counter_task_manager.mark_chunk_failed")
+def mark_chunk_failed(request, exc, traceback, batch_id: Optional[str], batch_ttl: int = 24 * 3600,
+                      img_paths: Optional[List[str]] = None) -> None:
+    """
+    Celery error callback of the chain of each chunk of a batch, or of a single image, run when any of its tasks
+    fails: the chain is ended as `mark_chunk_done` does, and counted as failed under 'failed_chunks:<batch_id>', so
+    the batch still completes and its status reports the failure.
+    """
+    logger.error(f"Chain of batch {batch_id} failed in task {request.id}: {exc!r}")
+    release_claims(img_paths or [])
+    if batch_id is None:
+        return
+    redis_client.incr(f"failed_chunks:{batch_id}")
+    redis_client.expire(f"failed_chunks:{batch_id}", batch_ttl)
+    _count_chunk_down(batch_id, batch_ttl)
+
+def _count_chunk_down(batch_id: str, batch_ttl: int) -> bool:
+    """
+    Decrement the pending chains of the batch; if zero, flag the batch as done. Returns whether it was the last one.
+    """
+    remaining = redis_client.decr(f"pending_chunks:{batch_id}")
+    logger.info(f"Chains remaining for batch {batch_id}: {remaining}")
+    if remaining == 0:
+        redis_client.delete(f"pending_chunks:{batch_id}")
+        redis_client.set(f"batch_done:{batch_id}", 1, ex=batch_ttl)
+        return True
+    return False
+
 @shared_task(name="cp_server.tasks_server.tasks.counter.counter_task_manager.all_tracks_finished")
 def all_tracks_finished(well_id: str) -> str:
     """
@@ -51,9 +98,10 @@ def all_tracks_finished(well_id: str) -> str:
 
 
 @shared_task(name="cp_server.tasks_server.tasks.counter.counter_task_manager.check_and_track")
-def check_and_track(hkey: Union[str, List[str]], track_stitch_threshold: float) -> None:
+def check_and_track(hkey: Union[str, List[str]], track_stitch_threshold: float, track_overlap_mode: str = "dense", track_matching: str = "greedy") -> None:
     """
-    Check if there are two masks for the same FOV in Redis. If so, trigger the tracking task.
+    Check if there are two masks for the same FOV in Redis. If so, trigger the tracking task with the given
+    stitching threshold, overlap mode and matching engine.
     Can process a single hkey or a list of hkeys for batch operation.
     Wrapped in try/except to catch Redis errors.
     """
@@ -80,9 +128,11 @@ def check_and_track(hkey: Union[str, List[str]], track_stitch_threshold: float)
                 celery_app.send_task(
                     'cp_server.tasks_server.tasks.track.track_cells',
                     args=[paths, track_stitch_threshold],
+                    kwargs={'track_overlap_mode': track_overlap_mode, 'track_matching': track_matching},
                     link=celery_app.signature(
                         'cp_server.tasks_server.tasks.counter.counter_task_manager.mark_one_done',
-                        args=[well_id]))
+                        args=[well_id]),
+                    ignore_result=True)
 
         except RedisError as e:
             logger.exception(f"Redis error in check_and_track for key {single_hkey}: {e}")
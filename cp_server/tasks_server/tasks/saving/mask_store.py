@@ -0,0 +1,251 @@
+"""
+Per-well container of masks: one zip file per well instead of one TIFF file per FOV and round.
+
+The masks of a well are members of '<dst_folder>.zip', each holding the TIFF bytes of one mask (compressed by the TIFF
+codec, so the members are stored as they are). A mask stored in a container is addressed by the path it would have if
+the container was a directory, e.g. '/data/A1_well/A1_masks.zip/F001_mask_1.tif'. The file name of the mask is kept,
+so the FOV and round are parsed from store paths as from regular paths.
+
+Zip members can't be rewritten in place. A member is written by appending it after the central directory of the
+container, followed by a new central directory that lists it instead of its previous copy: until the new one is
+complete, the previous one still describes the container. Once the file is synced, its inode and size are recorded
+as committed in a '<container>.lock' file next to it, and the bytes past the committed size of a writer that died
+mid-write are cut off by the next access. When superseded copies make up more than half of the container
+(STORE_COMPACT_RATIO), it is instead rewritten with only the latest copies to a temporary file, which replaces it
+(`os.replace`), so a container is only ever seen in a committed state.
+
+Writers and readers of a container are serialized by an exclusive (shared for readers) POSIX lock (`fcntl.lockf`) on
+the lock file, which holds across the processes of a host, and a lock per container within a process, as POSIX locks
+don't exclude the threads of a process. Readers only hold them to look the member up: the bytes of a committed member
+never change. The lookups use the central directory parsed at the last change of the container.
+On a network filesystem, the locks and the committed state hold only as far as the filesystem supports POSIX locks
+(lockd for NFSv3, or NFSv4) and close-to-open consistency, and MASK_STORAGE="well" is experimental there: containers
+are best kept on a local disk of the workers writing them.
+"""
+import fcntl
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, BinaryIO, Iterator
+
+# Where the masks are saved: "tiff" (one TIFF file per mask) or "well" (one container per well, see module docstring)
+MASK_STORAGE = os.getenv("MASK_STORAGE", "tiff")
+STORAGES = ("tiff", "well")
+STORE_SUFFIX = ".zip"
+# A container is compacted when it is larger than this many times its latest members
+STORE_COMPACT_RATIO = float(os.getenv("STORE_COMPACT_RATIO", 2.0))
+
+# Local file header of a zip member: signature, versions, flags, method, time, date, CRC, sizes, name and extra lengths
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+_thread_locks: defaultdict[Path, threading.Lock] = defaultdict(threading.Lock)
+_thread_locks_guard = threading.Lock()
+# Central directory of each container, by container, with the inode, size and mtime it was parsed at
+_indexes: dict[Path, tuple[tuple[int, int, int], dict[str, zipfile.ZipInfo]]] = {}
+
+
+def store_folder(dst_folder: str) -> Path:
+    """
+    The folder the masks of a well are saved in: the destination folder itself, or its container with MASK_STORAGE="well".
+    """
+    if MASK_STORAGE not in STORAGES:
+        raise ValueError(f"Unknown MASK_STORAGE {MASK_STORAGE!r}, expected one of {STORAGES}")
+    if MASK_STORAGE == "well":
+        return Path(dst_folder).with_suffix(STORE_SUFFIX)
+    return Path(dst_folder)
+
+def is_store_path(path: str | Path) -> bool:
+    """
+    Whether the path addresses a member of a container rather than a file.
+    """
+    parent = Path(path).parent
+    return parent.suffix == STORE_SUFFIX and not parent.is_dir()
+
+def store_exists(path: str | Path) -> bool:
+    """
+    Whether the path is an existing file or an existing member of a container.
+    """
+    if not is_store_path(path):
+        return Path(path).is_file()
+    container, member = Path(path).parent, Path(path).name
+    if not container.is_file():
+        return False
+    container_file, info = _open_member(container, member)
+    container_file.close()
+    return info is not None
+
+def write_member(path: str | Path, data: bytes) -> None:
+    """
+    Write the bytes of a member to its container, creating the container if needed. A member already in the
+    container is superseded by the new one. The container is left as it was if the writer dies before returning.
+    """
+    container, member = Path(path).parent, Path(path).name
+    with _locked(container, exclusive=True) as lock_file:
+        _recover(container, lock_file)
+        index = _index(container) if container.is_file() else {}
+        live = sum(_stored_size(info) for name, info in index.items() if name != member)
+        live += _LOCAL_HEADER.size + len(member.encode()) + len(data)
+        if not index or container.stat().st_size > STORE_COMPACT_RATIO * live:
+            _rewrite(container, index, member, data)
+        else:
+            _append(container, member, data)
+        _commit(container, lock_file)
+
+def read_member(path: str | Path) -> bytes:
+    """
+    Read the bytes of the last written copy of a member.
+    """
+    container, member = Path(path).parent, Path(path).name
+    container_file, info = _open_member(container, member)
+    with container_file:
+        if info is None:
+            raise KeyError(f"There is no item named {member!r} in the archive")
+        return _read_data(container_file, info)
+
+def member_identity(path: str | Path) -> str:
+    """
+    Identity of a member: the resolved container path, and the offset, size and CRC of the last written copy, which
+    change with every rewrite (as the size and mtime of a file do), and with the compactions of the container.
+    """
+    container, member = Path(path).parent, Path(path).name
+    container_file, info = _open_member(container, member)
+    container_file.close()
+    if info is None:
+        raise KeyError(f"There is no item named {member!r} in the archive")
+    return f"{container.resolve()}/{member}:{info.header_offset}:{info.file_size}:{info.CRC}"
+
+@contextmanager
+def _locked(container: Path, exclusive: bool) -> Iterator[IO[str]]:
+    """
+    Lock the container, exclusively or shared, for the threads of this process and for the other processes. Yields the
+    lock file, which holds the committed state of the container.
+    """
+    with _thread_locks_guard:
+        thread_lock = _thread_locks[container]
+    lock_path = container.with_name(f"{container.name}.lock")
+    with thread_lock, open(lock_path, "a+") as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield lock_file
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+def _open_member(container: Path, member: str) -> tuple[BinaryIO, zipfile.ZipInfo | None]:
+    """
+    Open the container in its committed state and look the member up (None if missing). The open file keeps that
+    state once the lock is released: appends only add bytes past it, and compactions replace the file.
+    """
+    with _locked(container, exclusive=False) as lock_file:
+        if not _torn(container, lock_file):
+            return open(container, "rb"), _index(container).get(member)
+    with _locked(container, exclusive=True) as lock_file:
+        _recover(container, lock_file)
+        return open(container, "rb"), _index(container).get(member)
+
+def _committed(lock_file: IO[str]) -> tuple[int, int] | None:
+    """
+    The inode and size of the container when it was last committed, None if never committed.
+    """
+    lock_file.seek(0)
+    state = lock_file.read().split()
+    return (int(state[0]), int(state[1])) if len(state) == 2 else None
+
+def _torn(container: Path, lock_file: IO[str]) -> bool:
+    """
+    Whether a writer died while appending to the container, leaving bytes past its committed size.
+    """
+    committed = _committed(lock_file)
+    if committed is None or not container.is_file():
+        return False
+    stat = container.stat()
+    return stat.st_ino == committed[0] and stat.st_size > committed[1]
+
+def _recover(container: Path, lock_file: IO[str]) -> None:
+    """
+    Cut off the partial write of a writer that died, back to the committed container. Needs the exclusive lock.
+    """
+    if _torn(container, lock_file):
+        os.truncate(container, _committed(lock_file)[1])  # type: ignore[index]
+
+def _commit(container: Path, lock_file: IO[str]) -> None:
+    stat = container.stat()
+    lock_file.truncate(0)
+    lock_file.write(f"{stat.st_ino} {stat.st_size}")
+    lock_file.flush()
+    os.fsync(lock_file.fileno())
+
+def _index(container: Path) -> dict[str, zipfile.ZipInfo]:
+    """
+    The last copy of each member of the container, by name, parsed again only when the container changed.
+    """
+    stat = container.stat()
+    version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _indexes.get(container)
+    if cached is None or cached[0] != version:
+        with zipfile.ZipFile(container) as zf:
+            cached = version, _latest(zf.infolist())
+        _indexes[container] = cached
+    return cached[1]
+
+def _stored_size(info: zipfile.ZipInfo) -> int:
+    return _LOCAL_HEADER.size + len(info.filename.encode()) + len(info.extra) + info.compress_size
+
+def _read_data(container_file: BinaryIO, info: zipfile.ZipInfo) -> bytes:
+    """
+    Read the bytes of a member stored as they are, from its local header.
+    """
+    container_file.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(container_file.read(_LOCAL_HEADER.size))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local header of member {info.filename!r}")
+    container_file.seek(header[-2] + header[-1], os.SEEK_CUR)
+    data = container_file.read(info.compress_size)
+    if zlib.crc32(data) != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 of member {info.filename!r}")
+    return data
+
+def _append(container: Path, member: str, data: bytes) -> None:
+    """
+    Append the member after the central directory of the container, then a new central directory without the
+    copies it supersedes.
+    """
+    with open(container, "r+b") as container_file:
+        with zipfile.ZipFile(container_file, "a", compression=zipfile.ZIP_STORED) as zf:
+            zf.start_dir = container_file.seek(0, os.SEEK_END)
+            zf.filelist = [info for name, info in _latest(zf.filelist).items() if name != member]
+            zf.NameToInfo.pop(member, None)
+            zf.writestr(member, data)
+        container_file.flush()
+        os.fsync(container_file.fileno())
+
+def _rewrite(container: Path, index: dict[str, zipfile.ZipInfo], member: str, data: bytes) -> None:
+    """
+    Write the latest copy of each member, and the new member, to a new container replacing the previous one.
+    """
+    tmp_path = container.with_name(f".{container.name}.tmp")
+    with open(tmp_path, "wb") as tmp_file:
+        with zipfile.ZipFile(tmp_file, "w", compression=zipfile.ZIP_STORED) as zf:
+            if index:
+                with open(container, "rb") as container_file:
+                    for name, info in index.items():
+                        if name != member:
+                            zf.writestr(zipfile.ZipInfo(name, date_time=info.date_time),
+                                        _read_data(container_file, info))
+            zf.writestr(member, data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, container)
+    dir_fd = os.open(container.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def _latest(infos: list[zipfile.ZipInfo]) -> dict[str, zipfile.ZipInfo]:
+    # Containers written before the compaction can list several copies of a member, the last one wins
+    return {info.filename: info for info in infos}
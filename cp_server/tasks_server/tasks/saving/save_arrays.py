@@ -1,14 +1,38 @@
+import importlib.util
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import TypeVar
+from typing import Any, TypeVar
 
 from numpy.typing import NDArray
 import numpy as np
 import tifffile as tiff
 
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.tasks.saving.mask_store import is_store_path, read_member, store_folder, write_member
+
 T = TypeVar("T", bound=np.generic)
 
+# Compression of the TIFF files written by each stage: "none", "zlib[:level]", "zstd[:level]", "lzw" or "packbits"
+MASK_COMPRESSION = os.getenv("MASK_COMPRESSION", "zlib")  # Masks written by the segmentation
+TRACK_MASK_COMPRESSION = os.getenv("TRACK_MASK_COMPRESSION", MASK_COMPRESSION)  # Masks rewritten by the tracking
+IMG_COMPRESSION = os.getenv("IMG_COMPRESSION", "zlib")  # Background-subtracted images
+CODECS = ("none", "zlib", "zstd", "lzw", "packbits")
+LEVEL_CODECS = ("zlib", "zstd")
+IMAGECODECS_CODECS = ("zstd", "lzw", "packbits")  # Only encoded by tifffile through the imagecodecs package
+# Number of threads decoding the masks of a FOV in parallel when loading them for the tracking
+MASK_LOADER_THREADS = int(os.getenv("MASK_LOADER_THREADS", 4))
+
+logger = get_logger(__name__)
+
 IMG_MARKERS = ("refseg", "measure")
 MASK_NAME = 'mask'
+TRACK_STATS_SUFFIX = '_tracks.npz'
+# Private TIFF tag marking background-subtracted images, holding the parameters as JSON
+BG_SUB_TAG = 65000
 
 def generate_mask_path(img_file: str, dst_folder: str) -> Path:
     """
@@ -18,13 +42,16 @@ def generate_mask_path(img_file: str, dst_folder: str) -> Path:
         img_file (str): The path to the image file.
         dst_folder (str): The destination folder where the mask will be saved (container path).
     Returns:
-        Path: The path where the mask will be saved.
+        Path: The path where the mask will be saved, inside the per-well container of the folder with MASK_STORAGE="well".
     """
     img_path = Path(img_file)
     
     # dst_folder is now a container path like "/data/A1_well/A1_masks"
-    save_dir = Path(dst_folder)
-    save_dir.mkdir(parents=True, exist_ok=True)
+    save_dir = store_folder(dst_folder)
+    if is_store_path(save_dir.joinpath(img_path.name)):
+        save_dir.parent.mkdir(parents=True, exist_ok=True)
+    else:
+        save_dir.mkdir(parents=True, exist_ok=True)
     
     # Extract the name of the image file and replace the marker with 'mask'
     name = img_path.name
@@ -64,15 +91,43 @@ def extract_fov_id(img_file: str) -> tuple[str, str]:
     
     raise ValueError(f"Could not extract FOV ID and timepoint from {img_path.name!r}")
 
-def save_mask(mask: NDArray[T], mask_path: str) -> None:
+@lru_cache
+def compression_kwargs(codec: str) -> dict[str, Any]:
+    """
+    Translate a codec setting into the compression arguments of tifffile.imwrite.
+    Codecs needing the imagecodecs package fall back to zlib, with a warning, when it isn't installed.
+    Args:
+        codec (str): "none", "zlib", "zstd", "lzw" or "packbits", with an optional level for zlib and zstd (e.g. "zstd:3").
+    Returns:
+        dict: The keyword arguments to pass to tifffile.imwrite.
+    """
+    name, _, level = codec.strip().lower().partition(":")
+    if name not in CODECS:
+        raise ValueError(f"Unknown compression codec {codec!r}, expected one of {CODECS}")
+    if level and name not in LEVEL_CODECS:
+        raise ValueError(f"Compression codec {name!r} doesn't take a level, only {LEVEL_CODECS} do")
+    if name == "none":
+        return {}
+    if name in IMAGECODECS_CODECS and importlib.util.find_spec("imagecodecs") is None:
+        logger.warning(f"Compression codec {name!r} requires the imagecodecs package, falling back to zlib")
+        return {"compression": "zlib"}
+    kwargs: dict[str, Any] = {"compression": name}
+    if level:
+        kwargs["compressionargs"] = {"level": int(level)}
+    return kwargs
+
+def save_mask(mask: NDArray[T], mask_path: str, compression: str = MASK_COMPRESSION) -> None:
     """
     Save the masks to a TIFF file. The masks are expected to be a 2D or 3D numpy array
     where each pixel value corresponds to a label of an object in the image.
-    The function determines the appropriate data type for the mask based on the maximum label value. Files are automatically compressed using zlib.
+    The function determines the appropriate data type for the mask based on the maximum label value. Files are compressed
+    with the given codec (MASK_COMPRESSION by default, see `compression_kwargs`). Masks addressed inside a per-well
+    container (see `mask_store`) are written to the container.
     Args:
         masks (np.ndarray): The mask array to save.
         img_file (str): The path to the original image file, used to determine the save directory.
         dst_folder (str): The destination folder where the mask will be saved.
+        compression (str, optional): The compression codec.
     """
     # Determine mask type based on the number of objects
     max_label = int(mask.max())
@@ -86,14 +141,125 @@ def save_mask(mask: NDArray[T], mask_path: str) -> None:
         raise ValueError(f"Too many objects in the mask: {max_label}. Cannot save as a mask.")
     
     # Save the masks
-    tiff.imwrite(mask_path, mask.astype(dtype), compression='zlib')
+    if is_store_path(mask_path):
+        buffer = io.BytesIO()
+        tiff.imwrite(buffer, mask.astype(dtype), **compression_kwargs(compression))
+        write_member(mask_path, buffer.getvalue())
+    else:
+        tiff.imwrite(mask_path, mask.astype(dtype), **compression_kwargs(compression))
+
+def _open_mask(mask_path: str) -> tiff.TiffFile:
+    if is_store_path(mask_path):
+        return tiff.TiffFile(io.BytesIO(read_member(mask_path)))
+    return tiff.TiffFile(mask_path)
+
+def load_mask(mask_path: str) -> NDArray:
+    """
+    Load a mask saved by `save_mask`, from its TIFF file or from its per-well container.
+    Args:
+        mask_path (str): The path of the mask.
+    Returns:
+        np.ndarray: The mask array.
+    """
+    with _open_mask(mask_path) as tif:
+        return tif.asarray()
+
+def load_masks(mask_paths: list[str], dtype: type[np.generic] = np.uint16) -> NDArray:
+    """
+    Load same-shaped masks into a single stack of the given dtype. The stack is allocated once and the masks are
+    decoded into it by MASK_LOADER_THREADS threads (the decompression releases the GIL), directly when a mask is
+    saved with the dtype of the stack, and otherwise through a single converting copy.
+    Args:
+        mask_paths (list[str]): The paths of the masks, in frame order.
+        dtype (type, optional): The dtype of the stack. Default to uint16.
+    Returns:
+        np.ndarray: The stack of masks, shape (n, *mask shape).
+    """
+    if not mask_paths:
+        return np.empty((0,), dtype=dtype)
+    with _open_mask(mask_paths[0]) as tif:
+        shape = tif.series[0].shape
+    stack = np.empty((len(mask_paths), *shape), dtype=dtype)
+
+    def _load_into(index: int) -> None:
+        with _open_mask(mask_paths[index]) as tif:
+            series = tif.series[0]
+            if series.shape != shape:
+                raise ValueError(f"Mask {mask_paths[index]} has shape {series.shape}, expected {shape}")
+            if series.dtype == stack.dtype:
+                tif.asarray(out=stack[index])
+            else:
+                stack[index] = tif.asarray()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MASK_LOADER_THREADS, len(mask_paths)))) as executor:
+        list(executor.map(_load_into, range(len(mask_paths))))
+    return stack
     
-def save_img(img: NDArray[T], img_file: str) -> None:
+def save_img(img: NDArray[T], img_file: str, bg_sub_params: dict[str, Any] | None = None,
+             compression: str = IMG_COMPRESSION) -> None:
     """
     Save the image to a TIFF file. The image is expected to be a 2D or 3D numpy array.
-    Files are automatically compressed using zlib.
+    Files are compressed with the given codec (IMG_COMPRESSION by default). The file is written next to its final location and then moved,
+    so an interrupted task never leaves a partially written image behind. An image overwritten with its background-subtracted
+    version keeps its modification time.
     Args:
         img (np.ndarray): The image array to save.
         img_file (str): The path where the image will be saved.
+        bg_sub_params (dict, optional): If given, the image is marked as background-subtracted with these parameters.
+        compression (str, optional): The compression codec.
+    """
+    extratags = []
+    if bg_sub_params is not None:
+        extratags.append((BG_SUB_TAG, 's', 0, json.dumps(bg_sub_params), True))
+    tmp_path = Path(img_file).with_name(f".{Path(img_file).name}.tmp")
+    tiff.imwrite(tmp_path, img.astype("uint16"), extratags=extratags, **compression_kwargs(compression))
+    if bg_sub_params is not None and Path(img_file).exists():
+        # The corrected image keeps the modification time of the acquisition, which identifies it (see the
+        # deduplication of /process)
+        stat = os.stat(img_file)
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    tmp_path.replace(img_file)
+
+def read_bg_sub_params(img_file: str) -> dict[str, Any] | None:
+    """
+    Read the background subtraction marker of a TIFF file, without loading the image data.
+    Args:
+        img_file (str): The path to the image file.
+    Returns:
+        dict | None: The parameters of the background subtraction, or None if the image was not background-subtracted.
+    """
+    with tiff.TiffFile(img_file) as tif:
+        tag = tif.pages[0].tags.get(BG_SUB_TAG)  # type: ignore[union-attr]
+        return json.loads(tag.value) if tag is not None else None
+
+def generate_track_stats_path(mask_file: str) -> Path:
+    """
+    Generate the path of the per-track statistics of a FOV, next to its masks.
+    The mask file name is expected in the format '<FOVID>_mask_[1-9].tif', so the statistics will be saved as '<FOVID>_tracks.npz'.
+    Args:
+        mask_file (str): The path to one of the mask files of the FOV.
+    Returns:
+        Path: The path where the statistics will be saved.
+    """
+    fov_id, _ = extract_fov_id(mask_file)
+    return Path(mask_file).parent.joinpath(f"{fov_id}{TRACK_STATS_SUFFIX}")
+
+def save_track_stats(stats: dict[str, NDArray], stats_path: str, mask_paths: list[str]) -> None:
+    """
+    Save the per-track statistics as an uncompressed .npz file, one array per column, so that a single column can be
+    loaded without the others (np.load is lazy). The mask paths are stored as well, indexed by the 'frame' column.
+    The file is written next to its final location and then moved, so readers never see a partial file. Next to masks
+    stored in a per-well container, the statistics are stored in the container as well.
+    Args:
+        stats (dict[str, np.ndarray]): The columns of the statistics table.
+        stats_path (str): The path where the statistics will be saved.
+        mask_paths (list[str]): The paths of the masks, in frame order.
     """
-    tiff.imwrite(img_file, img.astype("uint16"), compression='zlib')
\ No newline at end of file
+    if is_store_path(stats_path):
+        buffer = io.BytesIO()
+        np.savez(buffer, mask_paths=np.array(mask_paths), **stats)
+        write_member(stats_path, buffer.getvalue())
+        return
+    tmp_path = Path(stats_path).with_suffix(".tmp.npz")
+    np.savez(tmp_path, mask_paths=np.array(mask_paths), **stats)
+    tmp_path.replace(stats_path)
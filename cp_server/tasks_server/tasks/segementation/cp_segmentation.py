@@ -1,7 +1,7 @@
 from __future__ import annotations
 import threading
 import warnings
-from typing import Any, TypeVar
+from typing import Any, Callable, TypeVar
 from concurrent.futures import ThreadPoolExecutor
 
 from numpy.typing import NDArray
@@ -25,7 +25,10 @@ logger = get_logger(__name__)
 #########################################################################
 ########################## Main Function ################################
 #########################################################################
-def segment_image(img: NDArray[T] | list[NDArray[T]], cellpose_settings: dict[str, Any]) -> NDArray[T] | list[NDArray[T]]:
+def segment_image(img: NDArray[T] | list[NDArray[T]],
+                  cellpose_settings: dict[str, Any],
+                  on_mask: Callable[[int, NDArray[T]], None] | None = None,
+                  ) -> NDArray[T] | list[NDArray[T]]:
     """
     Generic segmentation interface for Cellpose using persistent model management.
     Uses model_manager to cache and reuse models for efficiency.
@@ -34,6 +37,8 @@ def segment_image(img: NDArray[T] | list[NDArray[T]], cellpose_settings: dict[st
         img: Single image or list of images (np.ndarray or list of np.ndarray)
         cellpose_settings: Dict of cellpose-kit settings
         threads: Number of threads for batch processing (default 1 = no threading)
+        on_mask: Optional callback receiving the index and the mask of each image as soon as it is segmented,
+            e.g. to start writing it while the rest of the batch is still running
     Returns:
         Segmentation mask(s) (same type/shape as input)
     """
@@ -43,14 +48,18 @@ def segment_image(img: NDArray[T] | list[NDArray[T]], cellpose_settings: dict[st
     configured_settings = model_manager.get_configured_settings(cellpose_settings)
     if isinstance(img, list):
         logger.info(f"Running segment_image on batch with settings: {cellpose_settings}, threads={DEFAULT_SEGMENT_THREADS}")
-        def _seg_single(im: NDArray[T]) -> NDArray[T]:
+        def _seg_single(index: int, im: NDArray[T]) -> NDArray[T]:
             masks, *_ = run_cellpose(im, configured_settings)
             assert isinstance(masks, np.ndarray), f"Expected NDArray but got {type(masks)}"
+            if on_mask is not None:
+                on_mask(index, masks)
             return masks
         with ThreadPoolExecutor(max_workers=DEFAULT_SEGMENT_THREADS) as executor:
-            results = list(executor.map(_seg_single, img))
+            results = list(executor.map(_seg_single, range(len(img)), img))
         return results 
     else:
         logger.info(f"Running segment_image on single image with settings: {cellpose_settings}")
         masks, *_ = run_cellpose(img, configured_settings)
+        if on_mask is not None:
+            on_mask(0, masks)
         return masks
\ No newline at end of file
@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+from redis import RedisError
+
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.utils.redis_com import redis_client
+
+
+# Number of recent segmentation tasks whose latency is kept
+SEG_LATENCY_SAMPLES = int(os.getenv("SEG_LATENCY_SAMPLES", 20))
+SEG_LATENCY_KEY = "latency:segment"
+
+logger = get_logger(__name__)
+
+
+def record_seg_latency(seconds: float, pixels: int) -> None:
+    """
+    Record the duration of a segmentation task, as seconds per megapixel so that tasks of different image sizes and
+    batch sizes can be compared. Only the last SEG_LATENCY_SAMPLES are kept. Failures are logged and otherwise ignored.
+    """
+    if pixels <= 0:
+        return
+    try:
+        pipe = redis_client.pipeline()
+        pipe.lpush(SEG_LATENCY_KEY, seconds / pixels * 1e6)
+        pipe.ltrim(SEG_LATENCY_KEY, 0, SEG_LATENCY_SAMPLES - 1)
+        pipe.execute()
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not record the segmentation latency: {e}")
+
+def seg_latency() -> float | None:
+    """
+    Median segmentation latency of the recent tasks, in seconds per megapixel.
+    Returns None when no task was recorded yet (or Redis is unavailable).
+    """
+    try:
+        samples = redis_client.lrange(SEG_LATENCY_KEY, 0, -1)
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not read the segmentation latency: {e}")
+        return None
+    if not samples:
+        return None
+    return float(np.median([float(sample) for sample in samples]))  # type: ignore[union-attr]
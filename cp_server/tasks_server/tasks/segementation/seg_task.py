@@ -1,14 +1,22 @@
-from typing import Any, TypeVar
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, TypeVar
 
-from celery import shared_task
+from celery import Task, shared_task
+from celery.exceptions import Ignore
 from numpy.typing import NDArray
 import numpy as np
 from tifffile import imread
 
 from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.tasks.bg_sub.bg_sub_task import bg_sub_params, load_bg_sub, save_bg_img_async
 from cp_server.tasks_server.tasks.saving.save_arrays import generate_mask_path, save_mask, extract_fov_id
 from cp_server.tasks_server.utils.redis_com import redis_client
 from cp_server.tasks_server.tasks.segementation.cp_segmentation import segment_image
+from cp_server.tasks_server.tasks.segementation.seg_latency import record_seg_latency
+from cp_server.tasks_server.utils.failures import clear_failures, retry_later
+from cp_server.tasks_server.utils.progress import SEGMENTED, record_stage
 
 ##### Lazy imports #######
 # from cellpose_kit import MODEL_NAMES, cp_version
@@ -16,65 +24,83 @@ from cp_server.tasks_server.tasks.segementation.cp_segmentation import segment_i
 
 T = TypeVar("T", bound=np.generic)
 
+# Number of threads writing and registering the masks of a batch while the rest of it is segmented
+MASK_WRITER_THREADS = int(os.getenv("MASK_WRITER_THREADS", 2))
+
 logger = get_logger(__name__)
 
-@shared_task(name="cp_server.tasks_server.tasks.segementation.seg_task.segment")
-def segment(img_path: str | list[str], cellpose_settings: dict[str, Any], dst_folder: str, well_id: str,) -> str | list[str]:
+_mask_writer = ThreadPoolExecutor(max_workers=MASK_WRITER_THREADS, thread_name_prefix="mask_writer")
+
+@shared_task(bind=True, name="cp_server.tasks_server.tasks.segementation.seg_task.segment")
+def segment(self: Task,
+            img_path: str | list[str],
+            cellpose_settings: dict[str, Any],
+            dst_folder: str,
+            well_id: str,
+            attempt: int=0,
+            ) -> str | list[str]:
     """
     Segment one or more images using Cellpose with persistent model loading via cellpose-kit.
+    In a batch, an image that can't be read or segmented doesn't fail the others: their masks are saved and
+    registered, and the failed image is retried alone by a later run of the task (see `_segment_items`).
     Args:
         img_path (str | list[str]): Path(s) to the image file(s).
         cellpose_settings (dict): Settings for the Cellpose model and segmentation.
         dst_folder (str): Destination folder where the masks will be saved.
         well_id (str): Unique identifier for the processing run.
+        attempt (int): Number of times the images were already retried, set by the retries (see `retry_later`).
     Returns:
-        str or list[str]: Redis key(s) for the stored mask(s).
+        str or list[str]: Redis key(s) for the stored mask(s), of the images that were segmented.
     """
-    if isinstance(img_path, list):
-        logger.info(f"Batch segmenting {len(img_path)} images with settings: {cellpose_settings}")
-        imgs = []
-        for p in img_path:
-            try:
-                img = imread(p)
-                logger.debug(f"Loaded image from {p} with shape {img.shape} and dtype {img.dtype}")
-                imgs.append(img)
-            except Exception as e:
-                logger.error(f"Failed to read image from {p}: {e}")
-                raise
-        try:
-            masks = segment_image(imgs, cellpose_settings)
-        except Exception as e:
-            logger.error(f"Batch segmentation failed: {e}")
-            raise
-        assert isinstance(masks, list) and len(masks) == len(img_path), "Batch output mismatch"
-        hkeys = []
-        for mask, p in zip(masks, img_path):
-            mask_path = generate_mask_path(p, dst_folder)
-            save_mask(mask, str(mask_path))
-            hkey = _register_mask_in_redis(str(mask_path), p, well_id)
-            hkeys.append(hkey)
-        return hkeys
-    else:
-        logger.info(f"Initializing segmentation for {img_path} with settings: {cellpose_settings}")
-        try:
-            img = imread(img_path)
-            logger.debug(f"Loaded image from {img_path} with shape {img.shape} and dtype {img.dtype}")
-        except Exception as e:
-            logger.error(f"Failed to read image from {img_path}: {e}")
-            raise
-        try:
-            mask = segment_image(img, cellpose_settings)
-        except Exception as e:
-            logger.error(f"Segmentation failed for {img_path}: {e}")
-            raise
-        assert not isinstance(mask, list), f"Expected single mask but got list of {len(mask)} masks"
-        logger.debug(f"Created masks of {mask.shape=}")
-        mask_path = generate_mask_path(img_path, dst_folder)
-        save_mask(mask, str(mask_path))
-    hkey = _register_mask_in_redis(str(mask_path), img_path, well_id)
-    return hkey
+    img_paths = img_path if isinstance(img_path, list) else [img_path]
+    logger.info(f"Segmenting {len(img_paths)} image(s) with settings: {cellpose_settings}")
+    hkeys = _segment_items(self, img_paths, imread, cellpose_settings, dst_folder, well_id, attempt)
+    return hkeys if isinstance(img_path, list) else hkeys[0]
+
+@shared_task(bind=True, name="cp_server.tasks_server.tasks.segementation.seg_task.bg_sub_and_segment")
+def bg_sub_and_segment(self: Task,
+                       img_path: str | list[str],
+                       cellpose_settings: dict[str, Any],
+                       dst_folder: str,
+                       well_id: str,
+                       sigma: float=0.0,
+                       size: int=7,
+                       bin_factor: int=1,
+                       save_bg_img: bool=True,
+                       attempt: int=0,
+                       ) -> str | list[str]:
+    """
+    Remove the background and segment one or more images in a single task, handing the corrected images to Cellpose
+    in memory instead of writing them to disk for `segment` to read them back. Failures of single images are
+    handled as in `segment`.
+    Args:
+        img_path (str | list[str]): Path(s) to the image file(s).
+        cellpose_settings (dict): Settings for the Cellpose model and segmentation.
+        dst_folder (str): Destination folder where the masks will be saved.
+        well_id (str): Unique identifier for the processing run.
+        sigma (float): Sigma value for background subtraction.
+        size (int): Size parameter for background subtraction.
+        bin_factor (int): Binning factor of the images on which the background is estimated, 1 for no binning.
+        save_bg_img (bool): If True, the images are overwritten with their background-subtracted version, from
+            background threads so the segmentation doesn't wait for them. Images already marked as
+            background-subtracted are segmented as they are.
+        attempt (int): Number of times the images were already retried, set by the retries (see `retry_later`).
+    Returns:
+        str or list[str]: Redis key(s) for the stored mask(s), of the images that were segmented.
+    """
+    img_paths = img_path if isinstance(img_path, list) else [img_path]
+    logger.info(f"Removing background and segmenting {len(img_paths)} image(s) with settings: {cellpose_settings}")
+
+    def _load_bg_sub(p: str) -> NDArray:
+        bg_img, subtracted = load_bg_sub(p, sigma, size, bin_factor)
+        if save_bg_img and subtracted:
+            save_bg_img_async(bg_img, p, bg_sub_params(sigma, size, bin_factor))
+        return bg_img
 
-@shared_task(name="cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings")
+    hkeys = _segment_items(self, img_paths, _load_bg_sub, cellpose_settings, dst_folder, well_id, attempt)
+    return hkeys if isinstance(img_path, list) else hkeys[0]
+
+@shared_task(name="cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings", ignore_result=False)
 def optimize_cellpose_settings(img: NDArray[T], cellpose_settings: dict[str, Any]) -> NDArray[T]:
     """
     Optimize Cellpose settings for a given image.
@@ -94,13 +120,122 @@ def optimize_cellpose_settings(img: NDArray[T], cellpose_settings: dict[str, Any
         logger.error(f"Optimization failed: {e}")
         raise
 
-@shared_task(name="cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata")
+@shared_task(name="cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata", ignore_result=False)
 def cellpose_metadata() -> dict[str, Any]:
     from cellpose_kit import MODEL_NAMES, cp_version
     return {
         "model_names": MODEL_NAMES,
         "version": cp_version,}
 
+def _segment_items(task: Task,
+                   img_paths: list[str],
+                   load_image: Callable[[str], NDArray],
+                   cellpose_settings: dict[str, Any],
+                   dst_folder: str,
+                   well_id: str,
+                   attempt: int,
+                   ) -> list[str]:
+    """
+    Segment a batch of images, tolerating the failure of single images. The images are loaded and segmented
+    together (each alone in a retry), the mask of every image that succeeds is saved and registered, and the failed
+    images are retried by a later run of the task (`retry_later`), so the images already done are never segmented
+    again and the worker never waits for the retry.
+    Returns the Redis keys of the images that succeeded, in order. If none did, raises their error, or `Ignore` when
+    they are retried, the retry then going on with the chain.
+    """
+    persisted: dict[str, str] = {}
+    errors: dict[str, Exception] = {}
+    for batch in ([img_paths] if attempt == 0 else [[p] for p in img_paths]):
+        done, failed = _try_segment(batch, load_image, cellpose_settings, dst_folder, well_id)
+        persisted.update(done)
+        errors.update(failed)
+    retried = bool(errors) and retry_later(task, errors, attempt, "segment")
+    if not persisted and errors:
+        if retried:
+            raise Ignore()
+        raise next(iter(errors.values()))
+    clear_failures(list(persisted))
+    return [persisted[p] for p in img_paths if p in persisted]
+
+def _try_segment(img_paths: list[str],
+                 load_image: Callable[[str], NDArray],
+                 cellpose_settings: dict[str, Any],
+                 dst_folder: str,
+                 well_id: str,
+                 ) -> tuple[dict[str, str], dict[str, Exception]]:
+    """
+    Load the images and segment the loaded ones in a single batch.
+    Returns the Redis keys of the images whose mask was saved, and the errors of the others, by image path.
+    """
+    imgs, loaded, errors = [], [], {}
+    for p in img_paths:
+        try:
+            img = load_image(p)
+            logger.debug(f"Loaded image from {p} with shape {img.shape} and dtype {img.dtype}")
+        except Exception as e:
+            logger.error(f"Failed to read image from {p}: {e}")
+            errors[p] = e
+            continue
+        imgs.append(img)
+        loaded.append(p)
+
+    persisted: dict[str, str] = {}
+    if loaded:
+        try:
+            _segment_and_persist(imgs if len(imgs) > 1 else imgs[0], loaded, cellpose_settings, dst_folder, well_id,
+                                 persisted, errors)
+        except Exception as e:
+            logger.error(f"Segmentation failed for {loaded}: {e}")
+            errors.update({p: e for p in loaded if p not in persisted and p not in errors})
+    return persisted, errors
+
+def _segment_and_persist(img: NDArray[T] | list[NDArray[T]],
+                         img_paths: list[str],
+                         cellpose_settings: dict[str, Any],
+                         dst_folder: str,
+                         well_id: str,
+                         persisted: dict[str, str],
+                         errors: dict[str, Exception],
+                         ) -> None:
+    """
+    Segment the image(s) and hand each mask to the mask writer threads as soon as it is ready, so the compression,
+    the disk and Redis overlap with the inference of the rest of the batch. The overlap is only within the batch:
+    this returns once every mask is written and registered, so the task still holds the GPU worker for the writes of
+    the last masks, and the Redis keys it returns always point to masks on disk.
+    The Redis key of each mask written is added to `persisted` and the error of each mask that couldn't be written to
+    `errors`, by image path, even when the segmentation fails midway.
+    The duration is recorded as the latency of the segmentation, from which the batches are chunked.
+    """
+    futures: dict[int, Future] = {}
+    start = time.perf_counter()
+
+    def _write_behind(index: int, mask: NDArray[T]) -> None:
+        futures[index] = _mask_writer.submit(_persist_mask, mask, img_paths[index], dst_folder, well_id)
+
+    try:
+        masks = segment_image(img, cellpose_settings, on_mask=_write_behind)
+    finally:
+        # Let the masks already handed over land, even if the segmentation of the others failed
+        wait(futures.values())
+        for index, future in futures.items():
+            if future.exception() is None:
+                persisted[img_paths[index]] = future.result()
+            else:
+                logger.error(f"Failed to save the mask of {img_paths[index]}: {future.exception()}")
+                errors[img_paths[index]] = future.exception()  # type: ignore[assignment]
+    n_masks = len(masks) if isinstance(masks, list) else 1
+    assert n_masks == len(img_paths) == len(futures), "Batch output mismatch"
+    pixels = sum(i.size for i in img) if isinstance(img, list) else img.size
+    record_seg_latency(time.perf_counter() - start, pixels)
+
+def _persist_mask(mask: NDArray[T], img_path: str, dst_folder: str, well_id: str) -> str:
+    logger.debug(f"Saving mask of {mask.shape=} for {img_path}")
+    mask_path = generate_mask_path(img_path, dst_folder)
+    save_mask(mask, str(mask_path))
+    hkey = _register_mask_in_redis(str(mask_path), img_path, well_id)
+    record_stage(well_id, [img_path], SEGMENTED, {str(mask_path): img_path})
+    return hkey
+
 def _register_mask_in_redis(mask_path: str, img_path: str, well_id: str) -> str:
     fov_id, time_id = extract_fov_id(img_path)
     hkey = f"masks:{well_id}:{fov_id}"
@@ -0,0 +1,114 @@
+import hashlib
+import io
+import os
+from pathlib import Path
+
+import numpy as np
+from redis import RedisError
+
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.tasks.saving.mask_store import is_store_path, member_identity
+from cp_server.tasks_server.utils.redis_com import redis_client
+
+
+OVERLAP_CACHE_TTL = int(os.getenv("OVERLAP_CACHE_TTL", 24 * 3600))
+
+logger = get_logger(__name__)
+
+
+def file_identity(path: str) -> str:
+    """
+    Identity of a mask file on disk: its resolved path, size and modification time.
+    Any rewrite of the file changes the identity, so stale tables can never be served.
+    Masks stored in a per-well container are identified by their member instead (see `member_identity`).
+    """
+    if is_store_path(path):
+        return member_identity(path)
+    stat = os.stat(path)
+    return f"{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def _cache_key(next_path: str, prev_path: str) -> str:
+    digest = hashlib.sha1(f"{file_identity(next_path)}|{file_identity(prev_path)}".encode()).hexdigest()
+    return f"overlap:{digest}"
+
+def _stats_key(path: str) -> str:
+    return f"labelstats:{hashlib.sha1(file_identity(path).encode()).hexdigest()}"
+
+def _encode_table(table: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, table.astype(np.uint32), allow_pickle=False)
+    return buffer.getvalue()
+
+def _decode_table(raw: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(raw), allow_pickle=False).astype(np.int64)
+
+def _encode_stats(stats: tuple[np.ndarray, np.ndarray, np.ndarray]) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, *stats)
+    return buffer.getvalue()
+
+def _decode_stats(raw: bytes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    with np.load(io.BytesIO(raw), allow_pickle=False) as arrays:
+        return arrays["arr_0"], arrays["arr_1"], arrays["arr_2"]
+
+def load_overlaps(mask_paths: list[str]) -> list[np.ndarray | None]:
+    """
+    Fetch the cached overlap tables for each consecutive pair of mask files.
+    Returns one entry per pair, None when the table is not cached (or Redis is unavailable).
+    """
+    pairs = len(mask_paths) - 1
+    if pairs < 1:
+        return []
+    try:
+        keys = [_cache_key(mask_paths[i + 1], mask_paths[i]) for i in range(pairs)]
+        raw_tables = redis_client.mget(keys)
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not read the overlap cache, computing all tables: {e}")
+        return [None] * pairs
+
+    tables = [_decode_table(raw) if raw is not None else None for raw in raw_tables]  # type: ignore[union-attr]
+    logger.debug(f"Overlap cache hits: {sum(t is not None for t in tables)}/{pairs}")
+    return tables
+
+def store_overlaps(mask_paths: list[str], overlaps: list[np.ndarray]) -> None:
+    """
+    Cache the overlap tables of each consecutive pair of mask files, keyed by the current identity of the files.
+    Must be called after the files have been written. Failures are logged and otherwise ignored.
+    """
+    try:
+        pipe = redis_client.pipeline()
+        for i, table in enumerate(overlaps):
+            pipe.set(_cache_key(mask_paths[i + 1], mask_paths[i]), _encode_table(table), ex=OVERLAP_CACHE_TTL)
+        pipe.execute()
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not store the overlap tables in the cache: {e}")
+
+def load_label_stats(mask_paths: list[str]) -> list[tuple[np.ndarray, np.ndarray, np.ndarray] | None]:
+    """
+    Fetch the cached label statistics (see `frame_label_stats`) of each mask file.
+    Returns one entry per file, None when they are not cached (or Redis is unavailable).
+    """
+    if not mask_paths:
+        return []
+    try:
+        raw_stats = redis_client.mget([_stats_key(path) for path in mask_paths])
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not read the label statistics cache, computing all of them: {e}")
+        return [None] * len(mask_paths)
+
+    stats = [_decode_stats(raw) if raw is not None else None for raw in raw_stats]  # type: ignore[arg-type]
+    logger.debug(f"Label statistics cache hits: {sum(s is not None for s in stats)}/{len(mask_paths)}")
+    return stats
+
+def store_label_stats(mask_paths: list[str], stats: list[tuple[np.ndarray, np.ndarray, np.ndarray]]) -> None:
+    """
+    Cache the label statistics of each mask file, keyed by the current identity of the file.
+    Must be called after the files have been written. Failures are logged and otherwise ignored.
+    """
+    try:
+        pipe = redis_client.pipeline()
+        for path, frame_stats in zip(mask_paths, stats):
+            pipe.set(_stats_key(path), _encode_stats(frame_stats), ex=OVERLAP_CACHE_TTL)
+        pipe.execute()
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not store the label statistics in the cache: {e}")
@@ -1,63 +1,347 @@
+import time
+from typing import Any, Callable
+
 import numpy as np
 from numba import jit
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage.segmentation import relabel_sequential
 
+# Bounding boxes, areas and coordinate sums of the labels of a frame, as returned by `_label_stats`
+LabelStats = tuple[np.ndarray, np.ndarray, np.ndarray]
+
 
 ############### Main Function ################
-def track_masks(masks: np.ndarray, track_stitch_threshold: float=0.25) -> np.ndarray:
+def track_masks(masks: np.ndarray, track_stitch_threshold: float=0.25, overlaps: list[np.ndarray] | None=None, overlap_mode: str="dense", matching: str="greedy") -> np.ndarray:
     """
     Track cells over time by stitching 2D masks into a time sequence using a stitch_threshold on IOU. Incomplete tracks are also automatically trimmed.
 
     Args:
         masks (ndarray): stack of masks, where masks[t] is a 2D array of masks at time t.
         stitch_threshold (float, optional): Threshold value for stitching. Defaults to 0.25.
+        overlaps (list[ndarray], optional): Precomputed overlap tables between consecutive frames, see `frame_overlaps`. Missing entries are computed from the masks.
+        overlap_mode (str, optional): How the missing overlap tables are computed, see `frame_overlaps`. Defaults to "dense".
+        matching (str, optional): How the masks of consecutive frames are matched, see `track_luts`. Defaults to "greedy".
 
     Returns:
         ndarray: stitched masks.
     """
-    stitched_masks = _stitch_frames(masks, track_stitch_threshold)
-    trimmed_mask = _trim_incomplete_tracks(stitched_masks)
-    return relabel_sequential(trimmed_mask)[0]
+    if len(masks) < 2:
+        return relabel_sequential(masks)[0]
+
+    overlaps = frame_overlaps(masks, overlaps, overlap_mode)
+    luts = track_luts(overlaps, track_stitch_threshold, matching)
+    return apply_luts(masks, luts)
+
+def frame_overlaps(masks: np.ndarray, cached: list[np.ndarray | None] | None=None, overlap_mode: str="dense",
+                   stats: list[LabelStats] | None=None) -> list[np.ndarray]:
+    """
+    Build the overlap tables between consecutive frames of the original (untracked) masks. This is the only step
+    of the tracking that has to go through every pixel, the stitching itself only works on the tables.
+
+    Two modes produce the exact same tables:
+        - "dense": count every pixel pair of the two frames. Best for crowded fields of view.
+        - "bbox": only count pixels inside the bounding box of each label. Much faster on large, sparse images,
+          where most label pairs can't possibly touch.
+
+    Args:
+        masks (ndarray): stack of masks, where masks[t] is a 2D array of masks at time t.
+        cached (list[ndarray | None], optional): Already known tables, one per frame pair. None entries are computed.
+        overlap_mode (str, optional): Either "dense" or "bbox". Defaults to "dense".
+        stats (list[LabelStats], optional): Statistics of the labels of each frame (see `frame_label_stats`), reused by
+            the "bbox" mode instead of being computed again.
+
+    Returns:
+        list[ndarray]: One table per frame pair (t+1, t), each of shape (k, 3) with the columns (label at t+1, label at t, pixel count).
+    """
+    if overlap_mode not in OVERLAP_MODES:
+        raise ValueError(f"Unknown overlap mode {overlap_mode!r}, expected one of {tuple(OVERLAP_MODES)}")
+    compute_overlap = OVERLAP_MODES[overlap_mode]
+
+    if cached is None:
+        cached = [None] * (len(masks) - 1)
+    if stats is None:
+        stats = [None] * len(masks)
+    return [table if table is not None else compute_overlap(masks[i + 1], masks[i], stats[i + 1], stats[i])
+            for i, table in enumerate(cached)]
+
+def frame_label_stats(masks: np.ndarray, cached: list[LabelStats | None] | None=None) -> list[LabelStats]:
+    """
+    Statistics (bounding box, area and sum of the coordinates, see `_label_stats`) of the labels of each frame.
+    None entries of `cached` are computed, with a single compiled pass over the frame.
+    """
+    if cached is None:
+        cached = [None] * len(masks)
+    return [frame_stats if frame_stats is not None else _label_stats(masks[t]) for t, frame_stats in enumerate(cached)]
+
+def track_luts(overlaps: list[np.ndarray], track_stitch_threshold: float, matching: str="greedy") -> list[np.ndarray]:
+    """
+    Compute, for every frame, the lookup table mapping the original labels to the final track labels.
+    Stitching, trimming of incomplete tracks and sequential relabeling are all resolved on the overlap tables.
+
+    Two matching engines are available:
+        - "greedy": each mask takes the previous mask it overlaps the most, as in cellpose stitch3D.
+        - "assignment": optimal one-to-one assignment maximizing the total IOU, solved on the sparse set of
+          overlapping pairs, one connected group of cells at a time.
+
+    Args:
+        overlaps (list[ndarray]): Overlap tables between consecutive frames, see `frame_overlaps`.
+        track_stitch_threshold (float): Threshold value for stitching.
+        matching (str, optional): Either "greedy" or "assignment". Defaults to "greedy".
+
+    Returns:
+        list[ndarray]: One lookup table per frame, where lut[label] is the tracked label (0 if trimmed).
+    """
+    if matching not in MATCHINGS:
+        raise ValueError(f"Unknown matching {matching!r}, expected one of {tuple(MATCHINGS)}")
+    stitch_luts = _stitch_frames(overlaps, track_stitch_threshold, MATCHINGS[matching])
+    return _trim_incomplete_tracks(stitch_luts, overlaps)
+
+def apply_luts(masks: np.ndarray, luts: list[np.ndarray]) -> np.ndarray:
+    """
+    Relabel each frame of the stack with its lookup table. The input masks are not modified.
+    """
+    tracked = np.empty_like(masks)
+    for t, lut in enumerate(luts):
+        tracked[t] = lut.astype(masks.dtype)[masks[t]]
+    return tracked
+
+def project_overlaps(overlaps: list[np.ndarray], luts: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    Translate the overlap tables of the original masks into the overlap tables of the tracked masks.
+    Every pixel keeps its pair of labels, only renamed through the lookup tables, so the result is exact
+    and no pixel needs to be read again.
+
+    Args:
+        overlaps (list[ndarray]): Overlap tables of the original masks.
+        luts (list[ndarray]): Lookup tables returned by `track_luts`.
+
+    Returns:
+        list[ndarray]: Overlap tables of the tracked masks.
+    """
+    projected = []
+    for i, table in enumerate(overlaps):
+        projected.append(_aggregate_pairs(luts[i + 1][table[:, 0]], luts[i][table[:, 1]], table[:, 2]))
+    return projected
+
+def project_stats(stats: list[LabelStats], luts: list[np.ndarray]) -> list[LabelStats]:
+    """
+    Translate the label statistics of the original masks into those of the tracked masks, as `project_overlaps`
+    does for the overlap tables: areas and coordinate sums add up, bounding boxes merge, trimmed labels are dropped.
+    The result is exact, and no pixel needs to be read again.
+    """
+    projected = []
+    for (boxes, areas, sums), lut in zip(stats, luts):
+        labels = np.nonzero(areas)[0]
+        tracked = lut[labels].astype(np.int64)
+        kept = tracked > 0
+        labels, tracked = labels[kept], tracked[kept]
+        n_labels = int(tracked.max(initial=0)) + 1
+        tracked_boxes = np.empty((n_labels, 4), dtype=np.int64)
+        tracked_boxes[:, :2] = np.iinfo(np.int64).max
+        tracked_boxes[:, 2:] = -1
+        np.minimum.at(tracked_boxes[:, :2], tracked, boxes[labels, :2])
+        np.maximum.at(tracked_boxes[:, 2:], tracked, boxes[labels, 2:])
+        tracked_areas = np.zeros(n_labels, dtype=np.int64)
+        np.add.at(tracked_areas, tracked, areas[labels])
+        tracked_sums = np.zeros((n_labels, 2), dtype=np.int64)
+        np.add.at(tracked_sums, tracked, sums[labels])
+        projected.append((tracked_boxes, tracked_areas, tracked_sums))
+    return projected
+
+def stats_columns(stats: list[LabelStats]) -> dict[str, np.ndarray]:
+    """
+    Per-track statistics of the tracked masks from the label statistics of each frame (see `project_stats`), one
+    row per (label, frame), in a columnar layout.
+
+    Returns:
+        dict[str, ndarray]: Columns 'label', 'frame', 'area', 'centroid_y', 'centroid_x' and 'bbox_min_y', 'bbox_min_x',
+        'bbox_max_y', 'bbox_max_x' (max exclusive, as in skimage regionprops), sorted by frame then label.
+    """
+    columns: dict[str, list[np.ndarray]] = {name: [] for name in TRACK_STATS_COLUMNS}
+    for t, (boxes, areas, sums) in enumerate(stats):
+        labels = np.nonzero(areas)[0]
+        columns["label"].append(labels)
+        columns["frame"].append(np.full(len(labels), t, dtype=np.int64))
+        columns["area"].append(areas[labels])
+        columns["centroid_y"].append(sums[labels, 0] / areas[labels])
+        columns["centroid_x"].append(sums[labels, 1] / areas[labels])
+        columns["bbox_min_y"].append(boxes[labels, 0])
+        columns["bbox_min_x"].append(boxes[labels, 1])
+        columns["bbox_max_y"].append(boxes[labels, 2] + 1)
+        columns["bbox_max_x"].append(boxes[labels, 3] + 1)
+    return {name: np.concatenate(values) for name, values in columns.items()}
+
+def track_stats(tracked: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Per-track statistics of the tracked masks (see `stats_columns`), computed with a single compiled pass per frame.
+    `track_cells` instead projects the statistics of the original masks, without reading the tracked pixels.
+
+    Args:
+        tracked (ndarray): stack of tracked masks, as returned by `track_masks`.
+    """
+    return stats_columns(frame_label_stats(tracked))
+
+def warm_up_kernels() -> dict[str, float]:
+    """
+    Compile the numba kernels for the uint16 masks used by `track_cells`, or load them from the on-disk cache
+    (see NUMBA_CACHE_DIR) when it is available. Meant to be called when a worker process starts, so that the first
+    tracking task doesn't pay for the compilation.
+
+    Returns:
+        dict[str, float]: Time spent (in seconds) to get each kernel ready, near 0 when it comes from the cache.
+    """
+    mask = np.zeros((2, 2), dtype=np.uint16)
+    kernels = (
+        ("_label_overlap", lambda: _label_overlap(mask, mask)),
+        ("_label_stats", lambda: _label_stats(mask)),
+        ("_box_overlap", lambda: _box_overlap(mask, mask, _label_stats(mask)[0])),)
+
+    timings = {}
+    for name, call in kernels:
+        start = time.perf_counter()
+        call()
+        timings[name] = time.perf_counter() - start
+    return timings
+
+def kernels_cache_hits() -> int:
+    """
+    Number of kernel signatures that were loaded from the on-disk cache instead of being compiled, in this process.
+    """
+    return sum(sum(kernel.stats.cache_hits.values()) for kernel in (_label_overlap, _label_stats, _box_overlap))
+
+def _kernel_cached(kernel: Any) -> bool:
+    """
+    Whether the on-disk cache holds a fresh entry of the kernel. This reads the cache index through numba internals,
+    so if they change the kernel is reported as not cached (the caller then leaves the compilation to the first task).
+    """
+    try:
+        return bool(kernel._cache._cache_file._load_index())
+    except Exception:
+        return False
+
+def kernels_ready() -> bool:
+    """
+    Whether `warm_up_kernels` runs without compiling: each kernel is either already compiled in this process (e.g.
+    inherited from the parent process) or has a fresh entry in the on-disk cache (not invalidated by a source change).
+    """
+    return all(kernel.signatures or _kernel_cached(kernel) for kernel in (_label_overlap, _label_stats, _box_overlap))
 
 
 ################# Stitching and IOU Functions ################
 
-# Copied the function stitch3D from cellpose, to avoid having to install all the dependencies for the package.
-def _stitch_frames(masks: np.ndarray, track_stitch_threshold: float) -> np.ndarray:
+# Adapted from the function stitch3D from cellpose, to avoid having to install all the dependencies for the package.
+def _stitch_frames(overlaps: list[np.ndarray], track_stitch_threshold: float, match: Callable[[np.ndarray, float], np.ndarray]) -> list[np.ndarray]:
     """Stitch 2D masks into a continuous time sequence by matching masks across frames using a specified IOU threshold.
+    Works on the overlap tables of the original masks instead of the pixels: the columns of each table are renamed
+    with the labels already stitched in the previous frame, which is what cellpose computes on the relabeled stack.
 
     Args:
-        masks (ndarray): stack of masks, where masks[t] is a 2D array of masks at time t.
-        stitch_threshold (float): Threshold value for stitching.
+        overlaps (list[ndarray]): Overlap tables between consecutive frames, see `frame_overlaps`.
+        track_stitch_threshold (float): Threshold value for stitching.
+        match (Callable): Matching engine, `_match_greedy` or `_match_assignment`.
 
     Returns:
-        ndarray: stitched masks.
+        list[ndarray]: One lookup table per frame, from original to stitched labels.
     """
-    
-    mmax = masks[0].max()
+
+    luts = [np.arange(overlaps[0][:, 1].max() + 1, dtype=np.int64)]
+    mmax = luts[0][-1]
     empty = 0
-    for i in range(len(masks) - 1):
-        iou = _intersection_over_union(masks[i + 1], masks[i])[1:, 1:]
-        if not iou.size and empty == 0:
-            mmax = masks[i + 1].max()
-        elif not iou.size and empty != 0:
-            icount = masks[i + 1].max()
-            istitch = np.arange(mmax + 1, mmax + icount + 1, 1, masks.dtype)
+    for i, table in enumerate(overlaps):
+        icount = table[:, 0].max()
+        pairs = _aggregate_pairs(table[:, 0], luts[i][table[:, 1]], table[:, 2])
+        if (icount == 0 or pairs[:, 1].max() == 0) and empty == 0:
+            istitch = np.arange(icount + 1, dtype=np.int64)
+            mmax = icount
+        elif icount == 0 or pairs[:, 1].max() == 0:
+            istitch = np.arange(mmax + 1, mmax + icount + 1, 1, np.int64)
             mmax += icount
             istitch = np.append(np.array(0), istitch)
-            masks[i + 1] = istitch[masks[i + 1]]
         else:
-            iou[iou < track_stitch_threshold] = 0.0
-            iou[iou < iou.max(axis=0)] = 0.0
-            istitch = iou.argmax(axis=1) + 1
-            ino = np.nonzero(iou.max(axis=1) == 0.0)[0]
-            istitch[ino] = np.arange(mmax + 1, mmax + len(ino) + 1, 1, masks.dtype)
+            istitch = match(pairs, track_stitch_threshold)
+            ino = np.nonzero(istitch == 0)[0]
+            istitch[ino] = np.arange(mmax + 1, mmax + len(ino) + 1, 1, np.int64)
             mmax += len(ino)
             istitch = np.append(np.array(0), istitch)
-            masks[i + 1] = istitch[masks[i + 1]]
             empty = 1
+        luts.append(istitch.astype(np.int64))
 
-    return masks
+    return luts
+
+def _match_greedy(pairs: np.ndarray, track_stitch_threshold: float) -> np.ndarray:
+    """
+    Greedy matching from cellpose stitch3D: each mask of the next frame takes the previous mask with the highest IOU,
+    provided it is above the threshold and that no other mask of the next frame overlaps that previous mask more.
+
+    Args:
+        pairs (np.ndarray): Overlap table between the next frame and the stitched previous frame.
+        track_stitch_threshold (float): Threshold value for stitching.
+
+    Returns:
+        np.ndarray: For each label 1..n of the next frame, the matched label of the previous frame, or 0.
+    """
+    overlap = np.zeros((pairs[:, 0].max() + 1, pairs[:, 1].max() + 1), dtype=np.int64)
+    overlap[pairs[:, 0], pairs[:, 1]] = pairs[:, 2]
+    iou = _iou_from_overlap(overlap)[1:, 1:]
+    iou[iou < track_stitch_threshold] = 0.0
+    iou[iou < iou.max(axis=0)] = 0.0
+    return np.where(iou.max(axis=1) > 0.0, iou.argmax(axis=1) + 1, 0)
+
+def _match_assignment(pairs: np.ndarray, track_stitch_threshold: float) -> np.ndarray:
+    """
+    Optimal one-to-one matching maximizing the total IOU of the matched masks. Only the overlapping pairs above the
+    threshold are considered; they form a bipartite graph whose connected components are solved independently with a
+    linear assignment, so the cost stays proportional to the size of the clusters of touching cells.
+
+    Args:
+        pairs (np.ndarray): Overlap table between the next frame and the stitched previous frame.
+        track_stitch_threshold (float): Threshold value for stitching.
+
+    Returns:
+        np.ndarray: For each label 1..n of the next frame, the matched label of the previous frame, or 0.
+    """
+    n_rows = pairs[:, 0].max()
+    n_cols = pairs[:, 1].max()
+    matched = np.zeros(n_rows, dtype=np.int64)
+
+    # IOU of the overlapping cell pairs, the areas include the overlap with the background
+    rows, cols, counts = pairs[:, 0], pairs[:, 1], pairs[:, 2]
+    area_rows = np.bincount(rows, weights=counts, minlength=n_rows + 1)
+    area_cols = np.bincount(cols, weights=counts, minlength=n_cols + 1)
+    cells = (rows > 0) & (cols > 0)
+    rows, cols, counts = rows[cells], cols[cells], counts[cells]
+    iou = counts / (area_rows[rows] + area_cols[cols] - counts)
+    keep = iou >= track_stitch_threshold
+    rows, cols, iou = rows[keep], cols[keep], iou[keep]
+    if not len(rows):
+        return matched
+
+    # Group the candidate pairs by connected component of the bipartite graph (rows first, then cols)
+    graph = coo_matrix((np.ones(len(rows)), (rows - 1, n_rows + cols - 1)), shape=(n_rows + n_cols, n_rows + n_cols))
+    _, components = connected_components(graph, directed=False)
+    edge_components = components[rows - 1]
+    edges_per_component = np.bincount(edge_components)
+
+    # A component with a single pair is trivially matched
+    single = edges_per_component[edge_components] == 1
+    matched[rows[single] - 1] = cols[single]
+
+    order = np.argsort(edge_components[~single], kind="stable")
+    group_rows, group_cols, group_iou = rows[~single][order], cols[~single][order], iou[~single][order]
+    bounds = np.flatnonzero(np.diff(edge_components[~single][order])) + 1
+    for c_rows, c_cols, c_iou in zip(np.split(group_rows, bounds), np.split(group_cols, bounds), np.split(group_iou, bounds)):
+        if not len(c_rows):
+            continue
+        row_ids, row_idx = np.unique(c_rows, return_inverse=True)
+        col_ids, col_idx = np.unique(c_cols, return_inverse=True)
+        weights = np.zeros((len(row_ids), len(col_ids)))
+        weights[row_idx, col_idx] = c_iou
+        assigned_rows, assigned_cols = linear_sum_assignment(weights, maximize=True)
+        valid = weights[assigned_rows, assigned_cols] > 0.0
+        matched[row_ids[assigned_rows[valid]] - 1] = col_ids[assigned_cols[valid]]
+    return matched
 
 def _intersection_over_union(masks_true: np.ndarray, masks_pred: np.ndarray) -> np.ndarray:
     """Calculate the intersection over union of all mask pairs.
@@ -68,11 +352,17 @@ def _intersection_over_union(masks_true: np.ndarray, masks_pred: np.ndarray) ->
 
     Returns:
         iou (np.ndarray, float): Matrix of IOU pairs of size [x.max()+1, y.max()+1].
+    """
+
+    return _iou_from_overlap(_label_overlap(masks_true, masks_pred))
+
+def _iou_from_overlap(overlap: np.ndarray) -> np.ndarray:
+    """Calculate the intersection over union from an overlap matrix.
 
     How it works:
         The overlap matrix is a lookup table of the area of intersection
         between each set of labels (true and predicted). The true labels
-        are taken to be along axis 0, and the predicted labels are taken 
+        are taken to be along axis 0, and the predicted labels are taken
         to be along axis 1. The sum of the overlaps along axis 0 is thus
         an array giving the total overlap of the true labels with each of
         the predicted labels, and likewise the sum over axis 1 is the
@@ -82,17 +372,16 @@ def _intersection_over_union(masks_true: np.ndarray, masks_pred: np.ndarray) ->
         column vectors gives a 2D array with the areas of every label pair
         added together. This is equivalent to the union of the label areas
         except for the duplicated overlap area, so the overlap matrix is
-        subtracted to find the union matrix. 
+        subtracted to find the union matrix.
     """
-    
-    overlap = _label_overlap(masks_true, masks_pred)
     n_pixels_pred: np.ndarray = np.sum(overlap, axis=0, keepdims=True)
     n_pixels_true: np.ndarray = np.sum(overlap, axis=1, keepdims=True)
-    iou = overlap / (n_pixels_pred + n_pixels_true - overlap)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        iou = overlap / (n_pixels_pred + n_pixels_true - overlap)
     iou[np.isnan(iou)] = 0.0
     return iou
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def _label_overlap(m1: np.ndarray, m2: np.ndarray) -> np.ndarray:
     """Fast function to get pixel overlaps between masks in m1 and m2.
 
@@ -103,7 +392,7 @@ def _label_overlap(m1: np.ndarray, m2: np.ndarray) -> np.ndarray:
     Returns:
         overlap (np.ndarray, int): Matrix of pixel overlaps of size [m1.max()+1, m2.max()+1].
     """
-    
+
     m1 = m1.ravel()
     m2 = m2.ravel()
 
@@ -118,43 +407,168 @@ def _label_overlap(m1: np.ndarray, m2: np.ndarray) -> np.ndarray:
         overlap[m1[i], m2[i]] += 1
     return overlap
 
-def _trim_incomplete_tracks(mask: np.ndarray) -> np.ndarray:
+def _dense_overlap(m1: np.ndarray, m2: np.ndarray, stats_m1: LabelStats | None=None,
+                   stats_m2: LabelStats | None=None) -> np.ndarray:
     """
-    Trim incomplete tracks from the mask stack.
+    Overlap table of m1 and m2, counting every pixel with `_label_overlap`. The label statistics are not needed.
+    """
+    return _sparse_overlap(_label_overlap(m1, m2))
+
+def _bbox_overlap(m1: np.ndarray, m2: np.ndarray, stats_m1: LabelStats | None=None,
+                  stats_m2: LabelStats | None=None) -> np.ndarray:
+    """
+    Overlap table of m1 and m2, only looking inside the bounding box of each label of m1.
+
+    All the pixels of a label of m1 are inside its bounding box, so the labels of m2 found under it in the
+    box give its exact row of the table, and only the labels of m2 whose box intersects it can show up.
+    The background row (label 0 of m1) is then deduced from the areas of the labels of m2.
+    The label statistics of the frames are computed if not given.
+    """
+    boxes_m1, _, _ = stats_m1 if stats_m1 is not None else _label_stats(m1)
+    _, areas_m2, _ = stats_m2 if stats_m2 is not None else _label_stats(m2)
+    rows, cols, counts = _box_overlap(m1, m2, boxes_m1)
+
+    # Whatever part of a label of m2 is not covered by a label of m1 lies on the background of m1
+    covered = np.zeros_like(areas_m2)
+    np.add.at(covered, cols, counts)
+    background = areas_m2 - covered
+    background[0] = m1.size - areas_m2[1:].sum() - covered[0]
+    labels_m2 = np.nonzero(background)[0]
 
-    This function returns a new 3D mask array (tyx format) where only the objects 
-    present in every frame are kept. Incomplete tracks (objects not found in all frames)
-    are set to 0.
+    return np.stack([np.concatenate([np.zeros(len(labels_m2), dtype=np.int64), rows]),
+                     np.concatenate([labels_m2, cols]),
+                     np.concatenate([background[labels_m2], counts])], axis=1)
+
+@jit(nopython=True, cache=True)
+def _label_stats(m: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Single pass over a 2D mask to get the bounding box, the area and the sum of the coordinates of every label.
+
+    Returns:
+        boxes (np.ndarray, int): (min row, min col, max row, max col) per label, max row is -1 for absent labels.
+        areas (np.ndarray, int): Number of pixels per label, the background area is left to 0.
+        sums (np.ndarray, int): (sum of rows, sum of cols) per label, to compute the centroids.
+    """
+    n_labels = m.max() + 1
+    boxes = np.empty((n_labels, 4), dtype=np.int64)
+    boxes[:, 0] = m.shape[0]
+    boxes[:, 1] = m.shape[1]
+    boxes[:, 2] = -1
+    boxes[:, 3] = -1
+    areas = np.zeros(n_labels, dtype=np.int64)
+    sums = np.zeros((n_labels, 2), dtype=np.int64)
+    for y in range(m.shape[0]):
+        for x in range(m.shape[1]):
+            label = m[y, x]
+            if label == 0:
+                continue
+            areas[label] += 1
+            sums[label, 0] += y
+            sums[label, 1] += x
+            boxes[label, 0] = min(boxes[label, 0], y)
+            boxes[label, 1] = min(boxes[label, 1], x)
+            boxes[label, 2] = max(boxes[label, 2], y)
+            boxes[label, 3] = max(boxes[label, 3], x)
+    return boxes, areas, sums
+
+@jit(nopython=True, cache=True)
+def _box_overlap(m1: np.ndarray, m2: np.ndarray, boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Count the labels of m2 under each label of m1, scanning only the bounding box of that label.
+
+    Returns:
+        rows, cols, counts (np.ndarray, int): Non-zero entries of the overlap matrix for the labels of m1 (label 0 excluded),
+        sorted by row then column.
+    """
+    scratch = np.zeros(m2.max() + 1, dtype=np.int64)
+    capacity = 1024
+    rows = np.empty(capacity, dtype=np.int64)
+    cols = np.empty(capacity, dtype=np.int64)
+    counts = np.empty(capacity, dtype=np.int64)
+    n_pairs = 0
+    for label in range(1, boxes.shape[0]):
+        if boxes[label, 2] < 0:
+            continue
+        for y in range(boxes[label, 0], boxes[label, 2] + 1):
+            for x in range(boxes[label, 1], boxes[label, 3] + 1):
+                if m1[y, x] == label:
+                    scratch[m2[y, x]] += 1
+        # Flush the counts of this label, the scratch only has entries inside the box
+        under_label = np.unique(m2[boxes[label, 0]:boxes[label, 2] + 1, boxes[label, 1]:boxes[label, 3] + 1])
+        for other in under_label:
+            if scratch[other] == 0:
+                continue
+            if n_pairs == capacity:
+                capacity *= 2
+                rows = np.concatenate((rows, np.empty(capacity - n_pairs, dtype=np.int64)))
+                cols = np.concatenate((cols, np.empty(capacity - n_pairs, dtype=np.int64)))
+                counts = np.concatenate((counts, np.empty(capacity - n_pairs, dtype=np.int64)))
+            rows[n_pairs] = label
+            cols[n_pairs] = other
+            counts[n_pairs] = scratch[other]
+            scratch[other] = 0
+            n_pairs += 1
+    return rows[:n_pairs], cols[:n_pairs], counts[:n_pairs]
+
+def _sparse_overlap(overlap: np.ndarray) -> np.ndarray:
+    """
+    Convert a dense overlap matrix into a (k, 3) table of its non-zero entries (label m1, label m2, pixel count).
+    Every label present in a mask covers at least one pixel, so the dense shape can always be recovered from the table.
+    """
+    rows, cols = np.nonzero(overlap)
+    return np.stack([rows, cols, overlap[rows, cols]], axis=1).astype(np.int64)
+
+def _aggregate_pairs(rows: np.ndarray, cols: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Sum the counts of identical (row, col) pairs and return them as an overlap table sorted by (row, col).
+    """
+    keys = rows.astype(np.int64) * (int(cols.max()) + 1) + cols
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    summed = np.bincount(inverse, weights=counts).astype(np.int64)
+    new_rows, new_cols = np.divmod(unique_keys, int(cols.max()) + 1)
+    return np.stack([new_rows, new_cols, summed], axis=1)
+
+OVERLAP_MODES = {"dense": _dense_overlap, "bbox": _bbox_overlap}
+MATCHINGS = {"greedy": _match_greedy, "assignment": _match_assignment}
+TRACK_STATS_COLUMNS = ("label", "frame", "area", "centroid_y", "centroid_x", "bbox_min_y", "bbox_min_x", "bbox_max_y", "bbox_max_x")
+
+def _trim_incomplete_tracks(luts: list[np.ndarray], overlaps: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    Trim incomplete tracks from the stitched lookup tables and relabel the remaining tracks sequentially.
+
+    Only the objects present in every frame are kept, the others are mapped to 0. The labels present in
+    each frame are read from the overlap tables, so no pixel is scanned.
 
     Args:
-        mask (np.ndarray): 3D mask array in tyx format.
+        luts (list[np.ndarray]): Lookup tables from original to stitched labels, one per frame.
+        overlaps (list[np.ndarray]): Overlap tables between consecutive frames.
 
     Returns:
-        np.ndarray: The trimmed mask array.
+        list[np.ndarray]: Lookup tables from original to final labels, one per frame.
     """
+    # Labels present in each frame: the columns of the first table, then the rows of every table
+    present = [np.unique(overlaps[0][:, 1])] + [np.unique(table[:, 0]) for table in overlaps]
+
     # Determine the complete set of objects (present in every frame)
-    complete_objs = set(np.unique(mask[0]))
-    for frame in mask[1:]:
-        complete_objs.intersection_update(np.unique(frame))
-    
-    # Create a copy of the mask to avoid modifying the original input
-    trimmed_mask = mask.copy()
-    
-    # Set to 0 any object not present in all frames
-    trimmed_mask[~np.isin(trimmed_mask, list(complete_objs))] = 0
-    
-    return trimmed_mask
+    complete_objs = set(luts[0][present[0]].tolist())
+    for lut, labels in zip(luts[1:], present[1:]):
+        complete_objs.intersection_update(lut[labels].tolist())
+    complete_objs.discard(0)
+
+    # Relabel the complete objects sequentially, in the same order as relabel_sequential
+    kept = np.array(sorted(complete_objs), dtype=np.int64)
+    forward = np.zeros(max(int(lut.max()) for lut in luts) + 1, dtype=np.int64)
+    forward[kept] = np.arange(1, len(kept) + 1)
+    return [forward[lut] for lut in luts]
 
 
 if __name__ == "__main__":
     from pathlib import Path
     from tifffile import imread, imwrite
-    
+
     img_path = Path("/media/ben/Analysis/Python/Images/Image_tests/dst_test/_z1_t10.tif_masks.tif")
     masks = imread(img_path)
-    
+
     tracked_masks = track_masks(masks, track_stitch_threshold=0.75)
-    
+
     # Save the tracked masks to a new file
     save_path = img_path.parent.joinpath(img_path.name.replace("_masks", "_tracked_masks"))
-    imwrite(save_path, tracked_masks.astype(np.uint16), compression='zlib')
\ No newline at end of file
+    imwrite(save_path, tracked_masks.astype(np.uint16), compression='zlib')
@@ -1,44 +1,89 @@
+import os
 from celery import shared_task
 import numpy as np
-import tifffile as tiff
 from pathlib import Path
 
 from cp_server.tasks_server import get_logger
-from cp_server.tasks_server.tasks.saving.save_arrays import save_mask
-from cp_server.tasks_server.tasks.track.track import track_masks
+from cp_server.tasks_server.tasks.saving.mask_store import is_store_path
+from cp_server.tasks_server.tasks.saving.save_arrays import TRACK_MASK_COMPRESSION, generate_track_stats_path, load_masks, save_mask, save_track_stats
+from cp_server.tasks_server.tasks.track.overlap_cache import load_label_stats, load_overlaps, store_label_stats, store_overlaps
+from cp_server.tasks_server.tasks.track.track import (apply_luts, frame_label_stats, frame_overlaps, project_overlaps,
+                                                     project_stats, stats_columns, track_luts, track_masks, track_stats)
 
+# Save the per-track statistics next to the tracked masks ('<FOVID>_tracks.npz')
+TRACK_STATS = os.getenv("TRACK_STATS", "true").lower() == "true"
 
 logger = get_logger(__name__)
 
 @shared_task(name="cp_server.tasks_server.tasks.track.track_cells")
-def track_cells(mask_paths: list[str], 
+def track_cells(mask_paths: list[str],
                 track_stitch_threshold: float,
-                ) -> None:
+                track_overlap_mode: str = "dense",
+                track_matching: str = "greedy",
+                ) -> list[str]:
     """
     Task to track cells in a time series of images. Masks are stitched together based on a threshold for IOU (Intersection Over Union).
     Masks are then relabeled sequentially to ensure unique labels across the time series.
+    The overlap tables between frames are cached in Redis, keyed by the identity of the written masks, so tracking
+    the same files again with another threshold skips the pixel pass.
+    The `track_overlap_mode` selects how the missing overlap tables are computed: "dense" scans every pixel, "bbox" only
+    scans the bounding box of each cell, which is faster on large and sparse fields of view.
+    The `track_matching` selects the matching engine: "greedy" (cellpose stitch3D) or "assignment" (optimal one-to-one matching).
+    With TRACK_STATS, the area, centroid and bounding box of every track in every frame are saved next to the masks as
+    '<FOVID>_tracks.npz'. They are projected from the label statistics of the original masks, which the "bbox" mode
+    computes anyway and which are cached like the overlap tables, so the tracked pixels are not read again.
+    Masks stored in a per-well container (MASK_STORAGE="well") are read from and written back to the container.
+    Returns the paths of the tracked masks, for the callback recording the progress of the run.
     """
-    
+
     # Log
     logger.debug(f"Tracking cells in {len(mask_paths)} images with track_stitch_threshold {track_stitch_threshold}")
-    
+
     # Load the stack of masks
-    masks = [tiff.imread(path) for path in mask_paths]
-    masks = np.array(masks).astype(np.uint16)
+    masks = load_masks(mask_paths, np.uint16)
     logger.debug(f"Loaded masks of shape {masks.shape=}")
-    
-    # Track the cells and trim the masks
-    stitched_masks = track_masks(masks, track_stitch_threshold)
+
+    # Track the cells and trim the masks, reusing the cached overlap tables if any
+    overlaps: list[np.ndarray] = []
+    stats = None
+    if len(masks) < 2:
+        stitched_masks = track_masks(masks, track_stitch_threshold, overlap_mode=track_overlap_mode, matching=track_matching)
+    else:
+        if TRACK_STATS or track_overlap_mode == "bbox":
+            stats = frame_label_stats(masks, load_label_stats(mask_paths))
+        overlaps = frame_overlaps(masks, load_overlaps(mask_paths), track_overlap_mode, stats)
+        luts = track_luts(overlaps, track_stitch_threshold, track_matching)
+        stitched_masks = apply_luts(masks, luts)
+        overlaps = project_overlaps(overlaps, luts)
+        if stats is not None:
+            stats = project_stats(stats, luts)
     logger.debug(f"Stitched masks of shape {stitched_masks.shape=}")
-    
+
     # Overwrite the original masks with the stitched ones and log each tracked file
     if mask_paths:
         log_dir = Path(mask_paths[0]).parent
+        if is_store_path(mask_paths[0]):
+            # Next to the per-well container, not inside it
+            log_dir = log_dir.parent
         log_file = log_dir / "tracked_files.txt"
-        
+
         with open(log_file, "a") as f:
             for mask, path in zip(stitched_masks, mask_paths):
-                save_mask(mask, path)
+                save_mask(mask, path, TRACK_MASK_COMPRESSION)
                 f.write(f"{path}\n")
-        
-        logger.debug(f"Logged {len(mask_paths)} tracked files to {log_file}")
\ No newline at end of file
+
+        logger.debug(f"Logged {len(mask_paths)} tracked files to {log_file}")
+
+        # Save the per-track statistics, so downstream analysis doesn't need to reload the masks
+        if TRACK_STATS:
+            stats_path = generate_track_stats_path(mask_paths[0])
+            track_columns = stats_columns(stats) if stats is not None else track_stats(stitched_masks)
+            save_track_stats(track_columns, str(stats_path), mask_paths)
+            logger.debug(f"Saved per-track statistics to {stats_path}")
+
+    # Cache the tables of the tracked masks, now that their identity on disk is final
+    if overlaps:
+        store_overlaps(mask_paths, overlaps)
+    if stats is not None:
+        store_label_stats(mask_paths, stats)
+    return mask_paths
@@ -0,0 +1,29 @@
+from redis import RedisError
+
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.utils.redis_com import redis_client
+
+
+# Redis hash of the images claimed by a submission (see `fastapi_app.endpoints.dedup`), by path, with their claim key
+INFLIGHT_IMAGES_KEY = "inflight_images"
+
+logger = get_logger(__name__)
+
+
+def release_claims(img_paths: list[str]) -> None:
+    """
+    Release the claims of the images once their processing ended (done or failed for good), so that submitting them
+    again processes them again. Images without a claim are ignored. Failures are logged and otherwise ignored, the
+    claims expire anyway.
+    """
+    if not img_paths:
+        return
+    try:
+        claim_keys = [key for key in redis_client.hmget(INFLIGHT_IMAGES_KEY, img_paths) if key is not None]
+        pipe = redis_client.pipeline()
+        if claim_keys:
+            pipe.delete(*claim_keys)
+        pipe.hdel(INFLIGHT_IMAGES_KEY, *img_paths)
+        pipe.execute()
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not release the claims of {len(img_paths)} image(s): {e}")
@@ -0,0 +1,100 @@
+import json
+import os
+import time
+from typing import Any
+
+from celery import Signature, Task, signature
+from redis import RedisError
+
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.utils.claims import release_claims
+from cp_server.tasks_server.utils.redis_com import redis_client
+
+
+# Number of times an image failing in a batch is retried alone, and delay before the first retry (doubled each time)
+ITEM_RETRIES = int(os.getenv("ITEM_RETRIES", 2))
+ITEM_RETRY_BACKOFF = float(os.getenv("ITEM_RETRY_BACKOFF", 2.0))
+# Tasks ending the chain of the images (see `celery_main_task.process_images`), run once the retries are done
+CHAIN_END_TASKS = (
+    "cp_server.tasks_server.tasks.counter.counter_task_manager.mark_chunk_done",
+    "cp_server.tasks_server.tasks.counter.counter_task_manager.mark_chunk_failed",
+)
+# Redis hash of the images that failed every retry, by path, and its lifetime in seconds
+FAILED_IMAGES_KEY = "failed_images"
+FAILED_IMAGES_TTL = int(os.getenv("FAILED_IMAGES_TTL", 24 * 3600))
+
+logger = get_logger(__name__)
+
+
+def retry_later(task: Task, errors: dict[str, Exception], attempt: int, stage: str) -> bool:
+    """
+    Send the items that failed in a batch to be retried alone by a new run of the task, in
+    ITEM_RETRY_BACKOFF * 2 ** attempt seconds, so the worker never waits for them and the rest of the batch is never
+    redone. The new run takes over the rest of the chain of the task, with the tasks ending it (CHAIN_END_TASKS),
+    while the result of this run goes on down the rest of the chain without them: the chain ends once, after the last
+    retry.
+    Returns False, sending nothing, if the items failed the last retry (attempt == ITEM_RETRIES) or the caller waits
+    for the result of the task (called directly or eagerly): the items are then recorded as failed for good.
+    Args:
+        task (Task): The bound task that failed on the items, which takes the items as `img_path` and the number of
+            retries as `attempt`.
+        errors (dict[str, Exception]): The failed items (image paths) with their error.
+        attempt (int): Number of times the items were already retried.
+        stage (str): Name of the processing stage, for the logs and the failure records.
+    """
+    request = task.request
+    if attempt >= ITEM_RETRIES or request.called_directly or request.is_eager:
+        for item, error in errors.items():
+            logger.error(f"{stage} failed for {item} after {attempt} retries: {error}")
+        record_failures(errors, stage)
+        return False
+
+    delay = ITEM_RETRY_BACKOFF * 2 ** attempt
+    logger.warning(f"Retrying {len(errors)} {stage} item(s) alone in {delay:.1f}s ({attempt + 1}/{ITEM_RETRIES})")
+    task.apply_async(kwargs={**request.kwargs, "img_path": list(errors), "attempt": attempt + 1},
+                     countdown=delay, chain=request.chain, link_error=request.errbacks)
+    request.chain = _without_end(request.chain)
+    return True
+
+def _without_end(chain: list[dict[str, Any]] | None) -> list[Signature] | None:
+    """
+    The rest of a chain (as in the request of a task, last task first) without the tasks ending it, neither as steps
+    nor as error callbacks of the remaining steps.
+    """
+    rest = []
+    for step in map(signature, chain or []):
+        if step.task in CHAIN_END_TASKS:
+            continue
+        errbacks = [errback for errback in step.options.get("link_error") or []
+                    if signature(errback).task not in CHAIN_END_TASKS]
+        rest.append(step.clone(link_error=errbacks))
+    return rest or None
+
+def record_failures(errors: dict[str, Exception], stage: str) -> None:
+    """
+    Record the images that failed for good, with the stage and the error, until FAILED_IMAGES_TTL, and release their
+    claims so that submitting them again retries them. Failures are logged and otherwise ignored.
+    """
+    if not errors:
+        return
+    release_claims(list(errors))
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(FAILED_IMAGES_KEY, mapping={
+            item: json.dumps({"stage": stage, "error": repr(error), "time": time.time()})
+            for item, error in errors.items()})
+        pipe.expire(FAILED_IMAGES_KEY, FAILED_IMAGES_TTL)
+        pipe.execute()
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not record the failed images: {e}")
+
+def clear_failures(items: list[str]) -> None:
+    """
+    Forget the past failures of images processed successfully since.
+    """
+    if not items:
+        return
+    try:
+        redis_client.hdel(FAILED_IMAGES_KEY, *items)
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not clear the failed images: {e}")
@@ -0,0 +1,239 @@
+import fnmatch
+import threading
+import time
+from typing import Any, Callable, Iterator
+
+
+def _encode(value: Any) -> bytes:
+    """
+    Store values as Redis does, as bytes.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, (int, float)):
+        return repr(value).encode()
+    raise TypeError(f"Invalid value of type {type(value).__name__}, expected bytes, str, int or float")
+
+class MemoryRedis:
+    """
+    In-process replacement of the Redis client, for the embedded (single-node) executor. Implements the commands used
+    by the server, with the same arguments and return values as redis-py (bytes values, expiring keys). The store is
+    shared by the threads of the process and lost when it exits.
+    """
+    def __init__(self) -> None:
+        self._data: dict[str, Any] = {}
+        self._expires: dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    def _key(self, key: str | bytes) -> str:
+        key = key.decode() if isinstance(key, bytes) else key
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._data.pop(key, None)
+            del self._expires[key]
+        return key
+
+    def _get_typed(self, key: str | bytes, kind: type) -> Any:
+        value = self._data.get(self._key(key))
+        if value is not None and not isinstance(value, kind):
+            raise TypeError(f"Operation against a key holding the wrong kind of value: {key!r}")
+        return value
+
+    # Server
+    def ping(self) -> bool:
+        return True
+
+    def info(self, section: str | None = None) -> dict[str, Any]:
+        # No memory limit, as for a Redis without maxmemory
+        return {"used_memory": 0, "maxmemory": 0}
+
+    def pipeline(self, transaction: bool = True) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    def transaction(self, func: Callable[["MemoryPipeline"], Any], *watches: str | bytes,
+                    value_from_callable: bool = False, **kwargs: Any) -> Any:
+        """
+        Run the function as a WATCH/MULTI/EXEC transaction: the pipeline runs the commands at once until `multi`,
+        then queues them. The store stays locked throughout, so the watched keys can't change and it runs once.
+        """
+        with self._lock:
+            pipe = MemoryPipeline(self, immediate=True)
+            func_value = func(pipe)
+            results = pipe.execute()
+        return func_value if value_from_callable else results
+
+    # Keys
+    def exists(self, *keys: str | bytes) -> int:
+        with self._lock:
+            return sum(self._key(key) in self._data for key in keys)
+
+    def delete(self, *keys: str | bytes) -> int:
+        with self._lock:
+            deleted = 0
+            for key in map(self._key, keys):
+                deleted += self._data.pop(key, None) is not None
+                self._expires.pop(key, None)
+            return deleted
+
+    def expire(self, key: str | bytes, seconds: int) -> bool:
+        with self._lock:
+            key = self._key(key)
+            if key not in self._data:
+                return False
+            self._expires[key] = time.monotonic() + seconds
+            return True
+
+    def scan_iter(self, match: str | None = None, count: int | None = None) -> Iterator[bytes]:
+        with self._lock:
+            keys = [key for key in list(self._data) if self._key(key) in self._data]
+        for key in keys:
+            if match is None or fnmatch.fnmatchcase(key, match):
+                yield key.encode()
+
+    # Strings
+    def get(self, key: str | bytes) -> bytes | None:
+        with self._lock:
+            return self._get_typed(key, bytes)
+
+    def mget(self, keys: str | bytes | list[str | bytes], *args: str | bytes) -> list[bytes | None]:
+        keys = [keys, *args] if isinstance(keys, (str, bytes)) else [*keys, *args]
+        with self._lock:
+            return [self.get(key) for key in keys]
+
+    def set(self, key: str | bytes, value: Any, ex: int | None = None, nx: bool = False) -> bool | None:
+        with self._lock:
+            key = self._key(key)
+            if nx and key in self._data:
+                return None
+            self._data[key] = _encode(value)
+            self._expires.pop(key, None)
+            if ex is not None:
+                self._expires[key] = time.monotonic() + ex
+            return True
+
+    def setnx(self, key: str | bytes, value: Any) -> bool:
+        return bool(self.set(key, value, nx=True))
+
+    def incr(self, key: str | bytes, amount: int = 1) -> int:
+        with self._lock:
+            value = int(self._get_typed(key, bytes) or 0) + amount
+            self._data[self._key(key)] = _encode(value)
+            return value
+
+    def decr(self, key: str | bytes, amount: int = 1) -> int:
+        return self.incr(key, -amount)
+
+    # Hashes
+    def hset(self, name: str | bytes, key: str | bytes | None = None, value: Any = None,
+             mapping: dict[Any, Any] | None = None) -> int:
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        with self._lock:
+            fields = self._get_typed(name, dict)
+            if fields is None:
+                fields = self._data[self._key(name)] = {}
+            added = 0
+            for field, field_value in items.items():
+                field = _encode(field)
+                added += field not in fields
+                fields[field] = _encode(field_value)
+            return added
+
+    def hget(self, name: str | bytes, key: str | bytes) -> bytes | None:
+        with self._lock:
+            return (self._get_typed(name, dict) or {}).get(_encode(key))
+
+    def hmget(self, name: str | bytes, keys: list[str | bytes], *args: str | bytes) -> list[bytes | None]:
+        with self._lock:
+            fields = self._get_typed(name, dict) or {}
+            return [fields.get(_encode(key)) for key in [*keys, *args]]
+
+    def hdel(self, name: str | bytes, *keys: str | bytes) -> int:
+        with self._lock:
+            fields = self._get_typed(name, dict) or {}
+            deleted = sum(fields.pop(_encode(key), None) is not None for key in keys)
+            if not fields:
+                self.delete(name)
+            return deleted
+
+    def hlen(self, name: str | bytes) -> int:
+        with self._lock:
+            return len(self._get_typed(name, dict) or {})
+
+    def hvals(self, name: str | bytes) -> list[bytes]:
+        with self._lock:
+            return list((self._get_typed(name, dict) or {}).values())
+
+    def hgetall(self, name: str | bytes) -> dict[bytes, bytes]:
+        with self._lock:
+            return dict(self._get_typed(name, dict) or {})
+
+    # Lists
+    def lpush(self, name: str | bytes, *values: Any) -> int:
+        with self._lock:
+            items = self._get_typed(name, list)
+            if items is None:
+                items = self._data[self._key(name)] = []
+            for value in values:
+                items.insert(0, _encode(value))
+            return len(items)
+
+    def lrange(self, name: str | bytes, start: int, end: int) -> list[bytes]:
+        with self._lock:
+            items = self._get_typed(name, list) or []
+            return items[start:None if end == -1 else end + 1]
+
+    def ltrim(self, name: str | bytes, start: int, end: int) -> bool:
+        with self._lock:
+            items = self._get_typed(name, list)
+            if items is not None:
+                items[:] = items[start:None if end == -1 else end + 1]
+                if not items:
+                    self.delete(name)
+            return True
+
+    def llen(self, name: str | bytes) -> int:
+        with self._lock:
+            return len(self._get_typed(name, list) or [])
+
+class MemoryPipeline:
+    """
+    Pipeline of a MemoryRedis: the commands are queued, then run together under the lock of the store by `execute`,
+    which returns their results. In a transaction, the commands run at once until `multi` (as after a WATCH).
+    """
+    def __init__(self, store: MemoryRedis, immediate: bool = False) -> None:
+        self._store = store
+        self._immediate = immediate
+        self._commands: list[tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_") or not callable(getattr(self._store, name, None)):
+            raise AttributeError(name)
+        if self._immediate:
+            return getattr(self._store, name)
+
+        def _queue(*args: Any, **kwargs: Any) -> "MemoryPipeline":
+            self._commands.append((name, args, kwargs))
+            return self
+        return _queue
+
+    def watch(self, *names: str | bytes) -> bool:
+        return True
+
+    def multi(self) -> None:
+        self._immediate = False
+
+    def execute(self) -> list[Any]:
+        with self._store._lock:
+            results = [getattr(self._store, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+    def __enter__(self) -> "MemoryPipeline":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._commands = []
@@ -0,0 +1,155 @@
+import json
+import os
+from typing import Any
+
+from redis import RedisError
+
+from cp_server.tasks_server import get_logger
+from cp_server.tasks_server.tasks.saving.save_arrays import extract_fov_id
+from cp_server.tasks_server.utils.redis_com import redis_client
+
+
+# Lifetime of the progress ledger of a run after its last update, in seconds
+PROGRESS_TTL = int(os.getenv("PROGRESS_TTL", 72 * 3600))
+# Stages of an image, in order
+SUBMITTED = "submitted"
+BG_SUBTRACTED = "bg_subtracted"
+SEGMENTED = "segmented"
+TRACKED = "tracked"
+STAGES = (SUBMITTED, BG_SUBTRACTED, SEGMENTED, TRACKED)
+_RANKS = {stage: rank for rank, stage in enumerate(STAGES)}
+
+logger = get_logger(__name__)
+
+
+def _ledger_keys(well_id: str) -> tuple[str, str, str]:
+    """
+    Keys of the ledger of a run: the stage of each image, the image of each mask, and the processing parameters.
+    """
+    return f"progress:{well_id}", f"progress:{well_id}:masks", f"progress:{well_id}:params"
+
+def _batches_key(well_id: str) -> str:
+    return f"progress:{well_id}:batches"
+
+def record_stage(well_id: str, img_paths: list[str], stage: str, masks: dict[str, str] | None = None) -> None:
+    """
+    Record that the images of the run reached the stage, and for segmented images the image of each mask
+    (mask path -> image path). A stage only moves forward, in the order of STAGES: images already at a later stage
+    (e.g. submitted again, or reported late by a writer thread) keep it, the stages being compared and set in a
+    WATCH transaction. Failures are logged and otherwise ignored, the ledger never fails the processing.
+    """
+    if not img_paths:
+        return
+    stages_key, masks_key, _ = _ledger_keys(well_id)
+    rank = STAGES.index(stage)
+
+    def _advance(pipe: Any) -> None:
+        current = pipe.hmget(stages_key, img_paths)
+        behind = {img_path: stage for img_path, reached in zip(img_paths, current)
+                  if reached is None or _RANKS.get(reached.decode(), -1) < rank}
+        pipe.multi()
+        if behind:
+            pipe.hset(stages_key, mapping=behind)
+        pipe.expire(stages_key, PROGRESS_TTL)
+        if masks:
+            pipe.hset(masks_key, mapping=masks)
+            pipe.expire(masks_key, PROGRESS_TTL)
+
+    try:
+        redis_client.transaction(_advance, stages_key)
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not record the {stage} stage of {len(img_paths)} image(s) of {well_id}: {e}")
+
+def record_batch(well_id: str, batch_id: str) -> None:
+    """
+    Record a batch sent for the run, whose chains are counted down under 'pending_chunks:<batch_id>' (see
+    `celery_main_task.process_images`), so the run isn't resumed while they are running.
+    """
+    batches_key = _batches_key(well_id)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.lpush(batches_key, batch_id)
+        pipe.expire(batches_key, PROGRESS_TTL)
+        pipe.execute()
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not record the batch {batch_id} of {well_id}: {e}")
+
+def run_batches(well_id: str) -> list[str]:
+    """
+    The IDs of the batches sent for the run, latest first.
+    """
+    return [batch_id.decode() for batch_id in redis_client.lrange(_batches_key(well_id), 0, -1)]
+
+def record_params(well_id: str, params: dict[str, Any]) -> None:
+    """
+    Record the processing parameters of the run (those of `process_images`, the images excluded), from which its
+    missing stages are resubmitted.
+    """
+    _, _, params_key = _ledger_keys(well_id)
+    try:
+        redis_client.set(params_key, json.dumps(params), ex=PROGRESS_TTL)
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not record the parameters of {well_id}: {e}")
+
+def record_tracked(well_id: str, mask_paths: list[str]) -> None:
+    """
+    Record that the images of the tracked masks reached the last stage. Masks not segmented by the run (e.g.
+    registered through the API) are ignored.
+    """
+    if not mask_paths:
+        return
+    _, masks_key, _ = _ledger_keys(well_id)
+    try:
+        img_paths = redis_client.hmget(masks_key, mask_paths)
+    except (OSError, RedisError) as e:
+        logger.warning(f"Could not look up the images of the tracked masks of {well_id}: {e}")
+        return
+    record_stage(well_id, [p.decode() for p in img_paths if p is not None], TRACKED)  # type: ignore[union-attr]
+
+def run_progress(well_id: str) -> tuple[dict[str, str], dict[str, str], dict[str, Any] | None]:
+    """
+    Read the ledger of a run.
+    Returns:
+        tuple: The stage of each image, the mask of each segmented image, and the processing parameters (None if not
+        recorded).
+    """
+    stages_key, masks_key, params_key = _ledger_keys(well_id)
+    pipe = redis_client.pipeline()
+    pipe.hgetall(stages_key)
+    pipe.hgetall(masks_key)
+    pipe.get(params_key)
+    raw_stages, raw_masks, raw_params = pipe.execute()
+    stages = {img_path.decode(): stage.decode() for img_path, stage in raw_stages.items()}
+    masks = {img_path.decode(): mask_path.decode() for mask_path, img_path in raw_masks.items()}
+    return stages, masks, json.loads(raw_params) if raw_params is not None else None
+
+def untracked_fovs(stages: dict[str, str]) -> set[str]:
+    """
+    The fields of view of a run none of whose images were tracked yet, from its ledger (see `run_progress`).
+    """
+    fovs = {extract_fov_id(img_path)[0]: False for img_path in stages}
+    for img_path, stage in stages.items():
+        if stage == TRACKED:
+            fovs[extract_fov_id(img_path)[0]] = True
+    return {fov_id for fov_id, tracked in fovs.items() if not tracked}
+
+def missing_stages(stages: dict[str, str], masks: dict[str, str]) -> tuple[list[str], dict[str, dict[str, str]]]:
+    """
+    What is left to do for a run, from its ledger (see `run_progress`).
+    Returns:
+        tuple: The images to process again, those not segmented (their background is not removed twice, the
+        corrected images being marked), and the fields of view to track, those whose images were all segmented but
+        none tracked, with the mask of each time point.
+    """
+    img_paths = [img_path for img_path, stage in stages.items() if stage in (SUBMITTED, BG_SUBTRACTED)]
+    fovs: dict[str, dict[str, str]] = {}
+    fov_stages: dict[str, set[str]] = {}
+    for img_path, stage in stages.items():
+        fov_id, time_id = extract_fov_id(img_path)
+        fov_stages.setdefault(fov_id, set()).add(stage)
+        if img_path in masks:
+            fovs.setdefault(fov_id, {})[time_id] = masks[img_path]
+    # A single time point waits for the next one, which tracks it
+    to_track = {fov_id: fov_masks for fov_id, fov_masks in fovs.items()
+                if fov_stages[fov_id] == {SEGMENTED} and len(fov_masks) >= 2}
+    return img_paths, to_track
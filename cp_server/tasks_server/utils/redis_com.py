@@ -4,9 +4,19 @@ from urllib.parse import urlparse
 
 from redis import Redis
 
+from cp_server.tasks_server.utils.memory_store import MemoryRedis
 
-url = os.environ["CELERY_BROKER_URL"]  # e.g. redis://redis:6379/2
-parse_url = urlparse(url)
-redis_client = Redis(host=parse_url.hostname or "localhost", 
-                     port=parse_url.port or 6379, 
-                     db=int(parse_url.path.lstrip("/")) if parse_url.path else 2)
\ No newline at end of file
+
+# "celery" (Celery workers coordinated through Redis) or "local" (embedded worker, see celery_app.start_local_worker)
+EXECUTOR = os.getenv("EXECUTOR", "celery")
+
+redis_client: Redis
+if EXECUTOR == "local":
+    # The tasks run in the process of the API, which keeps the counters and flags in memory
+    redis_client = MemoryRedis()  # type: ignore[assignment]
+else:
+    url = os.environ["CELERY_BROKER_URL"]  # e.g. redis://redis:6379/2
+    parse_url = urlparse(url)
+    redis_client = Redis(host=parse_url.hostname or "localhost",
+                         port=parse_url.port or 6379,
+                         db=int(parse_url.path.lstrip("/")) if parse_url.path else 2)
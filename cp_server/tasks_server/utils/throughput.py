@@ -0,0 +1,36 @@
+import os
+import time
+
+from redis import Redis
+
+
+# Window over which the throughput of the queues is averaged, in seconds
+THROUGHPUT_WINDOW = int(os.getenv("THROUGHPUT_WINDOW", 300))
+BUCKET_SECONDS = 60
+
+
+def _bucket_key(queue: str, bucket: int) -> str:
+    return f"throughput:{queue}:{bucket}"
+
+def record_task_done(redis_client: Redis, queue: str) -> None:
+    """
+    Count a task taken from the queue and done, in a counter per minute that expires once out of the window.
+    """
+    key = _bucket_key(queue, int(time.time() // BUCKET_SECONDS))
+    pipe = redis_client.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, THROUGHPUT_WINDOW + BUCKET_SECONDS)
+    pipe.execute()
+
+def queue_throughput(redis_client: Redis, queue: str) -> float:
+    """
+    Number of tasks of the queue done per second, averaged over the last THROUGHPUT_WINDOW seconds.
+    """
+    now = time.time()
+    current = int(now // BUCKET_SECONDS)
+    buckets = range(current - THROUGHPUT_WINDOW // BUCKET_SECONDS, current + 1)
+    counts = redis_client.mget([_bucket_key(queue, bucket) for bucket in buckets])
+    done = sum(int(count) for count in counts if count is not None)  # type: ignore[union-attr]
+    # The current minute is only partly elapsed
+    elapsed = (len(buckets) - 1) * BUCKET_SECONDS + now % BUCKET_SECONDS
+    return done / elapsed
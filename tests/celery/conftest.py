@@ -6,3 +6,4 @@ from cp_server.tasks_server.celery_app import celery_app
 def configure_celery_for_tests():
     celery_app.conf.task_always_eager = True
     celery_app.conf.result_backend = 'cache'
+    celery_app.conf.cache_backend = 'memory'
@@ -0,0 +1,52 @@
+import math
+
+from cp_server.tasks_server import autoscaler
+from cp_server.tasks_server.autoscaler import LatencyAutoscaler, target_concurrency
+from cp_server.tasks_server.celery_app import celery_app
+
+
+class FakePool:
+    def __init__(self, num_processes: int):
+        self.num_processes = num_processes
+
+    def grow(self, n: int) -> None:
+        self.num_processes += n
+
+    def shrink(self, n: int) -> None:
+        self.num_processes -= n
+
+    def maintain_pool(self) -> None:
+        pass
+
+
+def test_autoscaler_is_configured():
+    assert celery_app.conf.worker_autoscaler == "cp_server.tasks_server.autoscaler:LatencyAutoscaler"
+
+def test_target_concurrency():
+    # Grows with the waiting time, within the maximum
+    assert target_concurrency(2, 4, 90.0, 0.5, 0.5, 1, 12) == 6
+    assert target_concurrency(2, 4, 900.0, 0.5, 0.5, 1, 12) == 12
+    assert target_concurrency(2, 4, math.inf, 0.5, 0.5, 1, 12) == 3
+    # Not without CPU or memory headroom, and shrinks when memory runs out
+    assert target_concurrency(2, 4, 90.0, 1.5, 0.5, 1, 12) == 2
+    assert target_concurrency(2, 4, 90.0, 0.5, 0.1, 1, 12) == 2
+    assert target_concurrency(4, 4, 90.0, 0.5, 0.05, 1, 12) == 3
+    # Idle queues: down to the reserved tasks, not below the minimum
+    assert target_concurrency(6, 3, 10.0, 0.5, 0.5, 1, 12) == 6
+    assert target_concurrency(6, 3, 0.0, 0.5, 0.5, 1, 12) == 3
+    assert target_concurrency(6, 0, 0.0, 0.5, 0.5, 2, 12) == 2
+
+def test_autoscaler_follows_the_queue_wait(monkeypatch):
+    monkeypatch.setattr(autoscaler, "host_load", lambda: 0.5)
+    monkeypatch.setattr(autoscaler, "available_memory", lambda: 0.5)
+    monkeypatch.setattr(autoscaler, "AUTOSCALE_INTERVAL", 0.0)
+    waits = iter([120.0, 0.0])
+    monkeypatch.setattr(LatencyAutoscaler, "queue_wait", lambda self: next(waits))
+
+    pool = FakePool(2)
+    scaler = LatencyAutoscaler(pool, 12, 2, keepalive=0.001)
+    scaler.maybe_scale()
+    assert pool.num_processes == 8
+    scaler._last_scale_up -= 1
+    scaler.maybe_scale()
+    assert pool.num_processes == 2
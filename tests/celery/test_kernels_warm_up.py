@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import cp_server.tasks_server.tasks.track.track as track
+from cp_server.tasks_server.celery_app import warm_tracking_kernels_on_init, warm_tracking_kernels_on_process_init
+
+
+def _kernels_ready_in_new_process(cache_dir, warm_up: bool) -> list[str]:
+    code = ("from cp_server.tasks_server.tasks.track.track import kernels_ready, warm_up_kernels\n"
+            "print(kernels_ready())\n"
+            + ("warm_up_kernels()\nprint(kernels_ready())\n" if warm_up else ""))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            env={**os.environ, "NUMBA_CACHE_DIR": str(cache_dir)})
+    return result.stdout.split()
+
+def test_kernels_ready_from_disk_cache(tmp_path):
+    # Cold cache: compiled by the warm-up, which fills the cache for the next processes
+    assert _kernels_ready_in_new_process(tmp_path, warm_up=True) == ["False", "True"]
+    assert _kernels_ready_in_new_process(tmp_path, warm_up=False) == ["True"]
+
+def test_child_does_not_compile_cold_kernels(monkeypatch):
+    calls = []
+    monkeypatch.setattr(track, "kernels_ready", lambda: False)
+    monkeypatch.setattr(track, "warm_up_kernels", lambda: calls.append("warm_up") or {})
+    warm_tracking_kernels_on_process_init()
+    assert calls == []
+
+    monkeypatch.setattr(track, "kernels_ready", lambda: True)
+    warm_tracking_kernels_on_process_init()
+    assert calls == ["warm_up"]
+
+def test_gpu_worker_skips_warm_up(monkeypatch):
+    calls = []
+    monkeypatch.setattr(track, "warm_up_kernels", lambda: calls.append("warm_up") or {})
+    warm_tracking_kernels_on_init(sender=type("Worker", (), {"hostname": "gpu@host"})())
+    assert calls == []
+    warm_tracking_kernels_on_init(sender=type("Worker", (), {"hostname": "default@host"})())
+    assert calls == ["warm_up"]
+
+def test_unreadable_cache_index_is_not_cached():
+    # numba internals changed: the kernel is reported as not cached instead of failing the worker start
+    assert not track._kernel_cached(object())
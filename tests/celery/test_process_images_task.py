@@ -1,8 +1,12 @@
 # Test for process_images task
 import numpy as np
+import pytest
 import tifffile as tiff
 
-from cp_server.tasks_server.tasks.celery_main_task import process_images
+from cp_server.tasks_server.tasks import celery_main_task
+from cp_server.tasks_server.tasks.celery_main_task import adaptive_chunk_size, chunk_paths, process_images
+from cp_server.tasks_server.utils import progress
+from cp_server.tasks_server.utils.memory_store import MemoryRedis
 
 
 def test_process_images(monkeypatch):
@@ -26,12 +30,16 @@ def test_process_images(monkeypatch):
     def dummy_chain(*args, **kwargs):
         captured_args["args"] = args
         class DummyChain:
+            def on_error(self, errback):
+                captured_args["errback"] = errback
+                return self
             def apply_async(self):
                 return "chain_applied"
         return DummyChain()
 
     # Patch the `chain` symbol imported in the module under test
     monkeypatch.setattr("cp_server.tasks_server.tasks.celery_main_task.chain", dummy_chain)
+    monkeypatch.setattr(progress, "redis_client", MemoryRedis())
 
     # Call process_images with current signature: img_path, cellpose_settings, dst_folder, well_id
     result = process_images(
@@ -41,12 +49,96 @@ def test_process_images(monkeypatch):
         key_label,
     )
     assert result == f"Image {img_file} was sent to be segmented"
-    # Ensure that chain was called with three tasks (remove_bg, segment, counter)
+    # Ensure that chain was called with four tasks (remove_bg, segment, counter, end of the chain)
     args = captured_args.get("args", ())
-    assert len(args) == 3
+    assert len(args) == 4
     # We check that both elements are celery signatures (they have a "name" attribute)
     assert hasattr(args[0], "name")
     assert hasattr(args[1], "name")
+    # The chain releases its image when it ends, successful or not
+    assert args[-1].kwargs["img_paths"] == [img_file]
+    assert captured_args["errback"].kwargs["img_paths"] == [img_file]
 
 
 
+
+def test_process_images_batch_fans_out(monkeypatch):
+    img_files = [f"dummy_{i}_refseg_1.tif" for i in range(5)]
+
+    chains = []
+    errbacks = []
+    def dummy_chain(*args, **kwargs):
+        chains.append(args)
+        class DummyChain:
+            def on_error(self, errback):
+                errbacks.append(errback)
+                return self
+            def apply_async(self):
+                return "chain_applied"
+        return DummyChain()
+
+    counters = {}
+    class DummyRedis:
+        def set(self, key, value, ex=None):
+            counters[key] = value
+
+    monkeypatch.setattr("cp_server.tasks_server.tasks.celery_main_task.chain", dummy_chain)
+    monkeypatch.setattr("cp_server.tasks_server.tasks.celery_main_task.redis_client", DummyRedis())
+    monkeypatch.setattr(progress, "redis_client", MemoryRedis())
+
+    result = process_images(img_files, {}, "dummy_folder", "well", chunk_size=2)
+
+    assert result == "Batch of 5 images sent to be segmented in 3 chains"
+    # One chain per chunk, in order and spread evenly, each ending with the batch counter
+    assert [chain_args[0].kwargs["img_path"] for chain_args in chains] == [img_files[0:2], img_files[2:3], img_files[3:]]
+    assert all(chain_args[-1].name.endswith("mark_chunk_done") for chain_args in chains)
+    # A failing chain is counted down too, by its error callback
+    assert [errback.name.rsplit(".", 1)[-1] for errback in errbacks] == ["mark_chunk_failed"] * 3
+    # Both release the images of their chunk
+    assert [chain_args[-1].kwargs["img_paths"] for chain_args in chains] == [errback.kwargs["img_paths"]
+                                                                           for errback in errbacks]
+    assert list(counters.values()) == [3]
+    # The images and the parameters of the run are recorded, to resume it after a crash
+    stages, _, params = progress.run_progress("well")
+    assert stages == {img_file: "submitted" for img_file in img_files}
+    assert params["dst_folder"] == "dummy_folder"
+    assert chains[0][0].kwargs["well_id"] == "well"
+
+def test_failed_chain_is_counted_down(monkeypatch):
+    from cp_server.tasks_server.tasks.bg_sub import bg_sub_task  # noqa: F401, registers remove_bg
+    from cp_server.tasks_server.tasks.counter import counter_task_manager
+    from cp_server.tasks_server.utils import failures
+
+    store = MemoryRedis()
+    for module in (celery_main_task, counter_task_manager, progress, failures):
+        monkeypatch.setattr(module, "redis_client", store)
+
+    # None of the images exist, so the first task of the chain fails (and, run eagerly, fails process_images too)
+    img_files = [f"missing_{i}_refseg_1.tif" for i in range(3)]
+    process_images.apply(args=[img_files, {}, "dummy_folder", "well"], kwargs=dict(chunk_size=3), task_id="batch")
+
+    assert store.get("failed_chunks:batch") == b"1"
+    assert store.exists("batch_done:batch")
+    assert not store.exists("pending_chunks:batch")
+
+@pytest.mark.parametrize("n_images, chunk_size, expected", [(8, 4, [4, 4]), (9, 4, [3, 3, 3]), (3, 8, [3])])
+def test_chunk_paths_even(n_images, chunk_size, expected):
+    img_files = [f"dummy_{i}_refseg_1.tif" for i in range(n_images)]
+    chunks = chunk_paths(img_files, chunk_size)
+    assert [len(chunk) for chunk in chunks] == expected
+    assert sum(chunks, []) == img_files
+
+@pytest.mark.parametrize("latency, expected", [
+    (None, 4),   # PROCESS_CHUNK_SIZE until a latency is recorded
+    (1.0, 14),   # 60 s target at 4.2 s per image (4.2 megapixels)
+    (100.0, 1),  # never below one image
+    (0.01, 16),  # within the pixel budget (64 Mpx of 4 Mpx images)
+])
+def test_adaptive_chunk_size(tmp_path, monkeypatch, latency, expected):
+    img_file = tmp_path / "A1P1_refseg_1.tif"
+    tiff.imwrite(img_file, np.zeros((2048, 2048), dtype=np.uint16))
+    monkeypatch.setattr(celery_main_task, "seg_latency", lambda: latency)
+
+    assert adaptive_chunk_size([str(img_file)] * 200) == expected
+    # Large batches only, small ones are still split for CHUNK_MIN_CHAINS workers
+    assert adaptive_chunk_size([str(img_file)] * 6) == min(expected, 2)
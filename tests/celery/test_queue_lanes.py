@@ -0,0 +1,30 @@
+import pytest
+
+from cp_server.tasks_server.celery_app import GPU_INTERACTIVE_QUEUE, GPU_QUEUE, create_celery_app
+
+
+@pytest.mark.parametrize("include_tasks", [True, False])
+@pytest.mark.parametrize("task_name, queue", [
+    ("cp_server.tasks_server.tasks.segementation.seg_task.optimize_cellpose_settings", GPU_INTERACTIVE_QUEUE),
+    ("cp_server.tasks_server.tasks.segementation.seg_task.cellpose_metadata", GPU_INTERACTIVE_QUEUE),
+    ("cp_server.tasks_server.tasks.segementation.seg_task.segment", GPU_QUEUE),
+    ("cp_server.tasks_server.tasks.segementation.seg_task.bg_sub_and_segment", GPU_QUEUE),
+])
+def test_gpu_task_lanes(include_tasks, task_name, queue):
+    # The API app (without tasks) must route the interactive tasks as the workers do
+    app = create_celery_app(include_tasks=include_tasks)
+    route = app.amqp.router.route({}, task_name)
+    assert route["queue"].name == queue
+
+def test_queue_order_strategy():
+    app = create_celery_app()
+    assert app.conf.broker_transport_options["queue_order_strategy"] == "priority"
+
+def test_results_are_opt_in():
+    from cp_server.tasks_server.tasks.segementation import seg_task
+    from cp_server.tasks_server.tasks.track.track_task import track_cells
+
+    assert create_celery_app().conf.task_ignore_result
+    assert track_cells.ignore_result
+    assert not seg_task.optimize_cellpose_settings.ignore_result
+    assert not seg_task.cellpose_metadata.ignore_result
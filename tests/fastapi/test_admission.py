@@ -0,0 +1,66 @@
+import pytest
+from fastapi import HTTPException
+
+from cp_server.fastapi_app.endpoints import admission
+from cp_server.fastapi_app.endpoints.admission import check_admission, parse_queue_limits
+
+
+class FakeRedis:
+    """
+    The few commands used by the admission control, on queue lengths, memory info and throughput counters.
+    """
+    def __init__(self, depths, used_memory=0, maxmemory=0, counters=None):
+        self.depths, self.counters = depths, counters or {}
+        self.memory = {"used_memory": used_memory, "maxmemory": maxmemory}
+        self.commands = []
+
+    def pipeline(self):
+        self.commands = []
+        return self
+
+    def llen(self, queue):
+        self.commands.append(self.depths.get(queue, 0))
+
+    def info(self, section):
+        self.commands.append(self.memory)
+
+    def execute(self):
+        return self.commands
+
+    def mget(self, keys):
+        return [self.counters.get(key.split(":")[1]) for key in keys]
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(admission, "QUEUE_LIMITS", {"celery": 100, "gpu_tasks": 10})
+
+def test_parse_queue_limits():
+    assert parse_queue_limits("celery=5000, gpu_tasks=1000,") == {"celery": 5000, "gpu_tasks": 1000}
+    with pytest.raises(ValueError):
+        parse_queue_limits("celery")
+
+def test_admitted_under_limits(monkeypatch, limits):
+    monkeypatch.setattr(admission, "redis_client", FakeRedis({"celery": 99, "gpu_tasks": 9}))
+    check_admission()
+
+def test_full_queue_retry_after_from_throughput(monkeypatch, limits):
+    # 1 task per minute and per bucket over the window, 1/60 task per second
+    monkeypatch.setattr(admission, "redis_client", FakeRedis({"gpu_tasks": 14}, counters={"gpu_tasks": b"1"}))
+    with pytest.raises(HTTPException) as error:
+        check_admission()
+    assert error.value.status_code == 429
+    # 5 tasks to drain to get under the limit, at about 1 task per minute
+    assert 250 <= int(error.value.headers["Retry-After"]) <= 330
+
+def test_full_queue_without_throughput(monkeypatch, limits):
+    monkeypatch.setattr(admission, "redis_client", FakeRedis({"celery": 100}))
+    with pytest.raises(HTTPException) as error:
+        check_admission()
+    assert error.value.headers["Retry-After"] == str(admission.ADMISSION_RETRY_AFTER)
+
+def test_redis_memory_full(monkeypatch, limits):
+    monkeypatch.setattr(admission, "redis_client", FakeRedis({}, used_memory=90, maxmemory=100))
+    with pytest.raises(HTTPException) as error:
+        check_admission()
+    assert error.value.status_code == 429
@@ -0,0 +1,90 @@
+import os
+
+from cp_server.fastapi_app.endpoints import dedup
+from cp_server.fastapi_app.endpoints.dedup import claim_images
+from cp_server.tasks_server.utils import claims
+from cp_server.tasks_server.utils.claims import INFLIGHT_IMAGES_KEY, release_claims
+
+
+class FakeRedis:
+    """
+    The few commands used by the deduplication, on an in-memory dict (expiry ignored).
+    """
+    def __init__(self):
+        self.store, self.commands = {}, []
+
+    def pipeline(self):
+        self.commands = []
+        return self
+
+    def set(self, key, value, nx=False, ex=None):
+        is_new = not (nx and key in self.store)
+        if is_new:
+            self.store[key] = value.encode()
+        self.commands.append(is_new or None)
+
+    def execute(self):
+        return self.commands
+
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def hset(self, key, mapping):
+        self.store.setdefault(key, {}).update({field: value.encode() for field, value in mapping.items()})
+
+    def hmget(self, key, fields):
+        return [self.store.get(key, {}).get(field) for field in fields]
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.store.get(key, {}).pop(field, None)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.store.pop(key.decode() if isinstance(key, bytes) else key, None)
+
+    def expire(self, key, ttl):
+        pass
+
+
+def test_claim_images_dedup(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedup, "redis_client", FakeRedis())
+    img_paths = [str(tmp_path / f"A1P{i}_refseg_1.tif") for i in range(3)]
+    for img_path in img_paths:
+        open(img_path, "w").close()
+    params = {"img_path": img_paths, "sigma": 0.0, "well_id": "A1"}
+
+    assert claim_images(img_paths[:2], params, "task-1") == {}
+    # Retried submission: the first two images attach to the first task
+    assert claim_images(img_paths, params, "task-2") == {img_paths[0]: "task-1", img_paths[1]: "task-1"}
+    # Other settings, or a new acquisition at the same path, are processed again
+    assert claim_images(img_paths[:1], {**params, "sigma": 1.0}, "task-3") == {}
+    stat = os.stat(img_paths[1])
+    os.utime(img_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert claim_images(img_paths[1:2], params, "task-4") == {}
+
+
+def test_claim_images_listed_twice(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedup, "redis_client", FakeRedis())
+    img_path = str(tmp_path / "A1P1_refseg_1.tif")
+    open(img_path, "w").close()
+
+    # An image listed twice in a submission is not a duplicate of itself
+    assert claim_images([img_path, img_path], {"well_id": "A1"}, "task-1") == {}
+    assert claim_images([img_path], {"well_id": "A1"}, "task-2") == {img_path: "task-1"}
+
+
+def test_released_images_are_processed_again(tmp_path, monkeypatch):
+    store = FakeRedis()
+    monkeypatch.setattr(dedup, "redis_client", store)
+    monkeypatch.setattr(claims, "redis_client", store)
+    img_paths = [str(tmp_path / f"A1P{i}_refseg_1.tif") for i in range(2)]
+    for img_path in img_paths:
+        open(img_path, "w").close()
+    params = {"well_id": "A1"}
+
+    assert claim_images(img_paths, params, "task-1") == {}
+    # The first image is done (or failed for good), the second is still processed
+    release_claims(img_paths[:1])
+    assert claim_images(img_paths, params, "task-2") == {img_paths[1]: "task-1"}
+    assert list(store.store[INFLIGHT_IMAGES_KEY]) == img_paths[1:] + img_paths[:1]
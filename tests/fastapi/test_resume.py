@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from cp_server.fastapi_app.endpoints import process_tasks
+from cp_server.fastapi_app.endpoints.process_tasks import resume_run_endpoint
+from cp_server.tasks_server.utils import progress
+from cp_server.tasks_server.utils.claims import INFLIGHT_IMAGES_KEY
+from cp_server.tasks_server.utils.memory_store import MemoryRedis
+from cp_server.tasks_server.utils.progress import SEGMENTED, SUBMITTED, record_batch, record_params, record_stage
+
+
+def test_resume_waits_for_the_run_then_resets_the_pending_tracks(monkeypatch):
+    store = MemoryRedis()
+    monkeypatch.setattr(process_tasks, "redis_client", store)
+    monkeypatch.setattr(progress, "redis_client", store)
+    monkeypatch.setattr(process_tasks, "check_admission", lambda: None)
+    sent = []
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(celery_app=SimpleNamespace(
+        send_task=lambda name, **options: sent.append((name, options)) or SimpleNamespace(id="task-2")))))
+
+    # FOV 0 segmented but not tracked, FOV 1 not segmented, FOV 2 tracked
+    imgs = {(fov, t): f"/data/A1_well/A1P{fov}_refseg_{t}.tif" for fov in range(3) for t in (1, 2)}
+    record_params("A1", {"track_stitch_threshold": 0.75, "track_overlap_mode": "dense", "track_matching": "greedy"})
+    record_stage("A1", list(imgs.values()), SUBMITTED)
+    for fov, t in [(0, 1), (0, 2), (2, 1), (2, 2)]:
+        record_stage("A1", [imgs[fov, t]], SEGMENTED, {f"/data/A1_well/A1_masks/A1P{fov}_mask_{t}.tif": imgs[fov, t]})
+    progress.record_tracked("A1", ["/data/A1_well/A1_masks/A1P2_mask_1.tif", "/data/A1_well/A1_masks/A1P2_mask_2.tif"])
+
+    # Refused while a chain of a batch of the run is counted down, or an image not tracked is claimed
+    record_batch("A1", "task-1")
+    store.set("pending_chunks:task-1", 1)
+    with pytest.raises(HTTPException) as error:
+        resume_run_endpoint(request, "A1")
+    assert error.value.status_code == 409
+    store.delete("pending_chunks:task-1")
+    store.hset(INFLIGHT_IMAGES_KEY, mapping={imgs[1, 2]: "inflight:1"})
+    store.set("inflight:1", "task-1")
+    with pytest.raises(HTTPException) as error:
+        resume_run_endpoint(request, "A1")
+    assert error.value.status_code == 409
+    assert not sent
+
+    # Resumed once the claim expired, with a track pending for each FOV not tracked yet
+    store.delete("inflight:1")
+    result = resume_run_endpoint(request, "A1")
+    assert result == {"well_id": "A1", "task_id": "task-2", "images_sent": 2, "fovs_tracked": 1}
+    assert store.get("pending_tracks:A1") == b"2"
+    assert [name.rsplit(".", 1)[-1] for name, _ in sent] == ["process_images", "check_and_track"]
@@ -1,6 +1,8 @@
 import numpy as np
 
-from cp_server.tasks_server.tasks.bg_sub.bg_sub import apply_bg_sub
+from smo import SMO
+
+from cp_server.tasks_server.tasks.bg_sub.bg_sub import apply_bg_sub, apply_bg_sub_stack, bin_image, estimate_background, get_smo
 
 
 def test_apply_bg_sub(img):
@@ -10,4 +12,54 @@ def test_apply_bg_sub(img):
     assert bg_img.shape == img.shape
     assert bg_img.dtype == img.dtype
     assert np.all(bg_img >= 0)
-    assert not np.array_equal(bg_img, img), "The background-subtracted image should be different from the original image"
\ No newline at end of file
+    assert not np.array_equal(bg_img, img), "The background-subtracted image should be different from the original image"
+
+def test_smo_instance_is_reused(img):
+
+    apply_bg_sub(img)
+    hits = get_smo.cache_info().hits
+    apply_bg_sub(img)
+
+    assert get_smo.cache_info().hits == hits + 1
+    assert get_smo(img.shape, 0.0, 7) is get_smo(img.shape, 0.0, 7)
+
+def test_cached_smo_gives_same_result(img):
+
+    fresh = SMO(shape=img.shape, sigma=0.0, size=7).bg_corrected(img)
+    fresh[fresh<0] = 0
+
+    np.testing.assert_array_equal(apply_bg_sub(img), fresh.astype(img.dtype))
+
+def test_bin_image():
+
+    img = np.arange(36, dtype=np.uint16).reshape(6, 6)
+    img[5, 5] = 1000
+
+    binned = bin_image(img, 4)
+
+    assert binned.shape == (1, 1)
+    assert binned[0, 0] == img[:4, :4].mean()
+    assert bin_image(img, 2).mask.sum() == 1
+
+def test_binned_background_is_close():
+
+    rng = np.random.default_rng(0)
+    img = rng.normal(1000, 50, (512, 512)).astype(np.uint16)
+    img[100:200, 100:200] += 5000
+
+    background = estimate_background(img)
+    assert abs(estimate_background(img, bin_factor=4) - background) < 5
+    bg_img = apply_bg_sub(img, bin_factor=4)
+    assert bg_img.dtype == img.dtype
+    assert np.all(bg_img >= 0)
+
+def test_stack_matches_single_images():
+
+    rng = np.random.default_rng(0)
+    stack = rng.normal(1000, 50, (3, 128, 128)).astype(np.uint16)
+    stack[:, 30:60, 30:60] += 5000
+    stack[1, 0, 0] = 65535
+
+    for bin_factor in (1, 2):
+        expected = np.stack([apply_bg_sub(img, bin_factor=bin_factor) for img in stack])
+        np.testing.assert_array_equal(apply_bg_sub_stack(stack, bin_factor=bin_factor), expected)
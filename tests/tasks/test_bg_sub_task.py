@@ -0,0 +1,100 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+
+import numpy as np
+import tifffile as tiff
+from billiard.pool import Pool
+
+from cp_server.tasks_server.tasks.bg_sub.bg_sub import apply_bg_sub
+from cp_server.tasks_server.tasks.bg_sub import bg_sub_task
+from cp_server.tasks_server.tasks.bg_sub.bg_sub_task import _process_single_bg, bg_sub_params, load_bg_sub, remove_bg
+from cp_server.tasks_server.tasks.saving.save_arrays import read_bg_sub_params
+from cp_server.tasks_server.utils import failures
+
+
+def test_process_pool_matches_threads(tmp_path, img):
+    thread_path = str(tmp_path / "A1_refseg_1.tif")
+    process_path = str(tmp_path / "A2_refseg_1.tif")
+    tiff.imwrite(thread_path, img)
+    tiff.imwrite(process_path, img)
+
+    _process_single_bg(thread_path, 0.0, 7)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as pool:
+        _process_single_bg(process_path, 0.0, 7, pool=pool)
+
+    np.testing.assert_array_equal(tiff.imread(process_path), tiff.imread(thread_path))
+    np.testing.assert_array_equal(tiff.imread(process_path), apply_bg_sub(img))
+
+def _remove_bg_in_worker(img_paths: list[str]) -> tuple[bool, list[int], list[str]]:
+    done = remove_bg(img_paths, 0.0, 7)
+    pool = bg_sub_task._process_pool
+    return multiprocessing.current_process().daemon, list(pool._processes) if pool is not None else [], done
+
+def _is_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+def test_process_pool_runs_in_prefork_child(tmp_path, img, monkeypatch):
+    monkeypatch.setattr(bg_sub_task, "BG_SUB_EXECUTOR", "process")
+    monkeypatch.setattr(bg_sub_task, "BG_SUB_PARENT_CHECK", 0.1)
+    img_paths = [str(tmp_path / f"A{i}_refseg_1.tif") for i in range(2)]
+    for img_path in img_paths:
+        tiff.imwrite(img_path, img)
+
+    # Billiard pool, as the prefork pool of the worker, whose processes are daemonic
+    pool = Pool(1)
+    try:
+        daemon, pids, done = pool.apply(_remove_bg_in_worker, (img_paths,))
+    finally:
+        # Killed as Celery terminates its children: the processes of the bg-sub pool must not outlive them
+        pool.terminate()
+        pool.join()
+
+    assert daemon and pids
+    assert done == img_paths
+    for img_path in img_paths:
+        np.testing.assert_array_equal(tiff.imread(img_path), apply_bg_sub(img))
+    deadline = time.monotonic() + 5
+    while any(map(_is_running, pids)) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not any(map(_is_running, pids))
+
+def test_bg_sub_is_not_applied_twice(tmp_path, img):
+    img_path = str(tmp_path / "A1_refseg_1.tif")
+    tiff.imwrite(img_path, img)
+
+    _process_single_bg(img_path, 0.0, 7)
+    assert read_bg_sub_params(img_path) == bg_sub_params(0.0, 7)
+    bg_img = tiff.imread(img_path)
+
+    _process_single_bg(img_path, 0.0, 7)
+    np.testing.assert_array_equal(tiff.imread(img_path), bg_img)
+
+    loaded, subtracted = load_bg_sub(img_path, 0.0, 7)
+    assert not subtracted
+    np.testing.assert_array_equal(loaded, bg_img)
+
+def test_remove_bg_batches_match_single_images(tmp_path, img):
+    img_paths = [str(tmp_path / f"A{i}_refseg_1.tif") for i in range(3)]
+    for img_path in img_paths:
+        tiff.imwrite(img_path, img)
+
+    assert remove_bg(img_paths, 0.0, 7) == img_paths
+    for img_path in img_paths:
+        np.testing.assert_array_equal(tiff.imread(img_path), apply_bg_sub(img))
+        assert read_bg_sub_params(img_path) == bg_sub_params(0.0, 7)
+
+def test_remove_bg_skips_unreadable_images(tmp_path, img, monkeypatch):
+    monkeypatch.setattr(failures, "ITEM_RETRY_BACKOFF", 0.0)
+    monkeypatch.setattr(failures, "record_failures", lambda errors, stage: None)
+    img_paths = [str(tmp_path / f"A{i}_refseg_1.tif") for i in range(3)]
+    for img_path in img_paths:
+        tiff.imwrite(img_path, img)
+    (tmp_path / "A1_refseg_1.tif").write_bytes(b"not a tiff")
+
+    assert remove_bg(img_paths, 0.0, 7) == [img_paths[0], img_paths[2]]
+    assert read_bg_sub_params(img_paths[2]) == bg_sub_params(0.0, 7)
@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+from celery import signature
+from celery.app.task import Context
+
+from cp_server.tasks_server.utils import failures
+from cp_server.tasks_server.utils.failures import CHAIN_END_TASKS, retry_later
+
+
+def _retrying_task(attempt: int, rest: list | None = None) -> SimpleNamespace:
+    """
+    A bound task running in a worker (not eagerly), which records the runs it sends.
+    """
+    request = Context(called_directly=False, is_eager=False, chain=rest, errbacks=["errback"],
+                      kwargs={"img_path": ["a", "b", "c"], "sigma": 1.0, "attempt": attempt})
+    sent = []
+    return SimpleNamespace(request=request, sent=sent, apply_async=lambda **options: sent.append(options))
+
+
+def test_retry_later_hands_the_chain_end_to_the_retry(monkeypatch):
+    recorded = {}
+    monkeypatch.setattr(failures, "record_failures", lambda errors, stage: recorded.update(errors))
+    end = signature(CHAIN_END_TASKS[0], args=["batch"])
+    # The rest of the chain as in the request of a task: last task first, the error callback of the chain on each
+    track = signature("track").on_error(signature(CHAIN_END_TASKS[1]))
+    rest = [dict(end), dict(track)]
+    task = _retrying_task(0, rest)
+
+    assert retry_later(task, {"b": OSError("cannot read b")}, 0, "bg_sub")
+    # The failed item alone, later, with the whole rest of the chain and the error callbacks
+    [options] = task.sent
+    assert options["kwargs"] == {"img_path": ["b"], "sigma": 1.0, "attempt": 1}
+    assert options["countdown"] == failures.ITEM_RETRY_BACKOFF
+    assert options["chain"] == rest and options["link_error"] == ["errback"]
+    # This run goes on without the end of the chain
+    assert [step.task for step in task.request.chain] == ["track"]
+    assert task.request.chain[0].options["link_error"] == []
+    assert not recorded
+
+def test_retry_later_records_the_last_failures(monkeypatch):
+    recorded = {}
+    monkeypatch.setattr(failures, "record_failures", lambda errors, stage: recorded.update(errors))
+    task = _retrying_task(failures.ITEM_RETRIES, [dict(signature("track"))])
+
+    assert not retry_later(task, {"b": OSError("cannot read b")}, failures.ITEM_RETRIES, "bg_sub")
+    assert not task.sent and list(recorded) == ["b"]
+    # A caller waiting for the result isn't retried later either
+    task = _retrying_task(0)
+    task.request.is_eager = True
+    assert not retry_later(task, {"c": OSError("cannot read c")}, 0, "bg_sub")
+    assert not task.sent and list(recorded) == ["b", "c"]
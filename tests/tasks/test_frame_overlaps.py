@@ -0,0 +1,44 @@
+import numpy as np
+
+from cp_server.tasks_server.tasks.track.track import frame_overlaps, project_overlaps, track_luts, track_masks
+
+
+def _moving_cells():
+    # Two cells drifting to the right, a third one only present in frame0.
+    frame0 = np.array([[1, 1, 0, 0, 2, 2, 0, 3],
+                       [1, 1, 0, 0, 2, 2, 0, 3]], dtype=np.uint16)
+    frame1 = np.array([[0, 2, 2, 0, 0, 1, 1, 0],
+                       [0, 2, 2, 0, 0, 1, 1, 0]], dtype=np.uint16)
+    return np.stack([frame0, frame1])
+
+def test_frame_overlaps_table():
+    masks = _moving_cells()
+    overlaps = frame_overlaps(masks)
+    assert len(overlaps) == 1
+    # Columns: label in frame1, label in frame0, pixel count
+    expected = np.array([[0, 0, 2],
+                         [0, 1, 2],
+                         [0, 2, 2],
+                         [0, 3, 2],
+                         [1, 0, 2],
+                         [1, 2, 2],
+                         [2, 0, 2],
+                         [2, 1, 2]])
+    np.testing.assert_array_equal(overlaps[0], expected)
+
+def test_cached_overlaps_give_same_tracks():
+    masks = _moving_cells()
+    overlaps = frame_overlaps(masks)
+    np.testing.assert_array_equal(track_masks(masks, 0.25, overlaps), track_masks(masks, 0.25))
+
+def test_project_overlaps_matches_tracked_masks():
+    masks = _moving_cells()
+    overlaps = frame_overlaps(masks)
+    luts = track_luts(overlaps, 0.25)
+    tracked = track_masks(masks, 0.25)
+    for projected, direct in zip(project_overlaps(overlaps, luts), frame_overlaps(tracked)):
+        np.testing.assert_array_equal(projected, direct)
+
+def test_bbox_mode_matches_dense_mode():
+    masks = _moving_cells()
+    np.testing.assert_array_equal(frame_overlaps(masks, overlap_mode="bbox")[0], frame_overlaps(masks)[0])
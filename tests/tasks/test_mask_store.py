@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import zipfile
+
+import numpy as np
+import pytest
+
+from cp_server.tasks_server.tasks.saving import mask_store
+from cp_server.tasks_server.tasks.saving.mask_store import is_store_path, member_identity, store_exists
+from cp_server.tasks_server.tasks.saving.save_arrays import (extract_fov_id, generate_mask_path,
+                                                              generate_track_stats_path, load_mask, save_mask,
+                                                              save_track_stats)
+
+
+@pytest.fixture
+def well_storage(monkeypatch):
+    monkeypatch.setattr(mask_store, "MASK_STORAGE", "well")
+
+def test_generate_mask_path_in_container(tmp_path, well_storage):
+    mask_path = generate_mask_path("/data/A1P1_refseg_1.tif", str(tmp_path / "A1_well" / "A1_masks"))
+    assert mask_path == tmp_path / "A1_well" / "A1_masks.zip" / "A1P1_mask_1.tif"
+    assert mask_path.parent.parent.is_dir()
+    assert is_store_path(mask_path)
+    assert extract_fov_id(str(mask_path)) == ("A1P1", "1")
+
+def test_save_load_mask_in_container(tmp_path, well_storage):
+    masks = [np.random.randint(0, 300, (64, 64)) for _ in range(3)]
+    mask_paths = [generate_mask_path(f"/data/A1P{i}_refseg_1.tif", str(tmp_path / "A1_masks")) for i in range(3)]
+    for mask, mask_path in zip(masks, mask_paths):
+        save_mask(mask, str(mask_path))
+
+    # A single container holds all the masks, each read back on its own
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == ".zip"] == ["A1_masks.zip"]
+    for mask, mask_path in zip(masks, mask_paths):
+        assert store_exists(mask_path)
+        np.testing.assert_array_equal(load_mask(str(mask_path)), mask)
+    assert not store_exists(tmp_path / "A1_masks.zip" / "A1P9_mask_1.tif")
+
+def test_rewritten_mask_supersedes(tmp_path, well_storage):
+    mask_path = generate_mask_path("/data/A1P1_refseg_2.tif", str(tmp_path / "A1_masks"))
+    save_mask(np.ones((8, 8), dtype=np.uint16), str(mask_path))
+    identity = member_identity(mask_path)
+    save_mask(np.full((8, 8), 2, dtype=np.uint16), str(mask_path))
+
+    np.testing.assert_array_equal(load_mask(str(mask_path)), 2)
+    assert member_identity(mask_path) != identity
+    # The superseded copy is no longer listed
+    with zipfile.ZipFile(mask_path.parent) as zf:
+        assert zf.namelist() == ["A1P1_mask_2.tif"]
+
+def test_rewritten_masks_are_compacted(tmp_path, well_storage):
+    mask_paths = [generate_mask_path(f"/data/A1P{i}_refseg_1.tif", str(tmp_path / "A1_masks")) for i in range(4)]
+    for mask_path in mask_paths:
+        save_mask(np.random.randint(0, 300, (64, 64)), str(mask_path))
+    live_size = mask_paths[0].parent.stat().st_size
+
+    # Tracking rewrites every mask, several times
+    for value in range(1, 6):
+        for mask_path in mask_paths:
+            save_mask(np.full((64, 64), value, dtype=np.uint16), str(mask_path))
+            assert mask_path.parent.stat().st_size <= mask_store.STORE_COMPACT_RATIO * live_size
+    for mask_path in mask_paths:
+        np.testing.assert_array_equal(load_mask(str(mask_path)), 5)
+
+def _die_mid_write(mask_path: str, data: bytes) -> None:
+    # Write half of the member, then die as if killed
+    def write(self, chunk):
+        self._fileobj.write(chunk[:len(chunk) // 2])
+        self._fileobj.flush()
+        os._exit(1)
+    zipfile._ZipWriteFile.write = write
+    mask_store.write_member(mask_path, data)
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_writer_killed_mid_write_leaves_the_container(tmp_path, well_storage, monkeypatch, compact):
+    mask_paths = [generate_mask_path(f"/data/A1P{i}_refseg_1.tif", str(tmp_path / "A1_masks")) for i in range(3)]
+    masks = [np.full((64, 64), i + 1, dtype=np.uint16) for i in range(2)]
+    for mask, mask_path in zip(masks, mask_paths):
+        save_mask(mask, str(mask_path))
+    identities = [member_identity(mask_path) for mask_path in mask_paths[:2]]
+
+    # Killed while appending a new mask, or while rewriting the container to compact it
+    monkeypatch.setattr(mask_store, "STORE_COMPACT_RATIO", 0.0 if compact else 2.0)
+    writer = multiprocessing.get_context("fork").Process(
+        target=_die_mid_write, args=(str(mask_paths[2]), os.urandom(256 * 1024)))
+    writer.start()
+    writer.join()
+    assert writer.exitcode == 1
+
+    # The masks written before are intact, and the partial one is not there
+    assert not store_exists(mask_paths[2])
+    assert [member_identity(mask_path) for mask_path in mask_paths[:2]] == identities
+    for mask, mask_path in zip(masks, mask_paths):
+        np.testing.assert_array_equal(load_mask(str(mask_path)), mask)
+    # The next writer goes on from there
+    monkeypatch.setattr(mask_store, "STORE_COMPACT_RATIO", 2.0)
+    save_mask(np.full((64, 64), 3, dtype=np.uint16), str(mask_paths[2]))
+    with zipfile.ZipFile(mask_paths[2].parent) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(mask_path.name for mask_path in mask_paths)
+    np.testing.assert_array_equal(load_mask(str(mask_paths[2])), 3)
+
+def test_track_stats_in_container(tmp_path, well_storage):
+    mask_path = generate_mask_path("/data/A1P1_refseg_1.tif", str(tmp_path / "A1_masks"))
+    stats_path = generate_track_stats_path(str(mask_path))
+    save_track_stats({"area": np.array([4, 2])}, str(stats_path), [str(mask_path)])
+
+    with zipfile.ZipFile(mask_path.parent) as zf:
+        assert zf.namelist() == ["A1P1_tracks.npz"]
+    assert not (tmp_path / "A1P1_tracks.npz").exists()
+
+def test_tiff_storage_is_default(tmp_path):
+    mask_path = generate_mask_path("/data/A1P1_refseg_1.tif", str(tmp_path / "A1_masks"))
+    assert mask_path == tmp_path / "A1_masks" / "A1P1_mask_1.tif"
+    assert not is_store_path(mask_path)
@@ -0,0 +1,32 @@
+import numpy as np
+
+from cp_server.tasks_server.tasks.track.track import _match_assignment, _match_greedy
+
+
+# Overlap table (label next frame, label previous frame, pixel count) where every cell covers 10 pixels:
+# - next cell 1 overlaps previous cell 1 (IOU 6/14) and previous cell 2 (IOU 4/16)
+# - next cell 2 only overlaps previous cell 1 (IOU 4/16)
+PAIRS = np.array([[0, 0, 100],
+                  [0, 2, 6],
+                  [1, 1, 6],
+                  [1, 2, 4],
+                  [2, 0, 6],
+                  [2, 1, 4]])
+
+def test_greedy_takes_best_overlap():
+    # Next cell 1 takes previous cell 1, which leaves next cell 2 unmatched
+    np.testing.assert_array_equal(_match_greedy(PAIRS, 0.2), [1, 0])
+
+def test_assignment_maximizes_total_iou():
+    # Swapping the pairs matches both cells, for a higher total IOU (0.5 vs 0.43)
+    np.testing.assert_array_equal(_match_assignment(PAIRS, 0.2), [2, 1])
+
+def test_assignment_respects_threshold():
+    # Only the pair with IOU 6/14 is above the threshold
+    np.testing.assert_array_equal(_match_assignment(PAIRS, 0.3), [1, 0])
+
+def test_assignment_no_overlap():
+    pairs = np.array([[0, 0, 10],
+                      [0, 1, 5],
+                      [1, 0, 5]])
+    np.testing.assert_array_equal(_match_assignment(pairs, 0.1), [0])
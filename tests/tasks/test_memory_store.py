@@ -0,0 +1,55 @@
+import time
+
+from cp_server.tasks_server.utils.memory_store import MemoryRedis
+
+
+def test_memory_redis_counters_and_expiry():
+    store = MemoryRedis()
+    assert store.set("pending_chunks:b1", 2, ex=60)
+    assert store.decr("pending_chunks:b1") == 1
+    assert store.get("pending_chunks:b1") == b"1"
+    assert store.setnx("pending_chunks:b1", 5) is False
+
+    assert store.set("inflight:a", "task-1", nx=True, ex=0.05)
+    assert store.set("inflight:a", "task-2", nx=True) is None
+    assert store.mget(["inflight:a", "missing"]) == [b"task-1", None]
+    time.sleep(0.06)
+    assert not store.exists("inflight:a")
+    assert store.set("inflight:a", "task-2", nx=True)
+
+def test_memory_redis_hashes_lists_and_pipeline():
+    store = MemoryRedis()
+    store.hset("masks:run1:A1P1", "1", "/data/A1P1_mask_1.tif")
+    store.hset("masks:run1:A1P1", mapping={"2": "/data/A1P1_mask_2.tif"})
+    assert store.hlen("masks:run1:A1P1") == 2
+    assert sorted(store.hvals("masks:run1:A1P1")) == [b"/data/A1P1_mask_1.tif", b"/data/A1P1_mask_2.tif"]
+    assert list(store.scan_iter(match="masks:run1:*")) == [b"masks:run1:A1P1"]
+
+    pipe = store.pipeline()
+    for value in range(5):
+        pipe.lpush("latency:segment", value)
+    pipe.ltrim("latency:segment", 0, 2)
+    pipe.llen("latency:segment")
+    pipe.info("memory")
+    *_, length, memory = pipe.execute()
+    assert length == 3
+    assert memory["maxmemory"] == 0
+    assert store.lrange("latency:segment", 0, -1) == [b"4", b"3", b"2"]
+
+    assert store.delete("masks:run1:A1P1", "latency:segment") == 2
+    assert not store.exists("masks:run1:A1P1")
+
+def test_memory_redis_transaction():
+    store = MemoryRedis()
+    store.hset("progress:run1", mapping={"a": "segmented"})
+
+    def _advance(pipe):
+        current = pipe.hget("progress:run1", "a")
+        pipe.multi()
+        pipe.hset("progress:run1", "b", current)
+        pipe.expire("progress:run1", 60)
+        return current
+
+    assert store.transaction(_advance, "progress:run1") == [1, True]
+    assert store.transaction(_advance, "progress:run1", value_from_callable=True) == b"segmented"
+    assert store.hgetall("progress:run1") == {b"a": b"segmented", b"b": b"segmented"}
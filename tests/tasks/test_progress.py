@@ -0,0 +1,46 @@
+from cp_server.tasks_server.utils import progress
+from cp_server.tasks_server.utils.memory_store import MemoryRedis
+from cp_server.tasks_server.utils.progress import (BG_SUBTRACTED, SEGMENTED, SUBMITTED, missing_stages, record_params,
+                                                   record_stage, record_tracked, run_progress, untracked_fovs)
+
+
+def test_progress_ledger_and_missing_stages(monkeypatch):
+    monkeypatch.setattr(progress, "redis_client", MemoryRedis())
+    imgs = {(fov, t): f"/data/A1_well/A1P{fov}_refseg_{t}.tif" for fov in range(4) for t in (1, 2)}
+    mask = lambda fov, t: f"/data/A1_well/A1_masks/A1P{fov}_mask_{t}.tif"
+    record_params("run-A1", {"track_stitch_threshold": 0.75})
+    record_stage("run-A1", list(imgs.values()), SUBMITTED)
+    record_stage("run-A1", [imgs[0, 1], imgs[0, 2], imgs[1, 1], imgs[1, 2], imgs[2, 1]], BG_SUBTRACTED)
+    for fov, t in [(0, 1), (0, 2), (1, 1), (1, 2), (2, 1)]:
+        record_stage("run-A1", [imgs[fov, t]], SEGMENTED, {mask(fov, t): imgs[fov, t]})
+    # FOV 0 was tracked, FOV 1 crashed before tracking, FOV 2 before its second time point, FOV 3 before bg-sub
+    record_tracked("run-A1", [mask(0, 1), mask(0, 2)])
+    record_tracked("run-A1", ["/data/registered/A1P9_mask_2.tif"])
+
+    stages, masks, params = run_progress("run-A1")
+    assert params == {"track_stitch_threshold": 0.75}
+    assert stages[imgs[0, 1]] == stages[imgs[0, 2]] == "tracked"
+    assert masks[imgs[1, 2]] == mask(1, 2)
+
+    img_paths, fovs = missing_stages(stages, masks)
+    assert sorted(img_paths) == [imgs[2, 2], imgs[3, 1], imgs[3, 2]]
+    assert fovs == {"A1P1": {"1": mask(1, 1), "2": mask(1, 2)}}
+
+def test_run_progress_of_unknown_run(monkeypatch):
+    monkeypatch.setattr(progress, "redis_client", MemoryRedis())
+    assert run_progress("run-B2") == ({}, {}, None)
+
+def test_stages_only_move_forward(monkeypatch):
+    monkeypatch.setattr(progress, "redis_client", MemoryRedis())
+    img_paths = [f"/data/A1_well/A1P{fov}_refseg_1.tif" for fov in range(3)]
+    record_stage("run-A1", img_paths, SUBMITTED)
+    record_stage("run-A1", img_paths[:1], SEGMENTED, {"/data/A1_well/A1_masks/A1P0_mask_1.tif": img_paths[0]})
+    # A late report of an earlier stage, and a submission again, don't move an image back
+    record_stage("run-A1", img_paths[:2], BG_SUBTRACTED)
+    record_stage("run-A1", img_paths, SUBMITTED)
+
+    stages, masks, _ = run_progress("run-A1")
+    assert stages == {img_paths[0]: SEGMENTED, img_paths[1]: BG_SUBTRACTED, img_paths[2]: SUBMITTED}
+    assert masks == {img_paths[0]: "/data/A1_well/A1_masks/A1P0_mask_1.tif"}
+    record_tracked("run-A1", ["/data/A1_well/A1_masks/A1P0_mask_1.tif"])
+    assert untracked_fovs(run_progress("run-A1")[0]) == {"A1P1", "A1P2"}
@@ -1,9 +1,10 @@
+import os
 from pathlib import Path
 import numpy as np
 import pytest
 import tifffile as tiff
 
-from cp_server.tasks_server.tasks.saving.save_arrays import save_mask, save_img
+from cp_server.tasks_server.tasks.saving.save_arrays import compression_kwargs, load_masks, save_mask, save_img
 
 
 ############ Test save_mask ############
@@ -42,4 +43,56 @@ def test_save_img(temp_dir, img):
     assert img_file.exists(), f"The file {img_file} was not created."
     
     saved_img = tiff.imread(str(img_file))
-    np.testing.assert_array_equal(img.astype("uint16"), saved_img)
\ No newline at end of file
+    np.testing.assert_array_equal(img.astype("uint16"), saved_img)
+
+########### Test compression codecs ############
+@pytest.mark.parametrize("codec, expected", [
+    ("none", {}),
+    ("zlib", {"compression": "zlib"}),
+    ("zlib:1", {"compression": "zlib", "compressionargs": {"level": 1}}),])
+def test_compression_kwargs(codec, expected):
+    assert compression_kwargs(codec) == expected
+
+@pytest.mark.parametrize("codec", ["gzip", "lzw:3"])
+def test_compression_kwargs_invalid(codec):
+    with pytest.raises(ValueError):
+        compression_kwargs(codec)
+
+@pytest.mark.parametrize("codec", ["none", "zlib:1"])
+def test_save_img_with_codec(temp_dir, img, codec):
+    img_file = temp_dir.joinpath("test_img.tif")
+
+    save_img(img, img_file, compression=codec)
+
+    np.testing.assert_array_equal(img.astype("uint16"), tiff.imread(str(img_file)))
+
+########### Test load_masks ############
+@pytest.mark.parametrize("codec", ["none", "zlib"])
+def test_load_masks_stack(temp_dir, codec):
+    # uint8 and uint16 masks, decoded into the same uint16 stack
+    masks = [np.random.randint(0, max_label, (32, 48)) for max_label in (200, 3000, 60000)]
+    mask_paths = [str(temp_dir.joinpath(f"test_mask_{i}.tif")) for i in range(len(masks))]
+    for mask, mask_path in zip(masks, mask_paths):
+        save_mask(mask, mask_path, compression=codec)
+
+    stack = load_masks(mask_paths)
+
+    assert stack.dtype == np.uint16
+    np.testing.assert_array_equal(stack, np.array(masks))
+
+def test_load_masks_shape_mismatch(temp_dir):
+    mask_paths = [str(temp_dir.joinpath(f"test_mask_{i}.tif")) for i in range(2)]
+    save_mask(np.ones((8, 8)), mask_paths[0])
+    save_mask(np.ones((8, 9)), mask_paths[1])
+
+    with pytest.raises(ValueError):
+        load_masks(mask_paths)
+
+def test_save_img_bg_sub_keeps_mtime(temp_dir, img):
+    img_file = temp_dir.joinpath("test_refseg_1.tif")
+    tiff.imwrite(img_file, img)
+    os.utime(img_file, ns=(0, 123_000_000_000))
+
+    save_img(img, img_file, bg_sub_params={"sigma": 0.0, "size": 7, "bin_factor": 1})
+
+    assert os.stat(img_file).st_mtime_ns == 123_000_000_000
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import numpy as np
+from celery.app.task import Context
+
+from cp_server.tasks_server.tasks.segementation import seg_task
+from cp_server.tasks_server.tasks.segementation.seg_task import _segment_items
+from cp_server.tasks_server.utils import failures, progress
+from cp_server.tasks_server.utils.memory_store import MemoryRedis
+
+
+def test_segment_items_retries_the_failed_images_alone(tmp_path, monkeypatch):
+    store = MemoryRedis()
+    for module in (seg_task, progress, failures):
+        monkeypatch.setattr(module, "redis_client", store)
+    monkeypatch.setattr(seg_task, "record_seg_latency", lambda duration, pixels: None)
+    img_paths = [str(tmp_path / f"A1P{i}_refseg_1.tif") for i in range(4)]
+    unreadable, unwritable = img_paths[1], img_paths[2]
+
+    batches = []
+    def fake_segment_image(img, cellpose_settings, on_mask=None):
+        imgs = img if isinstance(img, list) else [img]
+        batches.append(len(imgs))
+        masks = [np.full((4, 4), index + 1, dtype=np.uint16) for index in range(len(imgs))]
+        for index, mask in enumerate(masks):
+            on_mask(index, mask)
+        return masks if isinstance(img, list) else masks[0]
+
+    def load_image(img_path):
+        if img_path == unreadable:
+            raise OSError(f"cannot read {img_path}")
+        return np.zeros((4, 4))
+
+    saved = []
+    def fake_save_mask(mask, mask_path):
+        if "A1P2" in mask_path:
+            raise OSError(f"cannot write {mask_path}")
+        saved.append(mask_path)
+
+    monkeypatch.setattr(seg_task, "segment_image", fake_segment_image)
+    monkeypatch.setattr(seg_task, "save_mask", fake_save_mask)
+    sent = []
+    task = SimpleNamespace(
+        request=Context(called_directly=False, is_eager=False, chain=None, errbacks=None,
+                        kwargs={"img_path": img_paths, "well_id": "A1", "attempt": 0}),
+        apply_async=lambda **options: sent.append(options))
+
+    hkeys = _segment_items(task, img_paths, load_image, {}, str(tmp_path / "masks"), "A1", 0)
+
+    # The others are segmented together, saved and registered
+    assert batches == [3]
+    assert hkeys == ["masks:A1:A1P0", "masks:A1:A1P3"]
+    assert [mask_path.rsplit("/", 1)[-1] for mask_path in saved] == ["A1P0_mask_1.tif", "A1P3_mask_1.tif"]
+    assert store.hgetall("masks:A1:A1P0") == {b"1": saved[0].encode()}
+    stages, _, _ = progress.run_progress("A1")
+    assert stages == {img_paths[0]: progress.SEGMENTED, img_paths[3]: progress.SEGMENTED}
+    # The failed images are sent to be retried later, by themselves
+    [options] = sent
+    assert options["kwargs"]["img_path"] == [unreadable, unwritable]
+    assert options["kwargs"]["attempt"] == 1 and options["countdown"] > 0
+
+    # The retry segments each image alone
+    batches.clear()
+    task.request.kwargs = options["kwargs"]
+    monkeypatch.setattr(seg_task, "save_mask", lambda mask, mask_path: saved.append(mask_path))
+    hkeys = _segment_items(task, [unreadable, unwritable], lambda img_path: np.zeros((4, 4)), {},
+                           str(tmp_path / "masks"), "A1", 1)
+    assert batches == [1, 1]
+    assert hkeys == ["masks:A1:A1P1", "masks:A1:A1P2"]
+    assert len(sent) == 1
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from cp_server.tasks_server.tasks.saving.save_arrays import generate_track_stats_path, save_track_stats
+from cp_server.tasks_server.tasks.track.track import (TRACK_STATS_COLUMNS, apply_luts, frame_label_stats, frame_overlaps,
+                                                     project_stats, stats_columns, track_luts, track_stats)
+
+
+def _tracked():
+    frame0 = np.array([[1, 1, 0, 0],
+                       [1, 1, 0, 2],
+                       [0, 0, 0, 2]], dtype=np.uint16)
+    frame1 = np.array([[0, 1, 1, 0],
+                       [0, 1, 1, 0],
+                       [0, 0, 0, 0]], dtype=np.uint16)
+    return np.stack([frame0, frame1])
+
+def test_track_stats_columns():
+    stats = track_stats(_tracked())
+    assert tuple(stats) == TRACK_STATS_COLUMNS
+    np.testing.assert_array_equal(stats["label"], [1, 2, 1])
+    np.testing.assert_array_equal(stats["frame"], [0, 0, 1])
+    np.testing.assert_array_equal(stats["area"], [4, 2, 4])
+    np.testing.assert_allclose(stats["centroid_y"], [0.5, 1.5, 0.5])
+    np.testing.assert_allclose(stats["centroid_x"], [0.5, 3.0, 1.5])
+    np.testing.assert_array_equal(stats["bbox_min_y"], [0, 1, 0])
+    np.testing.assert_array_equal(stats["bbox_min_x"], [0, 3, 1])
+    np.testing.assert_array_equal(stats["bbox_max_y"], [2, 3, 2])
+    np.testing.assert_array_equal(stats["bbox_max_x"], [2, 4, 3])
+
+def test_save_track_stats_roundtrip(tmp_path):
+    mask_paths = [str(tmp_path / f"A1P1_mask_{i}.tif") for i in range(1, 3)]
+    stats_path = generate_track_stats_path(mask_paths[0])
+    assert stats_path.name == "A1P1_tracks.npz"
+
+    stats = track_stats(_tracked())
+    save_track_stats(stats, str(stats_path), mask_paths)
+    with np.load(stats_path) as saved:
+        assert list(saved["mask_paths"]) == mask_paths
+        for column in TRACK_STATS_COLUMNS:
+            np.testing.assert_array_equal(saved[column], stats[column])
+
+@pytest.mark.parametrize("matching", ["greedy", "assignment"])
+def test_projected_stats_match_tracked_masks(matching):
+    rng = np.random.default_rng(0)
+    masks = np.zeros((4, 64, 64), dtype=np.uint16)
+    for t in range(4):
+        for label in range(1, 12):
+            y, x = rng.integers(0, 56, 2) + t
+            masks[t, y:y + 8, x:x + 8] = label
+
+    stats = frame_label_stats(masks)
+    luts = track_luts(frame_overlaps(masks, overlap_mode="bbox", stats=stats), 0.1, matching)
+    projected = stats_columns(project_stats(stats, luts))
+    expected = track_stats(apply_luts(masks, luts))
+    for column in TRACK_STATS_COLUMNS:
+        np.testing.assert_array_equal(projected[column], expected[column])